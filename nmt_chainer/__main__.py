@@ -5,6 +5,7 @@ import argparse
 import nmt_chainer.training_module.train_config as train
 import nmt_chainer.translation.eval_config as eval_module
 import nmt_chainer.dataprocessing.make_data_conf as make_data
+import nmt_chainer.training_module.distillation as distillation
 
 import nmt_chainer.utilities.utils_command as utils_command
 
@@ -69,6 +70,11 @@ def main(arguments=None):
     parser_eval = subparsers.add_parser('eval', description="Use a model.", help="Use a model", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     eval_module.define_parser(parser_eval)
 
+    # create the parser for the "distill" command
+    parser_distill = subparsers.add_parser('distill', description="Distill a model or an ensemble into a student model.",
+                                           help="Distill a model or an ensemble into a student model", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    distillation.define_parser(parser_distill)
+
     # create the parser for the "version" command
     parser_version = subparsers.add_parser('version', description="Get version infos.", help="Get version infos", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -88,6 +94,7 @@ def main(arguments=None):
     func = {"make_data": make_data.do_make_data,
             "train": train.do_train,
             "eval": eval_module.do_eval,
+            "distill": distillation.do_distill,
             "version": versioning_tools.main,
             "utils": utils_command.do_utils}[args.__subcommand_name]
 
@@ -104,6 +111,8 @@ def main(arguments=None):
             parser_eval.error(e.args[0])
         except make_data.CommandLineValuesException as e:
             parser_make_data.error(e.args[0])
+        except distillation.CommandLineValuesException as e:
+            parser_distill.error(e.args[0])
 
 
 if __name__ == "__main__":
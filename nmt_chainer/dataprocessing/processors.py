@@ -1058,6 +1058,17 @@ def build_dataset_one_side_pp(src_fn, src_pp, max_nb_ex=None):
     return res, stats_src
 
 
+def iterate_dataset_one_side_pp(src_fn, src_pp, max_nb_ex=None, stats=None):
+    """
+        Lazy version of build_dataset_one_side_pp: yield the converted sentences of src_fn one by one, so that the
+        file is never entirely loaded in memory. src_pp must already be initialized. If stats is not None
+        (as returned by src_pp.make_new_stat()), it is updated as the sentences are read.
+    """
+    assert src_pp.is_initialized()
+    for sentence_src in FileMultiIterator(src_fn, max_nb_ex=max_nb_ex):
+        yield src_pp.convert(sentence_src, stats=stats)
+
+
 # def load_pp_from_data(data):
 #     if Indexer.check_if_data_indexer(data):
 #         indexer = Indexer.make_from_serializable(data)
@@ -11,7 +11,7 @@ from chainer import Link, Chain, ChainList
 import chainer.functions as F
 import chainer.links as L
 
-from nmt_chainer.utilities.utils import ortho_init
+from nmt_chainer.utilities.utils import ortho_init, compute_src_lengths_from_mask
 
 import logging
 logging.basicConfig()
@@ -73,9 +73,26 @@ class AttentionModule(Chain):
                     concatenated_penalties = -10000 * (1 - self.xp.concatenate([
                         self.xp.reshape(mask_elem, (mb_size, 1)).astype(self.xp.float32) for mask_elem in mask], 1))
 
-        def compute_ctxt(previous_state, prev_word_embedding=None):
+        # values of the last rows given to compute_ctxt (the same rows are typically used for many steps)
+        selected_rows_cache = {}
+
+        # if rows is not None, previous_state[i] is a state for the sentence rows[i] of the minibatch
+        # (otherwise, previous_state has a state for each of the current_mb_size first sentences)
+        def compute_ctxt(previous_state, prev_word_embedding=None, rows=None):
             current_mb_size = previous_state.data.shape[0]
-            if current_mb_size < mb_size:
+            if rows is not None:
+                assert len(rows) == current_mb_size
+                if selected_rows_cache.get("rows") is not rows:
+                    selected_rows_cache["rows"] = rows
+                    selected_rows_cache["al_factor"] = F.get_item(precomputed_al_factor, rows)
+                    selected_rows_cache["fb_concat"] = F.get_item(fb_concat, rows)
+                    if mask_length > 0:
+                        selected_rows_cache["penalties"] = concatenated_penalties[rows]
+                al_factor = selected_rows_cache["al_factor"]
+                used_fb_concat = selected_rows_cache["fb_concat"]
+                if mask_length > 0:
+                    used_concatenated_penalties = selected_rows_cache["penalties"]
+            elif current_mb_size < mb_size:
                 al_factor, _ = F.split_axis(
                     precomputed_al_factor, (current_mb_size,), 0)
                 used_fb_concat, _ = F.split_axis(
@@ -110,14 +127,25 @@ class AttentionModule(Chain):
 
         return compute_ctxt
 
-    def compute_ctxt_demux(self, fb_concat, mask):
+    def compute_precomputed_al_factor(self, fb_concat):
+        """ Compute the part of the attention coefficients that only depends on the encoder output fb_concat.
+            The result can be given to compute_ctxt_demux.
+        """
+        mb_size, nb_elems, Hi = fb_concat.data.shape
+        return F.reshape(self.al_lin_h(
+            F.reshape(fb_concat, (mb_size * nb_elems, self.Hi))), (mb_size, nb_elems, self.Ha))
+
+    def compute_ctxt_demux(self, fb_concat, mask, precomputed_al_factor=None):
         mb_size, nb_elems, Hi = fb_concat.data.shape
         assert Hi == self.Hi
+        if mb_size > 1:
+            assert precomputed_al_factor is None
+            return self.compute_ctxt_demux_batch(fb_concat, mask)
         assert mb_size == 1
         assert len(mask) == 0
 
-        precomputed_al_factor = F.reshape(self.al_lin_h(
-            F.reshape(fb_concat, (mb_size * nb_elems, self.Hi))), (mb_size, nb_elems, self.Ha))
+        if precomputed_al_factor is None:
+            precomputed_al_factor = self.compute_precomputed_al_factor(fb_concat)
 
 #         concatenated_mask = F.concat([F.reshape(mask_elem, (mb_size, 1)) for mask_elem in mask], 1)
 
@@ -152,6 +180,69 @@ class AttentionModule(Chain):
 
         return compute_ctxt
 
+    def compute_ctxt_demux_batch(self, fb_concat, mask):
+        """ Version of compute_ctxt_demux for a minibatch of several source sentences.
+
+            The returned function takes an additional argument demux_sizes: a list with one integer for
+            each source sentence, giving the number of consecutive rows of previous_state that are conditionalized
+            on this sentence (0 if there is none).
+
+            The attention of each sentence is computed separately on its unpadded source, so that each row gives
+            the same result as when using compute_ctxt_demux on a single sentence. The returned attention is padded
+            with zeros up to the maximum source length.
+        """
+        mb_size, nb_elems, Hi = fb_concat.data.shape
+        src_lengths = compute_src_lengths_from_mask(mb_size, nb_elems, mask)
+
+        fb_concat_list = []
+        precomputed_al_factor_list = []
+        for num_sent in xrange(mb_size):
+            length = src_lengths[num_sent]
+            this_fb_concat = F.reshape(fb_concat[num_sent, :length], (length, Hi))
+            fb_concat_list.append(this_fb_concat)
+            precomputed_al_factor_list.append(F.reshape(self.al_lin_h(this_fb_concat), (1, length, self.Ha)))
+
+        def compute_ctxt(previous_state, prev_word_embedding=None, demux_sizes=None):
+            assert demux_sizes is not None and len(demux_sizes) == mb_size
+            current_mb_size = previous_state.data.shape[0]
+            assert sum(demux_sizes) == current_mb_size
+
+            state_al_factor = self.al_lin_s(previous_state)
+
+            # As suggested by Isao Goto
+            if prev_word_embedding is not None:
+                state_al_factor = state_al_factor + self.al_lin_y(prev_word_embedding)
+
+            ci_list = []
+            attn_list = []
+            start = 0
+            for num_sent in xrange(mb_size):
+                size = demux_sizes[num_sent]
+                if size == 0:
+                    continue
+                length = src_lengths[num_sent]
+                al_factor = F.broadcast_to(precomputed_al_factor_list[num_sent], (size, length, self.Ha))
+                state_al_factor_bc = F.broadcast_to(F.reshape(state_al_factor[start:start + size], (size, 1, self.Ha)),
+                                                    (size, length, self.Ha))
+                a_coeffs = F.reshape(self.al_lin_o(F.reshape(F.tanh(state_al_factor_bc + al_factor),
+                                                             (size * length, self.Ha))), (size, length))
+
+                attn = F.softmax(a_coeffs)
+
+                ci_list.append(F.reshape(F.matmul(attn, fb_concat_list[num_sent]), (size, self.Hi)))
+
+                if length < nb_elems:
+                    attn = F.concat((attn, Variable(self.xp.zeros((size, nb_elems - length), dtype=self.xp.float32),
+                                                    volatile="auto")), axis=1)
+                attn_list.append(attn)
+                start += size
+
+            ci = F.concat(ci_list, axis=0) if len(ci_list) > 1 else ci_list[0]
+            attn = F.concat(attn_list, axis=0) if len(attn_list) > 1 else attn_list[0]
+            return ci, attn
+
+        return compute_ctxt
+
 
 class DeepAttentionModule(Chain):
     """ DeepAttention Module for computing the current context during decoding.
@@ -176,16 +267,16 @@ class DeepAttentionModule(Chain):
         compute_ctxt1 = self.attn1(fb_concat, mask)
         compute_ctxt2 = self.attn2(fb_concat, mask)
 
-        def compute_ctxt(previous_state):
-            ci1, attn1 = compute_ctxt1(previous_state)
+        def compute_ctxt(previous_state, rows=None):
+            ci1, attn1 = compute_ctxt1(previous_state, rows=rows)
             intermediate_state = F.concat((previous_state, ci1), axis=1)
-            ci2, attn2 = compute_ctxt2(intermediate_state)
+            ci2, attn2 = compute_ctxt2(intermediate_state, rows=rows)
 
             return ci2, attn2
 
         return compute_ctxt
 
-    def compute_ctxt_demux(self, fb_concat, mask):
+    def compute_ctxt_demux(self, fb_concat, mask, precomputed_al_factor=None):
         raise NotImplemented
 
 
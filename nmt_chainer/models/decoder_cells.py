@@ -38,10 +38,20 @@ class ConditionalizedDecoderCell(object):
         Main public methods:
             get_initial_logits return the logits giving the probability for the first word of the translation
             __call__ compute the next decoder state and the next logits
-    
+
+        The rows of the states given to __call__ are normally for the first sentences of the minibatch (in order).
+        If rows is given to __call__, the ith row is instead for the sentence rows[i] of the minibatch (this allows to
+        remove finished sentences from the minibatch).
+
+        If shortlist is not None, it should be a sorted array of target word indices. The logits are then only
+        computed for these words (logits[:, i] is the logit of word shortlist[i]).
+        If shortlist_stats is not None (and shortlist is not None), the logits over the whole target vocabulary
+        are also computed, and shortlist_stats["nb_predictions"] and shortlist_stats["nb_misses"] are incremented
+        by the number of predictions and the number of predictions whose best word is not in the shortlist.
     """
     def __init__(self, decoder_chain, compute_ctxt, mb_size, noise_on_prev_word=False,
-                 mode="test", lexicon_probability_matrix=None, lex_epsilon=1e-3, demux=False):
+                 mode="test", lexicon_probability_matrix=None, lex_epsilon=1e-3, demux=False,
+                 shortlist=None, shortlist_stats=None):
         self.decoder_chain = decoder_chain
         self.compute_ctxt = compute_ctxt
         self.noise_on_prev_word = noise_on_prev_word
@@ -54,15 +64,38 @@ class ConditionalizedDecoderCell(object):
 
         self.xp = decoder_chain.xp
 
+        self.shortlist = shortlist
+        self.shortlist_stats = shortlist_stats
+        if shortlist is not None:
+            self.shortlist_W = Variable(self.xp.take(decoder_chain.lin_o.W.data, shortlist, axis=0), volatile="auto")
+            self.shortlist_b = Variable(self.xp.take(decoder_chain.lin_o.b.data, shortlist, axis=0), volatile="auto")
+            if lexicon_probability_matrix is not None:
+                self.shortlist_lexicon_probability_matrix = self.xp.take(lexicon_probability_matrix, shortlist, axis=2)
+            if shortlist_stats is not None:
+                self.shortlist_mask = self.xp.zeros((decoder_chain.lin_o.W.data.shape[0],), dtype=np.bool_)
+                self.shortlist_mask[shortlist] = True
+                shortlist_stats.setdefault("nb_predictions", 0)
+                shortlist_stats.setdefault("nb_misses", 0)
+
         if noise_on_prev_word:
             self.noise_mean = self.xp.ones((mb_size, self.decoder_chain.Eo), dtype=self.xp.float32)
             self.noise_lnvar = self.xp.zeros((mb_size, self.decoder_chain.Eo), dtype=self.xp.float32)
 
-    def advance_state(self, previous_states, prev_y):
+        self.selected_rows_cache = {}
+
+    def select_rows(self, array, rows):
+        """ Return array[rows], cached for the last rows used with this array """
+        cached_rows, selected = self.selected_rows_cache.get(id(array), (None, None))
+        if cached_rows is not rows:
+            selected = array[rows]
+            self.selected_rows_cache[id(array)] = (rows, selected)
+        return selected
+
+    def advance_state(self, previous_states, prev_y, demux_sizes=None, rows=None):
         current_mb_size = prev_y.data.shape[0]
         assert self.mb_size is None or current_mb_size <= self.mb_size
 
-        if current_mb_size < len(previous_states[0].data):
+        if rows is None and current_mb_size < len(previous_states[0].data):
             truncated_states = [None] * len(previous_states)
             for num_state in xrange(len(previous_states)):
                 truncated_states[num_state], _ = F.split_axis(
@@ -70,54 +103,100 @@ class ConditionalizedDecoderCell(object):
             previous_states = tuple(truncated_states)
 
         output_state = previous_states[-1]
+        ctxt_kwargs = {} if demux_sizes is None else {"demux_sizes": demux_sizes}
+        if rows is not None:
+            ctxt_kwargs["rows"] = rows
         if self.decoder_chain.use_goto_attention:
-            ci, attn = self.compute_ctxt(output_state, prev_y)
+            ci, attn = self.compute_ctxt(output_state, prev_y, **ctxt_kwargs)
         else:
-            ci, attn = self.compute_ctxt(output_state)
+            ci, attn = self.compute_ctxt(output_state, **ctxt_kwargs)
         concatenated = F.concat((prev_y, ci))
 
         new_states = self.decoder_chain.gru(previous_states, concatenated, mode=self.mode)
         return new_states, concatenated, attn
 
-    def compute_logits(self, new_states, concatenated, attn):
+    def compute_logits(self, new_states, concatenated, attn, demux_sizes=None, rows=None):
         new_output_state = new_states[-1]
 
         all_concatenated = F.concat((concatenated, new_output_state))
-        logits = self.decoder_chain.lin_o(self.decoder_chain.maxo(all_concatenated))
+        maxo_output = self.decoder_chain.maxo(all_concatenated)
+
+        if self.shortlist is None:
+            logits = self.decoder_chain.lin_o(maxo_output)
+            if self.lexicon_probability_matrix is not None:
+                logits = self.add_lexicon_probabilities(logits, attn, self.lexicon_probability_matrix,
+                                                        demux_sizes=demux_sizes, rows=rows)
+            return logits
 
+        logits = F.linear(maxo_output, self.shortlist_W, self.shortlist_b)
         if self.lexicon_probability_matrix is not None:
-            current_mb_size = new_output_state.data.shape[0]
-            assert self.mb_size is None or current_mb_size <= self.mb_size
-            lexicon_probability_matrix = self.lexicon_probability_matrix[:current_mb_size]
-
-            # Just making sure data shape is as expected
-            attn_mb_size, max_source_length_attn = attn.data.shape
-            assert attn_mb_size == current_mb_size
-            lex_mb_size, max_source_length_lexicon, v_size_lexicon = lexicon_probability_matrix.shape
-            assert max_source_length_lexicon == max_source_length_attn
-            assert logits.data.shape == (current_mb_size, v_size_lexicon)
-
-            if self.demux:
-                assert lex_mb_size == 1
-                weighted_lex_probs = F.reshape(
-                    matmul_constant(attn, lexicon_probability_matrix.reshape(lexicon_probability_matrix.shape[1],
-                                                                             lexicon_probability_matrix.shape[2])),
-                    logits.data.shape)
-            else:
-                assert lex_mb_size == current_mb_size
+            logits = self.add_lexicon_probabilities(logits, attn, self.shortlist_lexicon_probability_matrix,
+                                                    demux_sizes=demux_sizes, rows=rows)
+
+        if self.shortlist_stats is not None:
+            full_logits = self.decoder_chain.lin_o(maxo_output)
+            if self.lexicon_probability_matrix is not None:
+                full_logits = self.add_lexicon_probabilities(full_logits, attn, self.lexicon_probability_matrix,
+                                                             demux_sizes=demux_sizes, rows=rows)
+            best_words = self.xp.argmax(full_logits.data, axis=1)
+            self.shortlist_stats["nb_predictions"] += len(best_words)
+            self.shortlist_stats["nb_misses"] += int(len(best_words) - self.shortlist_mask[best_words].sum())
+
+        return logits
+
+    def add_lexicon_probabilities(self, logits, attn, lexicon_probability_matrix, demux_sizes=None, rows=None):
+        """
+            Add to logits the log of the lexicon probabilities of the target words, weighted by the attention.
+            lexicon_probability_matrix should have one column for each column of logits.
+        """
+        current_mb_size = logits.data.shape[0]
+        assert self.mb_size is None or current_mb_size <= self.mb_size
+        if rows is not None:
+            lexicon_probability_matrix = self.select_rows(lexicon_probability_matrix, rows)
+        elif not (self.demux and demux_sizes is not None):
+            # with demux_sizes, there is one lexicon matrix for each input sentence, whatever the number of states
+            lexicon_probability_matrix = lexicon_probability_matrix[:current_mb_size]
+
+        # Just making sure data shape is as expected
+        attn_mb_size, max_source_length_attn = attn.data.shape
+        assert attn_mb_size == current_mb_size
+        lex_mb_size, max_source_length_lexicon, v_size_lexicon = lexicon_probability_matrix.shape
+        assert max_source_length_lexicon == max_source_length_attn
+        assert logits.data.shape == (current_mb_size, v_size_lexicon)
+
+        if self.demux and demux_sizes is not None:
+            assert lex_mb_size == len(demux_sizes)
+            weighted_lex_probs_list = []
+            start = 0
+            for num_sent, size in enumerate(demux_sizes):
+                if size == 0:
+                    continue
+                weighted_lex_probs_list.append(matmul_constant(attn[start:start + size],
+                                                               lexicon_probability_matrix[num_sent]))
+                start += size
+            weighted_lex_probs = F.reshape(F.concat(weighted_lex_probs_list, axis=0),
+                                           logits.data.shape)
+        elif self.demux:
+            assert lex_mb_size == 1
+            weighted_lex_probs = F.reshape(
+                matmul_constant(attn, lexicon_probability_matrix.reshape(lexicon_probability_matrix.shape[1],
+                                                                         lexicon_probability_matrix.shape[2])),
+                logits.data.shape)
+        else:
+            assert lex_mb_size == current_mb_size
 
-    #                 weighted_lex_probs = F.reshape(
-    #                         F.batch_matmul(attn, ConstantFunction(lexicon_probability_matrix)(), transa = True),
-    #                                                logits.data.shape)
+#                 weighted_lex_probs = F.reshape(
+#                         F.batch_matmul(attn, ConstantFunction(lexicon_probability_matrix)(), transa = True),
+#                                                logits.data.shape)
 
-                weighted_lex_probs = F.reshape(
-                    batch_matmul_constant(attn, lexicon_probability_matrix, transa=True),
-                    logits.data.shape)
+            weighted_lex_probs = F.reshape(
+                batch_matmul_constant(attn, lexicon_probability_matrix, transa=True),
+                logits.data.shape)
 
-            logits += F.log(weighted_lex_probs + self.lex_epsilon)
+        logits += F.log(weighted_lex_probs + self.lex_epsilon)
         return logits
 
-    def advance_one_step(self, previous_states, prev_y):
+    def advance_one_step(self, previous_states, prev_y, demux_sizes=None, rows=None):
 
         if self.noise_on_prev_word:
             current_mb_size = prev_y.data.shape[0]
@@ -125,13 +204,14 @@ class ConditionalizedDecoderCell(object):
             prev_y = prev_y * F.gaussian(Variable(self.noise_mean[:current_mb_size], volatile="auto"),
                                          Variable(self.noise_lnvar[:current_mb_size], volatile="auto"))
 
-        new_states, concatenated, attn = self.advance_state(previous_states, prev_y)
+        new_states, concatenated, attn = self.advance_state(previous_states, prev_y, demux_sizes=demux_sizes,
+                                                            rows=rows)
 
-        logits = self.compute_logits(new_states, concatenated, attn)
+        logits = self.compute_logits(new_states, concatenated, attn, demux_sizes=demux_sizes, rows=rows)
 
         return new_states, logits, attn
 
-    def get_initial_logits(self, mb_size=None):
+    def get_initial_logits(self, mb_size=None, demux_sizes=None):
         if mb_size is None:
             mb_size = self.mb_size
         assert mb_size is not None
@@ -140,17 +220,17 @@ class ConditionalizedDecoderCell(object):
 
         prev_y = F.broadcast_to(self.decoder_chain.bos_embeding, (mb_size, self.decoder_chain.Eo))
 
-        new_states, logits, attn = self.advance_one_step(previous_states, prev_y)
+        new_states, logits, attn = self.advance_one_step(previous_states, prev_y, demux_sizes=demux_sizes)
 
         return new_states, logits, attn
 
-    def __call__(self, prev_states, inpt, is_soft_inpt=False):
+    def __call__(self, prev_states, inpt, is_soft_inpt=False, demux_sizes=None, rows=None):
         if is_soft_inpt:
             prev_y = F.matmul(inpt, self.decoder_chain.emb.W)
         else:
             prev_y = self.decoder_chain.emb(inpt)
 
-        new_states, logits, attn = self.advance_one_step(prev_states, prev_y)
+        new_states, logits, attn = self.advance_one_step(prev_states, prev_y, demux_sizes=demux_sizes, rows=rows)
 
         return new_states, logits, attn
 
@@ -235,9 +315,17 @@ def compute_loss_from_decoder_cell(cell, targets, use_previous_prediction=0,
 
 
 def sample_from_decoder_cell(cell, nb_steps, best=False, keep_attn_values=False,
-                             need_score=False):
+                             need_score=False, eos_idx=None, nb_steps_per_sentence=None):
     """
         Function that sample an output from a conditionalized decoder cell
+
+        If eos_idx is not None, a sentence is removed from the minibatch as soon as it has generated eos_idx,
+        and the sampling stops when all sentences are finished (so that less than nb_steps steps can be returned).
+        The returned sequences and attention values still have one row for each sentence at each step:
+        finished sentences get eos_idx and a null attention. Their score does not include the steps after EOS.
+
+        nb_steps_per_sentence (which requires eos_idx) can give a maximum number of steps for each sentence.
+        A sentence that reaches it is removed from the minibatch as well.
     """
     states, logits, attn = cell.get_initial_logits()
 
@@ -245,8 +333,26 @@ def sample_from_decoder_cell(cell, nb_steps, best=False, keep_attn_values=False,
     sequences = []
     attn_list = []
 
-    for _ in xrange(nb_steps):
+    mb_size = logits.data.shape[0]
+    if eos_idx is not None:
+        if need_score:
+            score = np.zeros((mb_size,), dtype=np.float32)
+        if nb_steps_per_sentence is not None:
+            assert len(nb_steps_per_sentence) == mb_size
+            nb_steps_per_sentence = np.array(nb_steps_per_sentence)
+            nb_steps = min(nb_steps, int(nb_steps_per_sentence.max()))
+    else:
+        assert nb_steps_per_sentence is None, "nb_steps_per_sentence requires eos_idx"
+    # indices of the sentences still in the minibatch (None while all of them are)
+    rows = None
+    rows_cpu = None
+
+    for num_step in xrange(nb_steps):
         if keep_attn_values:
+            if rows is not None:
+                full_attn = cell.xp.zeros((mb_size, attn.data.shape[1]), dtype=cell.xp.float32)
+                full_attn[rows] = attn.data
+                attn = Variable(full_attn, volatile="auto")
             attn_list.append(attn)
 
         probs = F.softmax(logits)
@@ -266,13 +372,46 @@ def sample_from_decoder_cell(cell, nb_steps, best=False, keep_attn_values=False,
 #                 for i in xrange(mb_size):
 #                     sampler = chainer.utils.WalkerAlias(probs_data[i])
 #                     curr_idx[i] =  sampler.sample(1)[0]
+        current_mb_size = len(curr_idx)
         if need_score:
-            score = score + np.log(cuda.to_cpu(probs.data)[np.arange(cell.mb_size), cuda.to_cpu(curr_idx)])
-        sequences.append(curr_idx)
+            step_score = np.log(cuda.to_cpu(probs.data)[np.arange(current_mb_size), cuda.to_cpu(curr_idx)])
+            if rows is not None:
+                score[rows_cpu] += step_score
+            else:
+                score = score + step_score
+
+        if rows is not None:
+            full_idx = cell.xp.empty((mb_size,), dtype=np.int32)
+            full_idx.fill(eos_idx)
+            full_idx[rows] = curr_idx
+            sequences.append(full_idx)
+        else:
+            sequences.append(curr_idx)
+
+        if num_step == nb_steps - 1:
+            break
+
+        if eos_idx is not None:
+            still_running = cuda.to_cpu(curr_idx) != eos_idx
+            if nb_steps_per_sentence is not None:
+                still_running &= (nb_steps_per_sentence if rows is None
+                                  else nb_steps_per_sentence[rows_cpu]) > num_step + 1
+            if not still_running.all():
+                if not still_running.any():
+                    break
+                kept = np.where(still_running)[0]
+                rows_cpu = kept if rows is None else rows_cpu[kept]
+                rows = rows_cpu if cell.xp == np else cuda.to_gpu(rows_cpu)
+                kept = kept if cell.xp == np else cuda.to_gpu(kept)
+                states = tuple(F.get_item(state, kept) for state in states)
+                curr_idx = curr_idx[kept]
 
         previous_word = Variable(curr_idx, volatile="auto")
 
-        states, logits, attn = cell(states, previous_word)
+        if rows is not None:
+            states, logits, attn = cell(states, previous_word, rows=rows)
+        else:
+            states, logits, attn = cell(states, previous_word)
 
     return sequences, score, attn_list
 
@@ -346,7 +485,8 @@ class Decoder(Chain):
             ortho_init(self.maxo)
 
     def give_conditionalized_cell(self, fb_concat, src_mask, noise_on_prev_word=False,
-                                  mode="test", lexicon_probability_matrix=None, lex_epsilon=1e-3, demux=False):
+                                  mode="test", lexicon_probability_matrix=None, lex_epsilon=1e-3, demux=False,
+                                  shortlist=None, shortlist_stats=None, precomputed_al_factor=None):
         assert mode in "test train".split()
         mb_size, nb_elems, Hi = fb_concat.data.shape
         assert Hi == self.Hi, "%i != %i" % (Hi, self.Hi)
@@ -355,14 +495,15 @@ class Decoder(Chain):
 
         if not demux:
             return ConditionalizedDecoderCell(self, compute_ctxt, mb_size, noise_on_prev_word=noise_on_prev_word,
-                                              mode=mode, lexicon_probability_matrix=lexicon_probability_matrix, lex_epsilon=lex_epsilon)
+                                              mode=mode, lexicon_probability_matrix=lexicon_probability_matrix, lex_epsilon=lex_epsilon,
+                                              shortlist=shortlist, shortlist_stats=shortlist_stats)
         else:
-            assert mb_size == 1
             assert demux >= 1
-            compute_ctxt = self.attn_module.compute_ctxt_demux(fb_concat, src_mask)
+            compute_ctxt = self.attn_module.compute_ctxt_demux(fb_concat, src_mask,
+                                                               precomputed_al_factor=precomputed_al_factor)
             return ConditionalizedDecoderCell(self, compute_ctxt, None, noise_on_prev_word=noise_on_prev_word,
                                               mode=mode, lexicon_probability_matrix=lexicon_probability_matrix, lex_epsilon=lex_epsilon,
-                                              demux=True)
+                                              demux=True, shortlist=shortlist, shortlist_stats=shortlist_stats)
 
     def compute_loss(self, fb_concat, src_mask, targets, raw_loss_info=False, keep_attn_values=False,
                      noise_on_prev_word=False, use_previous_prediction=0, mode="test", per_sentence=False,
@@ -384,12 +525,14 @@ class Decoder(Chain):
         return loss, attn_list
 
     def sample(self, fb_concat, src_mask, nb_steps, mb_size, lexicon_probability_matrix=None,
-               lex_epsilon=1e-3, best=False, keep_attn_values=False, need_score=False):
+               lex_epsilon=1e-3, best=False, keep_attn_values=False, need_score=False,
+               eos_idx=None, nb_steps_per_sentence=None):
         decoding_cell = self.give_conditionalized_cell(fb_concat, src_mask, noise_on_prev_word=False,
                                                        mode="test", lexicon_probability_matrix=lexicon_probability_matrix,
                                                        lex_epsilon=lex_epsilon)
         sequences, score, attn_list = sample_from_decoder_cell(decoding_cell, nb_steps, best=best,
                                                                keep_attn_values=keep_attn_values,
-                                                               need_score=need_score)
+                                                               need_score=need_score, eos_idx=eos_idx,
+                                                               nb_steps_per_sentence=nb_steps_per_sentence)
 
         return sequences, score, attn_list
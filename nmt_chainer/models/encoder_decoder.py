@@ -108,6 +108,39 @@ class EncoderDecoder(Chain):
         self.lexical_probability_dictionary = lexical_probability_dictionary
         self.lex_epsilon = lex_epsilon
 
+        # If not None, a utilities.lru_cache.LRUCache (possibly shared by several models) in which the encoding
+        # of single sentences is kept when creating demux decoder cells (see encode_with_cache)
+        self.encoding_cache = None
+
+    def encode_with_cache(self, src_batch, src_mask):
+        """
+            Return a tuple (fb_concat, precomputed_al_factor) for a minibatch of one sentence, encoded in test mode.
+            If self.encoding_cache is not None, the encoder output and the precomputed attention factor are kept in
+            it, with the key (id of the model, sequence of source indices), so that they are not recomputed
+            the next time the same sentence is encoded.
+        """
+        assert len(src_mask) == 0
+        key = None
+        if self.encoding_cache is not None:
+            key = (id(self), tuple(int(idx) for idx in cuda.to_cpu(self.xp.concatenate([x.data for x in src_batch]))))
+            cached = self.encoding_cache.get(key)
+            if cached is not None:
+                fb_concat_data, precomputed_al_factor_data = cached
+                if precomputed_al_factor_data is None:
+                    return Variable(fb_concat_data, volatile="auto"), None
+                return (Variable(fb_concat_data, volatile="auto"),
+                        Variable(precomputed_al_factor_data, volatile="auto"))
+
+        fb_concat = self.enc(src_batch, src_mask, mode="test")
+        if hasattr(self.dec.attn_module, "compute_precomputed_al_factor"):
+            precomputed_al_factor = self.dec.attn_module.compute_precomputed_al_factor(fb_concat)
+        else:
+            precomputed_al_factor = None
+        if key is not None:
+            self.encoding_cache.put(key, (fb_concat.data,
+                                          None if precomputed_al_factor is None else precomputed_al_factor.data))
+        return fb_concat, precomputed_al_factor
+
     def compute_lexicon_probability_matrix(self, src_batch):
         if self.lexical_probability_dictionary is not None:
             lexicon_probability_matrix = compute_lexicon_matrix(
@@ -125,7 +158,8 @@ class EncoderDecoder(Chain):
                  use_previous_prediction=0, mode="test",
                  use_soft_prediction_feedback=False, 
                 use_gumbel_for_soft_predictions=False,
-                temperature_for_soft_predictions=1.0
+                temperature_for_soft_predictions=1.0,
+                 eos_idx=None, nb_steps_per_sentence=None
                  ):
         assert mode in "test train".split()
 
@@ -139,7 +173,8 @@ class EncoderDecoder(Chain):
             return self.dec.sample(fb_concat, src_mask, tgt_batch, mb_size,
                                    lexicon_probability_matrix=lexicon_probability_matrix,
                                    lex_epsilon=self.lex_epsilon, best=use_best_for_sample,
-                                   keep_attn_values=keep_attn_values, need_score=need_score)
+                                   keep_attn_values=keep_attn_values, need_score=need_score,
+                                   eos_idx=eos_idx, nb_steps_per_sentence=nb_steps_per_sentence)
 
         else:
             return self.dec.compute_loss(fb_concat, src_mask, tgt_batch, raw_loss_info=raw_loss_info,
@@ -152,7 +187,7 @@ class EncoderDecoder(Chain):
                                          temperature_for_soft_predictions=temperature_for_soft_predictions)
 
     def give_conditionalized_cell(self, src_batch, src_mask, noise_on_prev_word=False,
-                                  mode="test", demux=False):
+                                  mode="test", demux=False, shortlist=None, shortlist_stats=None):
 
         if self.lexical_probability_dictionary is not None:
             lexicon_probability_matrix = compute_lexicon_matrix(
@@ -164,24 +199,30 @@ class EncoderDecoder(Chain):
         else:
             lexicon_probability_matrix = None
 
-        fb_concat = self.enc(src_batch, src_mask, mode=mode)
+        precomputed_al_factor = None
+        if demux and mode == "test" and src_batch[0].data.shape[0] == 1:
+            fb_concat, precomputed_al_factor = self.encode_with_cache(src_batch, src_mask)
+        else:
+            fb_concat = self.enc(src_batch, src_mask, mode=mode)
 
         mb_size, nb_elems, Hi = fb_concat.data.shape
 
         return self.dec.give_conditionalized_cell(fb_concat, src_mask,
                                                   noise_on_prev_word=noise_on_prev_word,
                                                   mode=mode, lexicon_probability_matrix=lexicon_probability_matrix,
-                                                  lex_epsilon=self.lex_epsilon, demux=demux)
+                                                  lex_epsilon=self.lex_epsilon, demux=demux,
+                                                  shortlist=shortlist, shortlist_stats=shortlist_stats,
+                                                  precomputed_al_factor=precomputed_al_factor)
 
     def nbest_scorer(self, src_batch, src_mask, keep_attn=False):
         assert len(src_batch[0].data) == 1
 
         lexicon_probability_matrix = self.compute_lexicon_probability_matrix(src_batch)
-        fb_concat = self.enc(src_batch, src_mask)
+        fb_concat, precomputed_al_factor = self.encode_with_cache(src_batch, src_mask)
 
         decoding_cell = self.dec.give_conditionalized_cell(fb_concat, src_mask, noise_on_prev_word=False,
                                                            mode="test", lexicon_probability_matrix=lexicon_probability_matrix, lex_epsilon=self.lex_epsilon,
-                                                           demux=True)
+                                                           demux=True, precomputed_al_factor=precomputed_al_factor)
 
         def scorer(tgt_batch):
 
@@ -195,6 +236,32 @@ class EncoderDecoder(Chain):
 
         return scorer
 
+    def nbest_batch_scorer(self, src_batch, src_mask):
+        """
+            Return a function scoring together candidate translations of all the source sentences of src_batch
+            (each source sentence is encoded only once).
+            The function takes src_indices, giving for each candidate the index of its source sentence in src_batch,
+            and tgt_batch, the candidates as returned by utils.make_batch_tgt (ie. sorted by decreasing length, and
+            src_indices should be in the same order). It returns the same values as the scorer of nbest_scorer.
+        """
+        lexicon_probability_matrix = self.compute_lexicon_probability_matrix(src_batch)
+        fb_concat = self.enc(src_batch, src_mask, mode="test")
+
+        def scorer(src_indices, tgt_batch):
+            src_indices = self.xp.array(src_indices, dtype=self.xp.int32)
+            decoding_cell = self.dec.give_conditionalized_cell(
+                F.get_item(fb_concat, src_indices), [mask_elem[src_indices] for mask_elem in src_mask],
+                noise_on_prev_word=False, mode="test",
+                lexicon_probability_matrix=(None if lexicon_probability_matrix is None
+                                            else lexicon_probability_matrix[src_indices]),
+                lex_epsilon=self.lex_epsilon)
+            return decoder_cells.compute_loss_from_decoder_cell(decoding_cell, tgt_batch,
+                                                                use_previous_prediction=0,
+                                                                raw_loss_info=True,
+                                                                per_sentence=True)
+
+        return scorer
+
 #
 #     def get_sampler_reinf(self, fb_concat, mask, eos_idx, nb_steps = 50, use_best_for_sample = False,
 #                     temperature = None,
@@ -0,0 +1,942 @@
+#!/usr/bin/env python
+"""numpy_inference.py: Graph-free numpy implementation of the forward pass of EncoderDecoder models"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import threading
+
+import numpy as np
+from chainer import cuda, Variable
+
+import rnn_cells
+import encoders
+import attention
+import decoder_cells
+from nmt_chainer.utilities.utils import compute_lexicon_matrix, compute_src_lengths_from_mask
+
+import logging
+logging.basicConfig()
+log = logging.getLogger("rnns:numpy_inference")
+log.setLevel(logging.INFO)
+
+# The classes of this module mirror the chainer links of encoders, attention, decoder_cells and rnn_cells, but only
+# implement their forward pass in test mode, directly on numpy arrays: no chainer Variable or Function is created,
+# and the temporary arrays of each step are written in buffers that are only reallocated when they become too small.
+# NumpyEncoderDecoder can be used in place of an EncoderDecoder by beam_search.ensemble_beam_search(_batch) and
+# evaluation.greedy_batch_translate (the decoder cells return their results wrapped in volatile Variables).
+#
+# With quantize=True, the weight matrices of the linear layers (recurrent cells, attention, maxout, lin_o) and the
+# embeddings are stored as int8 with one float32 scale per row (QuantizedLinear and QuantizedEmbedding), which makes
+# the model about 4 times smaller in memory. Biases, initial states and the attention output vector stay float32.
+
+
+def get_buffer(buffers, name, shape):
+    """
+        Return a C-contiguous float32 array of the given shape, that is a view of the buffer buffers[name].
+        The buffer is (re)allocated if it does not exist yet or is too small.
+    """
+    size = int(np.prod(shape))
+    buf = buffers.get(name)
+    if buf is None or buf.size < size:
+        buf = np.empty((size,), dtype=np.float32)
+        buffers[name] = buf
+    return buf[:size].reshape(shape)
+
+
+class ThreadLocalBuffers(threading.local):
+    """
+        The scratch buffers of a layer, to be used with get_buffer. Each thread has its own dict of buffers, so that
+        the same model can be used by several threads at once (eg. by the concurrent requests of the server).
+    """
+
+    def __init__(self):
+        self.arrays = {}
+
+    def get(self, name):
+        return self.arrays.get(name)
+
+    def __setitem__(self, name, buf):
+        self.arrays[name] = buf
+
+
+# the scratch buffers of QuantizedLinear, shared by all the layers of all the models used by a thread
+_dequantization_buffers = threading.local()
+_all_dequantization_buffers = []
+_all_dequantization_buffers_lock = threading.Lock()
+
+
+def get_dequantization_buffers():
+    """ The dict of scratch buffers of QuantizedLinear for the current thread. """
+    buffers = getattr(_dequantization_buffers, "buffers", None)
+    if buffers is None:
+        buffers = {}
+        _dequantization_buffers.buffers = buffers
+        with _all_dequantization_buffers_lock:
+            _all_dequantization_buffers.append(buffers)
+    return buffers
+
+
+def compute_dequantization_buffers_size_in_bytes():
+    """ Total size of the scratch buffers of QuantizedLinear, for all the threads. """
+    with _all_dequantization_buffers_lock:
+        return sum(buf.nbytes for buffers in _all_dequantization_buffers for buf in buffers.values())
+
+
+def sigmoid(x, out=None):
+    """ Sigmoid computed with the same formula as the cpu implementation of chainer.functions.sigmoid """
+    out = np.multiply(x, 0.5, out=out)
+    np.tanh(out, out=out)
+    out *= 0.5
+    out += 0.5
+    return out
+
+
+def softmax_in_place(x):
+    """ Softmax of each row of the 2-dimensional array x, computed in place """
+    x -= x.max(axis=1, keepdims=True)
+    np.exp(x, out=x)
+    x /= x.sum(axis=1, keepdims=True)
+    return x
+
+
+def unwrap(x):
+    return x.data if isinstance(x, Variable) else x
+
+
+def to_cpu_array(x):
+    return np.ascontiguousarray(cuda.to_cpu(x), dtype=np.float32)
+
+
+def quantize_rows(W):
+    """
+        Symmetric int8 quantization of each row of the 2-dimensional array W.
+        Return (W_q, scale) with W_q an int8 array and scale a float32 array such that W ~= W_q * scale[:, None].
+    """
+    W = np.asarray(W, dtype=np.float32)
+    scale = np.abs(W).max(axis=1) / 127
+    scale[scale == 0] = 1
+    W_q = np.clip(np.round(W / scale[:, None]), -127, 127).astype(np.int8)
+    return W_q, scale.astype(np.float32)
+
+
+class NumpyLinear(object):
+    """ y = x.W^T + b, with W of shape (out_size, in_size) as in chainer.links.Linear """
+
+    def __init__(self, W, b=None):
+        self.WT = np.ascontiguousarray(W.T, dtype=np.float32)
+        self.b = None if b is None else to_cpu_array(b)
+
+    @property
+    def out_size(self):
+        return self.WT.shape[1]
+
+    def select_rows(self, rows):
+        """ Linear layer computing only the outputs of index rows """
+        return NumpyLinear(self.WT[:, rows].T, None if self.b is None else self.b[rows])
+
+    def __call__(self, x, out=None):
+        y = np.dot(x, self.WT, out=out)
+        if self.b is not None:
+            y += self.b
+        return y
+
+
+class QuantizedLinear(object):
+    """
+        Same as NumpyLinear, but W is stored as int8 with one float32 scale per row (see quantize_rows).
+        The product with the int8 weights is computed by blocks of chunk_size rows, that are converted to float32
+        in a small scratch buffer shared by all the layers of the thread (so that no float32 copy of the matrix is
+        ever kept), and the scales are applied to the result: y = (x.W_q^T) * scale + b.
+    """
+    chunk_size = 128
+
+    def __init__(self, W_q, scale, b=None):
+        assert W_q.dtype == np.int8 and len(scale) == len(W_q)
+        self.W_q = W_q
+        self.scale = scale
+        self.b = None if b is None else to_cpu_array(b)
+
+    @staticmethod
+    def quantize(W, b=None):
+        W_q, scale = quantize_rows(W)
+        return QuantizedLinear(W_q, scale, b)
+
+    @property
+    def out_size(self):
+        return self.W_q.shape[0]
+
+    def select_rows(self, rows):
+        return QuantizedLinear(self.W_q[rows], self.scale[rows], None if self.b is None else self.b[rows])
+
+    def __call__(self, x, out=None):
+        out_size, in_size = self.W_q.shape
+        if out is None:
+            out = np.empty((x.shape[0], out_size), dtype=np.float32)
+        buffers = get_dequantization_buffers()
+        for start in xrange(0, out_size, self.chunk_size):
+            W_q_chunk = self.W_q[start:start + self.chunk_size]
+            W_chunk = get_buffer(buffers, "W", W_q_chunk.shape)
+            W_chunk[...] = W_q_chunk
+            if len(W_q_chunk) == out_size:
+                np.dot(x, W_chunk.T, out=out)
+            else:
+                out[:, start:start + len(W_chunk)] = np.dot(
+                    x, W_chunk.T, out=get_buffer(buffers, "y", (x.shape[0], len(W_chunk))))
+        out *= self.scale
+        if self.b is not None:
+            out += self.b
+        return out
+
+
+def make_linear(W, b=None, quantize=False):
+    if quantize:
+        return QuantizedLinear.quantize(W, b)
+    else:
+        return NumpyLinear(W, b)
+
+
+def make_linear_from_link(link, quantize=False):
+    return make_linear(to_cpu_array(link.W.data), None if link.b is None else link.b.data, quantize=quantize)
+
+
+class QuantizedEmbedding(object):
+    """ Embedding matrix stored as int8 with one float32 scale per row. Indexing it returns float32 rows. """
+
+    def __init__(self, W):
+        self.W_q, self.scale = quantize_rows(W)
+
+    def __getitem__(self, ids):
+        res = self.W_q[ids].astype(np.float32)
+        res *= self.scale[ids][..., None]
+        return res
+
+    def dequantize(self):
+        return self.W_q * self.scale[:, None]
+
+
+def make_embedding(W, quantize=False):
+    W = to_cpu_array(W)
+    return QuantizedEmbedding(W) if quantize else W
+
+
+def compute_size_in_bytes(obj, include_buffers=False, _seen=None):
+    """
+        Total size of the weights of an engine object of this module (eg. a NumpyEncoderDecoder): sum of the sizes
+        of the arrays it references, directly or through other objects of this module. Caches are not counted,
+        and buffers only if include_buffers is True (only those of the current thread; the scratch buffers of
+        QuantizedLinear, shared by all the models, are given by compute_dequantization_buffers_size_in_bytes).
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sum(compute_size_in_bytes(elem, include_buffers, _seen) for elem in obj)
+    if isinstance(obj, dict) and include_buffers:
+        return sum(compute_size_in_bytes(elem, include_buffers, _seen) for elem in obj.itervalues())
+    if type(obj).__module__ == __name__:
+        excluded = ("encoding_cache",) if include_buffers else ("buffers", "encoding_cache")
+        return sum(compute_size_in_bytes(value, include_buffers, _seen) for name, value in vars(obj).iteritems()
+                   if name not in excluded)
+    return 0
+
+
+class NumpyMaxout(object):
+    def __init__(self, maxout_link, quantize=False):
+        self.linear = make_linear_from_link(maxout_link.linear, quantize=quantize)
+        self.out_size = maxout_link.out_size
+        self.pool_size = maxout_link.pool_size
+        self.buffers = ThreadLocalBuffers()
+
+    def __call__(self, x):
+        mb_size = x.shape[0]
+        y = self.linear(x, out=get_buffer(self.buffers, "y", (mb_size, self.out_size * self.pool_size)))
+        return y.reshape(mb_size, self.out_size, self.pool_size).max(axis=2)
+
+
+class NumpyLSTMCell(object):
+    """
+        Numpy version of rnn_cells.LSTMCell (and of rnn_cells.GatedLSTMCell if gate is not None).
+        chainer.functions.lstm expects the 4 gates of each unit to be interleaved: the weights are reordered
+        so that each gate is a contiguous block of columns.
+    """
+
+    def __init__(self, cell, quantize=False):
+        H = cell.out_size
+        self.H = H
+
+        def group_gates(a):
+            return np.ascontiguousarray(a.reshape((H, 4) + a.shape[1:]).swapaxes(0, 1).reshape(a.shape))
+
+        lstm = cell.lstm
+        self.upward = make_linear(group_gates(to_cpu_array(lstm.upward.W.data)),
+                                  group_gates(to_cpu_array(lstm.upward.b.data)), quantize=quantize)
+        self.lateral = make_linear(group_gates(to_cpu_array(lstm.lateral.W.data)), quantize=quantize)
+        self.initial_state = to_cpu_array(cell.initial_state.data)
+        self.initial_cell = to_cpu_array(cell.initial_cell)
+
+        if isinstance(cell, rnn_cells.GatedLSTMCell):
+            self.gate = make_linear_from_link(cell.gate_w, quantize=quantize)
+            self.initial_output = to_cpu_array(cell.initial_output)
+        else:
+            self.gate = None
+        self.buffers = ThreadLocalBuffers()
+
+    def get_nb_states(self):
+        return 2 if self.gate is None else 3
+
+    def get_initial_states(self, mb_size):
+        shape = (mb_size, self.H)
+        states = (np.broadcast_to(self.initial_cell, shape), np.broadcast_to(self.initial_state, shape))
+        if self.gate is not None:
+            states += (np.broadcast_to(self.initial_output, shape),)
+        return states
+
+    def project_input(self, x):
+        return self.upward(x)
+
+    def __call__(self, prev_states, x, projected_x=None):
+        H = self.H
+        prev_cell, prev_state = prev_states[:2]
+        if projected_x is None:
+            projected_x = self.upward(x)
+
+        gates = self.lateral(prev_state, out=get_buffer(self.buffers, "gates", (x.shape[0], 4 * H)))
+        gates += projected_x
+        a = gates[:, :H]
+        np.tanh(a, out=a)
+        sigmoid(gates[:, H:], out=gates[:, H:])
+
+        new_cell = a * gates[:, H:2 * H]
+        new_cell += gates[:, 2 * H:3 * H] * prev_cell
+        new_state = np.tanh(new_cell)
+        new_state *= gates[:, 3 * H:]
+
+        if self.gate is None:
+            return new_cell, new_state
+
+        passthrough_gate_state = sigmoid(self.gate(x))
+        output = passthrough_gate_state * x + (1 - passthrough_gate_state) * new_state
+        return new_cell, new_state, output
+
+
+class NumpyGRUCell(object):
+    """
+        Numpy version of rnn_cells.FastGRUCell and rnn_cells.GRUCell.
+        The weights of the GRU links are grouped as in faster_gru.GRU: one projection of the input for the
+        reset gate, update gate and candidate state, and one projection of the state for the two gates.
+    """
+
+    def __init__(self, cell, quantize=False):
+        gru = cell.gru
+        if isinstance(cell, rnn_cells.FastGRUCell):
+            self.W_r_z_h = make_linear_from_link(gru.W_r_z_h, quantize=quantize)
+            self.U_r_z = make_linear_from_link(gru.U_r_z, quantize=quantize)
+        else:
+            self.W_r_z_h = make_linear(np.concatenate([to_cpu_array(l.W.data) for l in (gru.W_r, gru.W_z, gru.W)]),
+                                       np.concatenate([to_cpu_array(l.b.data) for l in (gru.W_r, gru.W_z, gru.W)]),
+                                       quantize=quantize)
+            self.U_r_z = make_linear(np.concatenate([to_cpu_array(l.W.data) for l in (gru.U_r, gru.U_z)]),
+                                     np.concatenate([to_cpu_array(l.b.data) for l in (gru.U_r, gru.U_z)]),
+                                     quantize=quantize)
+        self.U = make_linear_from_link(gru.U, quantize=quantize)
+        self.H = cell.out_size
+        self.initial_state = to_cpu_array(cell.initial_state.data)
+        self.buffers = ThreadLocalBuffers()
+
+    def get_nb_states(self):
+        return 1
+
+    def get_initial_states(self, mb_size):
+        return (np.broadcast_to(self.initial_state, (mb_size, self.H)),)
+
+    def project_input(self, x):
+        return self.W_r_z_h(x)
+
+    def __call__(self, prev_states, x, projected_x=None):
+        H = self.H
+        h, = prev_states
+        if projected_x is None:
+            projected_x = self.W_r_z_h(x)
+
+        r_z = self.U_r_z(h, out=get_buffer(self.buffers, "r_z", (x.shape[0], 2 * H)))
+        r_z += projected_x[:, :2 * H]
+        sigmoid(r_z, out=r_z)
+        r = r_z[:, :H]
+        z = r_z[:, H:]
+
+        h_bar = self.U(r * h)
+        h_bar += projected_x[:, 2 * H:]
+        np.tanh(h_bar, out=h_bar)
+
+        h_new = (1 - z) * h
+        h_new += z * h_bar
+        return (h_new,)
+
+
+class NumpyStackedCell(object):
+    """ Numpy version of rnn_cells.StackedCell (dropout is not applied, as in test mode) """
+
+    def __init__(self, cell, quantize=False):
+        self.sub_cells = [make_numpy_cell(sub_cell, quantize=quantize) for sub_cell in cell]
+        self.nb_of_states = list(cell.nb_of_states)
+        self.residual_connection = cell.residual_connection
+        self.no_residual_connection_on_output = cell.no_residual_connection_on_output
+        self.no_residual_connection_on_input = cell.no_residual_connection_on_input
+
+    def get_nb_states(self):
+        return sum(self.nb_of_states)
+
+    def get_initial_states(self, mb_size):
+        res = []
+        for sub_cell in self.sub_cells:
+            res += list(sub_cell.get_initial_states(mb_size))
+        return tuple(res)
+
+    def project_input(self, x):
+        return self.sub_cells[0].project_input(x)
+
+    def __call__(self, prev_states, x, projected_x=None):
+        input_below = x
+        states_cursor = 0
+        res = []
+        nb_cells = len(self.sub_cells)
+        for i, sub_cell in enumerate(self.sub_cells):
+            new_states = sub_cell(prev_states[states_cursor:states_cursor + self.nb_of_states[i]], input_below,
+                                  projected_x=projected_x if i == 0 else None)
+            states_cursor += self.nb_of_states[i]
+
+            if (self.residual_connection and
+                not (i == nb_cells - 1 and self.no_residual_connection_on_output) and
+                    not (i == 0 and self.no_residual_connection_on_input)):
+                input_below = new_states[-1] + input_below
+            else:
+                input_below = new_states[-1]
+
+            res += list(new_states)
+        return tuple(res)
+
+
+def make_numpy_cell(cell, quantize=False):
+    if isinstance(cell, rnn_cells.StackedCell):
+        return NumpyStackedCell(cell, quantize=quantize)
+    elif isinstance(cell, (rnn_cells.LSTMCell, rnn_cells.GatedLSTMCell)):
+        return NumpyLSTMCell(cell, quantize=quantize)
+    elif isinstance(cell, (rnn_cells.FastGRUCell, rnn_cells.GRUCell)):
+        return NumpyGRUCell(cell, quantize=quantize)
+    else:
+        raise NotImplementedError("numpy inference is not implemented for cells of type %s" % type(cell).__name__)
+
+
+class NumpyEncoder(object):
+    """ Numpy version of encoders.Encoder """
+
+    def __init__(self, encoder, quantize=False):
+        if not isinstance(encoder, encoders.Encoder):
+            raise NotImplementedError("numpy inference is not implemented for encoders of type %s" %
+                                      type(encoder).__name__)
+        self.emb_W = make_embedding(encoder.emb.W.data, quantize=quantize)
+        self.cell_f = make_numpy_cell(encoder.gru_f, quantize=quantize)
+        self.cell_b = make_numpy_cell(encoder.gru_b, quantize=quantize)
+        self.Hi = encoder.Hi
+
+    def __call__(self, src_seq, mask):
+        """
+            src_seq is an int32 array of shape (seq_length, mb_size) (the data of the sequence parameter of
+            Encoder.__call__) and mask is as in Encoder.__call__.
+            Return an array of shape (mb_size, seq_length, 2*Hi).
+        """
+        seq_length, mb_size = src_seq.shape
+        Hi = self.Hi
+        embedded_seq = self.emb_W[src_seq]
+        # the input projections of all the positions are computed with one matrix product for each direction
+        flat_embedded_seq = embedded_seq.reshape(seq_length * mb_size, -1)
+        projected_seq_f = self.cell_f.project_input(flat_embedded_seq).reshape(seq_length, mb_size, -1)
+        projected_seq_b = self.cell_b.project_input(flat_embedded_seq).reshape(seq_length, mb_size, -1)
+
+        fb_concat = np.empty((mb_size, seq_length, 2 * Hi), dtype=np.float32)
+
+        states = self.cell_f.get_initial_states(mb_size)
+        for pos in xrange(seq_length):
+            states = self.cell_f(states, embedded_seq[pos], projected_x=projected_seq_f[pos])
+            fb_concat[:, pos, :Hi] = states[-1]
+
+        mask_offset = seq_length - len(mask)
+        assert mask_offset >= 0
+        initial_states_b = self.cell_b.get_initial_states(mb_size)
+        states = initial_states_b
+        for pos in reversed(xrange(seq_length)):
+            states = self.cell_b(states, embedded_seq[pos], projected_x=projected_seq_b[pos])
+            if pos >= mask_offset:
+                reshaped_mask = np.reshape(mask[pos - mask_offset], (mb_size, 1))
+                states = tuple(np.where(reshaped_mask, state, initial_state)
+                               for state, initial_state in zip(states, initial_states_b))
+            fb_concat[:, pos, Hi:] = states[-1]
+
+        return fb_concat
+
+
+class NumpyAttentionModule(object):
+    """ Numpy version of attention.AttentionModule """
+
+    def __init__(self, attn_module, quantize=False):
+        self.al_lin_h = make_linear_from_link(attn_module.al_lin_h, quantize=quantize)
+        self.al_lin_s = make_linear_from_link(attn_module.al_lin_s, quantize=quantize)
+        self.al_lin_o_w = to_cpu_array(attn_module.al_lin_o.W.data)[0]
+        self.al_lin_y = (make_linear_from_link(attn_module.al_lin_y, quantize=quantize)
+                         if hasattr(attn_module, "al_lin_y") else None)
+        self.Hi = attn_module.Hi
+        self.Ha = attn_module.Ha
+        self.buffers = ThreadLocalBuffers()
+
+    def compute_precomputed_al_factor(self, fb_concat):
+        mb_size, nb_elems, Hi = fb_concat.shape
+        return self.al_lin_h(fb_concat.reshape(mb_size * nb_elems, Hi)).reshape(mb_size, nb_elems, self.Ha)
+
+    def compute_state_al_factor(self, previous_state, prev_word_embedding=None):
+        state_al_factor = self.al_lin_s(previous_state)
+        # As suggested by Isao Goto
+        if prev_word_embedding is not None:
+            state_al_factor += self.al_lin_y(prev_word_embedding)
+        return state_al_factor
+
+    def compute_attention(self, state_al_factor, al_factor, penalties=None):
+        """
+            Attention of each row of state_al_factor (shape (current_mb_size, Ha)) over the source positions,
+            given al_factor of shape (current_mb_size or 1, nb_elems, Ha).
+        """
+        current_mb_size = state_al_factor.shape[0]
+        nb_elems = al_factor.shape[1]
+        hidden = get_buffer(self.buffers, "hidden", (current_mb_size, nb_elems, self.Ha))
+        np.add(state_al_factor.reshape(current_mb_size, 1, self.Ha), al_factor, out=hidden)
+        np.tanh(hidden, out=hidden)
+        a_coeffs = np.dot(hidden.reshape(current_mb_size * nb_elems, self.Ha),
+                          self.al_lin_o_w).reshape(current_mb_size, nb_elems)
+        if penalties is not None:
+            a_coeffs += penalties
+        return softmax_in_place(a_coeffs)
+
+    def __call__(self, fb_concat, mask):
+        mb_size, nb_elems, Hi = fb_concat.shape
+        assert Hi == self.Hi
+        precomputed_al_factor = self.compute_precomputed_al_factor(fb_concat)
+
+        mask_length = len(mask)
+        mask_offset = nb_elems - mask_length
+        assert mask_offset >= 0
+        penalties = None
+        if mask_length > 0:
+            penalties = np.zeros((mb_size, nb_elems), dtype=np.float32)
+            penalties[:, mask_offset:] = -10000 * (1 - np.array(mask, dtype=np.float32).T)
+
+        # values of the last rows given to compute_ctxt (see attention.AttentionModule)
+        selected_rows_cache = {}
+
+        def compute_ctxt(previous_state, prev_word_embedding=None, rows=None):
+            current_mb_size = previous_state.shape[0]
+            if rows is not None:
+                if selected_rows_cache.get("rows") is not rows:
+                    selected_rows_cache["rows"] = rows
+                    selected_rows_cache["al_factor"] = precomputed_al_factor[rows]
+                    selected_rows_cache["fb_concat"] = fb_concat[rows]
+                    selected_rows_cache["penalties"] = None if penalties is None else penalties[rows]
+                used_al_factor = selected_rows_cache["al_factor"]
+                used_fb_concat = selected_rows_cache["fb_concat"]
+                used_penalties = selected_rows_cache["penalties"]
+            else:
+                used_al_factor = precomputed_al_factor[:current_mb_size]
+                used_fb_concat = fb_concat[:current_mb_size]
+                used_penalties = None if penalties is None else penalties[:current_mb_size]
+            state_al_factor = self.compute_state_al_factor(previous_state, prev_word_embedding)
+            attn = self.compute_attention(state_al_factor, used_al_factor, used_penalties)
+            ci = np.matmul(attn.reshape(current_mb_size, 1, nb_elems), used_fb_concat).reshape(current_mb_size, Hi)
+            return ci, attn
+
+        return compute_ctxt
+
+    def compute_ctxt_demux(self, fb_concat, mask, precomputed_al_factor=None):
+        mb_size, nb_elems, Hi = fb_concat.shape
+        assert Hi == self.Hi
+        if mb_size > 1:
+            assert precomputed_al_factor is None
+            return self.compute_ctxt_demux_batch(fb_concat, mask)
+        assert len(mask) == 0
+
+        if precomputed_al_factor is None:
+            precomputed_al_factor = self.compute_precomputed_al_factor(fb_concat)
+        fb_concat_2d = fb_concat.reshape(nb_elems, Hi)
+
+        def compute_ctxt(previous_state, prev_word_embedding=None):
+            state_al_factor = self.compute_state_al_factor(previous_state, prev_word_embedding)
+            attn = self.compute_attention(state_al_factor, precomputed_al_factor)
+            ci = np.dot(attn, fb_concat_2d)
+            return ci, attn
+
+        return compute_ctxt
+
+    def compute_ctxt_demux_batch(self, fb_concat, mask):
+        """ See attention.AttentionModule.compute_ctxt_demux_batch """
+        mb_size, nb_elems, Hi = fb_concat.shape
+        src_lengths = compute_src_lengths_from_mask(mb_size, nb_elems, mask)
+
+        fb_concat_list = [fb_concat[num_sent, :src_lengths[num_sent]] for num_sent in xrange(mb_size)]
+        precomputed_al_factor_list = [self.al_lin_h(this_fb_concat).reshape(1, len(this_fb_concat), self.Ha)
+                                      for this_fb_concat in fb_concat_list]
+
+        def compute_ctxt(previous_state, prev_word_embedding=None, demux_sizes=None):
+            assert demux_sizes is not None and len(demux_sizes) == mb_size
+            current_mb_size = previous_state.shape[0]
+            assert sum(demux_sizes) == current_mb_size
+
+            state_al_factor = self.compute_state_al_factor(previous_state, prev_word_embedding)
+
+            ci = np.empty((current_mb_size, Hi), dtype=np.float32)
+            attn = np.zeros((current_mb_size, nb_elems), dtype=np.float32)
+            start = 0
+            for num_sent in xrange(mb_size):
+                size = demux_sizes[num_sent]
+                if size == 0:
+                    continue
+                length = src_lengths[num_sent]
+                sent_attn = self.compute_attention(state_al_factor[start:start + size],
+                                                   precomputed_al_factor_list[num_sent])
+                np.dot(sent_attn, fb_concat_list[num_sent], out=ci[start:start + size])
+                attn[start:start + size, :length] = sent_attn
+                start += size
+            return ci, attn
+
+        return compute_ctxt
+
+
+class NumpyDeepAttentionModule(object):
+    """ Numpy version of attention.DeepAttentionModule (also usable for demux decoding) """
+
+    def __init__(self, attn_module, quantize=False):
+        self.attn1 = NumpyAttentionModule(attn_module.attn1, quantize=quantize)
+        self.attn2 = NumpyAttentionModule(attn_module.attn2, quantize=quantize)
+
+    def combine(self, compute_ctxt1, compute_ctxt2):
+        def compute_ctxt(previous_state, **kwargs):
+            ci1, _ = compute_ctxt1(previous_state, **kwargs)
+            intermediate_state = np.concatenate((previous_state, ci1), axis=1)
+            return compute_ctxt2(intermediate_state, **kwargs)
+        return compute_ctxt
+
+    def __call__(self, fb_concat, mask):
+        return self.combine(self.attn1(fb_concat, mask), self.attn2(fb_concat, mask))
+
+    def compute_ctxt_demux(self, fb_concat, mask, precomputed_al_factor=None):
+        assert precomputed_al_factor is None
+        return self.combine(self.attn1.compute_ctxt_demux(fb_concat, mask),
+                            self.attn2.compute_ctxt_demux(fb_concat, mask))
+
+
+def make_numpy_attention_module(attn_module, quantize=False):
+    if isinstance(attn_module, attention.AttentionModule):
+        return NumpyAttentionModule(attn_module, quantize=quantize)
+    elif isinstance(attn_module, attention.DeepAttentionModule):
+        return NumpyDeepAttentionModule(attn_module, quantize=quantize)
+    else:
+        raise NotImplementedError("numpy inference is not implemented for attention modules of type %s" %
+                                  type(attn_module).__name__)
+
+
+class NumpyConditionalizedDecoderCell(object):
+    """
+        Numpy version of decoder_cells.ConditionalizedDecoderCell (see its documentation for the parameters).
+        It has the same interface, so that it can be used by the beam search and by
+        decoder_cells.sample_from_decoder_cell / compute_loss_from_decoder_cell: the states, logits and attention
+        it returns are numpy arrays wrapped in volatile Variables, and it accepts Variables or arrays as input.
+    """
+
+    def __init__(self, decoder, compute_ctxt, mb_size, lexicon_probability_matrix=None, lex_epsilon=1e-3,
+                 demux=False, shortlist=None, shortlist_stats=None):
+        self.decoder = decoder
+        self.compute_ctxt = compute_ctxt
+        self.mb_size = mb_size
+        self.lexicon_probability_matrix = lexicon_probability_matrix
+        self.lex_epsilon = lex_epsilon
+        self.demux = demux
+        self.xp = np
+
+        self.shortlist = shortlist
+        self.shortlist_stats = shortlist_stats
+        if shortlist is not None:
+            self.shortlist_lin_o = decoder.lin_o.select_rows(shortlist)
+            if lexicon_probability_matrix is not None:
+                self.shortlist_lexicon_probability_matrix = np.take(lexicon_probability_matrix, shortlist, axis=2)
+            if shortlist_stats is not None:
+                self.shortlist_mask = np.zeros((decoder.lin_o.out_size,), dtype=np.bool_)
+                self.shortlist_mask[shortlist] = True
+                shortlist_stats.setdefault("nb_predictions", 0)
+                shortlist_stats.setdefault("nb_misses", 0)
+
+        self.selected_rows_cache = {}
+
+    def select_rows(self, array, rows):
+        """ See ConditionalizedDecoderCell.select_rows """
+        cached_rows, selected = self.selected_rows_cache.get(id(array), (None, None))
+        if cached_rows is not rows:
+            selected = array[rows]
+            self.selected_rows_cache[id(array)] = (rows, selected)
+        return selected
+
+    def advance_state(self, previous_states, prev_y, demux_sizes=None, rows=None):
+        current_mb_size = prev_y.shape[0]
+        assert self.mb_size is None or current_mb_size <= self.mb_size
+
+        if rows is None and current_mb_size < len(previous_states[0]):
+            previous_states = tuple(state[:current_mb_size] for state in previous_states)
+
+        output_state = previous_states[-1]
+        ctxt_kwargs = {} if demux_sizes is None else {"demux_sizes": demux_sizes}
+        if rows is not None:
+            ctxt_kwargs["rows"] = rows
+        if self.decoder.use_goto_attention:
+            ci, attn = self.compute_ctxt(output_state, prev_y, **ctxt_kwargs)
+        else:
+            ci, attn = self.compute_ctxt(output_state, **ctxt_kwargs)
+        concatenated = np.concatenate((prev_y, ci), axis=1)
+
+        new_states = self.decoder.cell(previous_states, concatenated)
+        return new_states, concatenated, attn
+
+    def compute_logits(self, new_states, concatenated, attn, demux_sizes=None, rows=None):
+        all_concatenated = np.concatenate((concatenated, new_states[-1]), axis=1)
+        maxo_output = self.decoder.maxo(all_concatenated)
+
+        if self.shortlist is None:
+            logits = self.decoder.lin_o(maxo_output)
+            if self.lexicon_probability_matrix is not None:
+                self.add_lexicon_probabilities(logits, attn, self.lexicon_probability_matrix,
+                                               demux_sizes=demux_sizes, rows=rows)
+            return logits
+
+        logits = self.shortlist_lin_o(maxo_output)
+        if self.lexicon_probability_matrix is not None:
+            self.add_lexicon_probabilities(logits, attn, self.shortlist_lexicon_probability_matrix,
+                                           demux_sizes=demux_sizes, rows=rows)
+
+        if self.shortlist_stats is not None:
+            full_logits = self.decoder.lin_o(maxo_output)
+            if self.lexicon_probability_matrix is not None:
+                self.add_lexicon_probabilities(full_logits, attn, self.lexicon_probability_matrix,
+                                               demux_sizes=demux_sizes, rows=rows)
+            best_words = np.argmax(full_logits, axis=1)
+            self.shortlist_stats["nb_predictions"] += len(best_words)
+            self.shortlist_stats["nb_misses"] += int(len(best_words) - self.shortlist_mask[best_words].sum())
+
+        return logits
+
+    def add_lexicon_probabilities(self, logits, attn, lexicon_probability_matrix, demux_sizes=None, rows=None):
+        """ In-place version of ConditionalizedDecoderCell.add_lexicon_probabilities """
+        current_mb_size = logits.shape[0]
+        if self.demux and demux_sizes is not None:
+            assert len(lexicon_probability_matrix) == len(demux_sizes)
+            weighted_lex_probs = np.empty(logits.shape, dtype=np.float32)
+            start = 0
+            for num_sent, size in enumerate(demux_sizes):
+                if size == 0:
+                    continue
+                np.dot(attn[start:start + size], lexicon_probability_matrix[num_sent],
+                       out=weighted_lex_probs[start:start + size])
+                start += size
+        elif self.demux:
+            assert len(lexicon_probability_matrix) == 1
+            weighted_lex_probs = np.dot(attn, lexicon_probability_matrix[0])
+        else:
+            if rows is not None:
+                lexicon_probability_matrix = self.select_rows(lexicon_probability_matrix, rows)
+            else:
+                lexicon_probability_matrix = lexicon_probability_matrix[:current_mb_size]
+            weighted_lex_probs = np.matmul(attn.reshape(current_mb_size, 1, -1),
+                                           lexicon_probability_matrix).reshape(logits.shape)
+
+        weighted_lex_probs += self.lex_epsilon
+        logits += np.log(weighted_lex_probs, out=weighted_lex_probs)
+        return logits
+
+    def advance_one_step(self, previous_states, prev_y, demux_sizes=None, rows=None):
+        new_states, concatenated, attn = self.advance_state(previous_states, prev_y, demux_sizes=demux_sizes,
+                                                            rows=rows)
+        logits = self.compute_logits(new_states, concatenated, attn, demux_sizes=demux_sizes, rows=rows)
+        return (tuple(Variable(state, volatile="auto") for state in new_states),
+                Variable(logits, volatile="auto"), Variable(attn, volatile="auto"))
+
+    def get_initial_logits(self, mb_size=None, demux_sizes=None):
+        if mb_size is None:
+            mb_size = self.mb_size
+        assert mb_size is not None
+
+        previous_states = self.decoder.cell.get_initial_states(mb_size)
+        prev_y = np.broadcast_to(self.decoder.bos_embeding, (mb_size, self.decoder.Eo))
+
+        return self.advance_one_step(previous_states, prev_y, demux_sizes=demux_sizes)
+
+    def __call__(self, prev_states, inpt, is_soft_inpt=False, demux_sizes=None, rows=None):
+        inpt = unwrap(inpt)
+        if is_soft_inpt:
+            emb_W = self.decoder.emb_W
+            if isinstance(emb_W, QuantizedEmbedding):
+                emb_W = emb_W.dequantize()
+            prev_y = np.dot(inpt, emb_W)
+        else:
+            prev_y = self.decoder.emb_W[inpt]
+
+        return self.advance_one_step(tuple(unwrap(state) for state in prev_states), prev_y,
+                                     demux_sizes=demux_sizes, rows=rows)
+
+
+class NumpyDecoder(object):
+    """ Numpy version of decoder_cells.Decoder """
+
+    def __init__(self, decoder, quantize=False):
+        self.emb_W = make_embedding(decoder.emb.W.data, quantize=quantize)
+        self.bos_embeding = to_cpu_array(decoder.bos_embeding.data)
+        self.cell = make_numpy_cell(decoder.gru, quantize=quantize)
+        self.maxo = NumpyMaxout(decoder.maxo, quantize=quantize)
+        self.lin_o = make_linear_from_link(decoder.lin_o, quantize=quantize)
+        self.attn_module = make_numpy_attention_module(decoder.attn_module, quantize=quantize)
+        self.use_goto_attention = decoder.use_goto_attention
+        self.Eo = decoder.Eo
+        self.Hi = decoder.Hi
+
+    def give_conditionalized_cell(self, fb_concat, src_mask, lexicon_probability_matrix=None, lex_epsilon=1e-3,
+                                  demux=False, shortlist=None, shortlist_stats=None, precomputed_al_factor=None):
+        mb_size, nb_elems, Hi = fb_concat.shape
+        assert Hi == self.Hi, "%i != %i" % (Hi, self.Hi)
+
+        if not demux:
+            compute_ctxt = self.attn_module(fb_concat, src_mask)
+            return NumpyConditionalizedDecoderCell(self, compute_ctxt, mb_size,
+                                                   lexicon_probability_matrix=lexicon_probability_matrix,
+                                                   lex_epsilon=lex_epsilon,
+                                                   shortlist=shortlist, shortlist_stats=shortlist_stats)
+        else:
+            compute_ctxt = self.attn_module.compute_ctxt_demux(fb_concat, src_mask,
+                                                               precomputed_al_factor=precomputed_al_factor)
+            return NumpyConditionalizedDecoderCell(self, compute_ctxt, None,
+                                                   lexicon_probability_matrix=lexicon_probability_matrix,
+                                                   lex_epsilon=lex_epsilon, demux=True,
+                                                   shortlist=shortlist, shortlist_stats=shortlist_stats)
+
+
+class NumpyEncoderDecoder(object):
+    """
+        Inference engine running the forward pass of a trained EncoderDecoder directly on numpy arrays.
+
+        It is created from an EncoderDecoder on the cpu, whose weights are copied (and rearranged for faster
+        computation). It supports all the cell types except "nsteps", and both AttentionModule and
+        DeepAttentionModule. It can be used in place of the EncoderDecoder for beam search, greedy translation
+        (__call__ with an int as tgt_batch), loss computation and nbest scoring, in test mode only.
+        Results are the same as with the chainer model, up to float rounding errors.
+
+        If quantize is True, the weight matrices and embeddings are quantized to int8 (see QuantizedLinear):
+        results are then only approximately the same as with the chainer model.
+    """
+
+    def __init__(self, encdec, quantize=False):
+        if encdec.xp is not np:
+            raise ValueError("numpy inference can only be used with models on the cpu")
+        self.quantize = quantize
+        self.enc = NumpyEncoder(encdec.enc, quantize=quantize)
+        self.dec = NumpyDecoder(encdec.dec, quantize=quantize)
+        self.Vo = encdec.Vo
+        self.lexical_probability_dictionary = encdec.lexical_probability_dictionary
+        self.lex_epsilon = encdec.lex_epsilon
+        self.xp = np
+
+        # see EncoderDecoder.encoding_cache
+        self.encoding_cache = None
+
+    def encode(self, src_batch, src_mask):
+        return self.enc(np.array([unwrap(x) for x in src_batch], dtype=np.int32), src_mask)
+
+    def encode_with_cache(self, src_batch, src_mask):
+        """ See EncoderDecoder.encode_with_cache """
+        assert len(src_mask) == 0
+        key = None
+        if self.encoding_cache is not None:
+            key = (id(self), tuple(int(unwrap(x)[0]) for x in src_batch))
+            cached = self.encoding_cache.get(key)
+            if cached is not None:
+                return cached
+
+        fb_concat = self.encode(src_batch, src_mask)
+        if isinstance(self.dec.attn_module, NumpyAttentionModule):
+            precomputed_al_factor = self.dec.attn_module.compute_precomputed_al_factor(fb_concat)
+        else:
+            precomputed_al_factor = None
+        if key is not None:
+            self.encoding_cache.put(key, (fb_concat, precomputed_al_factor))
+        return fb_concat, precomputed_al_factor
+
+    def compute_lexicon_probability_matrix(self, src_batch):
+        if self.lexical_probability_dictionary is None:
+            return None
+        return compute_lexicon_matrix(src_batch, self.lexical_probability_dictionary, self.Vo)
+
+    def give_conditionalized_cell(self, src_batch, src_mask, noise_on_prev_word=False,
+                                  mode="test", demux=False, shortlist=None, shortlist_stats=None):
+        assert mode == "test" and not noise_on_prev_word, "numpy inference is only for test mode"
+        lexicon_probability_matrix = self.compute_lexicon_probability_matrix(src_batch)
+
+        precomputed_al_factor = None
+        if demux and unwrap(src_batch[0]).shape[0] == 1:
+            fb_concat, precomputed_al_factor = self.encode_with_cache(src_batch, src_mask)
+        else:
+            fb_concat = self.encode(src_batch, src_mask)
+
+        return self.dec.give_conditionalized_cell(fb_concat, src_mask,
+                                                  lexicon_probability_matrix=lexicon_probability_matrix,
+                                                  lex_epsilon=self.lex_epsilon, demux=demux,
+                                                  shortlist=shortlist, shortlist_stats=shortlist_stats,
+                                                  precomputed_al_factor=precomputed_al_factor)
+
+    def __call__(self, src_batch, tgt_batch, src_mask, use_best_for_sample=False,
+                 raw_loss_info=False, keep_attn_values=False, need_score=False, mode="test",
+                 eos_idx=None, nb_steps_per_sentence=None):
+        decoding_cell = self.give_conditionalized_cell(src_batch, src_mask, mode=mode)
+        if isinstance(tgt_batch, int):
+            return decoder_cells.sample_from_decoder_cell(decoding_cell, tgt_batch, best=use_best_for_sample,
+                                                          keep_attn_values=keep_attn_values,
+                                                          need_score=need_score, eos_idx=eos_idx,
+                                                          nb_steps_per_sentence=nb_steps_per_sentence)
+        else:
+            return decoder_cells.compute_loss_from_decoder_cell(decoding_cell, tgt_batch,
+                                                                raw_loss_info=raw_loss_info,
+                                                                keep_attn=keep_attn_values)
+
+    def nbest_scorer(self, src_batch, src_mask, keep_attn=False):
+        assert len(unwrap(src_batch[0])) == 1
+        decoding_cell = self.give_conditionalized_cell(src_batch, src_mask, demux=True)
+
+        def scorer(tgt_batch):
+            return decoder_cells.compute_loss_from_decoder_cell(decoding_cell, tgt_batch,
+                                                                use_previous_prediction=0,
+                                                                raw_loss_info=True,
+                                                                per_sentence=True,
+                                                                keep_attn=keep_attn)
+        return scorer
+
+    def nbest_batch_scorer(self, src_batch, src_mask):
+        """ See EncoderDecoder.nbest_batch_scorer """
+        lexicon_probability_matrix = self.compute_lexicon_probability_matrix(src_batch)
+        fb_concat = self.encode(src_batch, src_mask)
+
+        def scorer(src_indices, tgt_batch):
+            src_indices = np.array(src_indices, dtype=np.int32)
+            decoding_cell = self.dec.give_conditionalized_cell(
+                fb_concat[src_indices], [unwrap(mask_elem)[src_indices] for mask_elem in src_mask],
+                lexicon_probability_matrix=(None if lexicon_probability_matrix is None
+                                            else lexicon_probability_matrix[src_indices]),
+                lex_epsilon=self.lex_epsilon)
+            return decoder_cells.compute_loss_from_decoder_cell(decoding_cell, tgt_batch,
+                                                                use_previous_prediction=0,
+                                                                raw_loss_info=True,
+                                                                per_sentence=True)
+        return scorer
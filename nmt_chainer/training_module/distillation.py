@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""distillation.py: sequence-level knowledge distillation of a model (or an ensemble of models) into a student model"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import argparse
+import codecs
+import json
+import logging
+import os.path
+import re
+import shlex
+from collections import OrderedDict
+from itertools import izip
+
+import nmt_chainer.dataprocessing.make_data_conf as make_data_conf
+import nmt_chainer.training_module.train_config as train_config
+import nmt_chainer.translation.eval_config as eval_config
+
+logging.basicConfig()
+log = logging.getLogger("rnns:distillation")
+log.setLevel(logging.INFO)
+
+
+def define_parser(parser):
+    parser.add_argument("training_config", help="training config of the teacher model")
+    parser.add_argument("trained_model", help="parameters of the teacher model")
+    parser.add_argument("src_fn", help="source side of the training data, translated by the teacher")
+    parser.add_argument("dev_src", help="source side of the dev set (used to train the student and in the report)")
+    parser.add_argument("dev_ref", help="reference translations of the dev set")
+    parser.add_argument("save_prefix", help="created files will be saved with this prefix")
+    parser.add_argument("--additional_training_config", nargs="*", help="training configs of the other models of "
+                        "the teacher ensemble")
+    parser.add_argument("--additional_trained_model", nargs="*", help="parameters of the other models of the "
+                        "teacher ensemble")
+    parser.add_argument("--beam_width", type=int, default=5, help="beam width of the teacher (and of the report)")
+    parser.add_argument("--nb_steps_ratio", type=float, default=1.5,
+                        help="maximum length of the teacher translations as a ratio of the source length")
+    parser.add_argument("--max_nb_ex", type=int, help="only distill the first MAX_NB_EX sentences of src_fn")
+    parser.add_argument("--beam_search_batch_size", type=int, default=1,
+                        help="number of sentences translated together by the beam search of the teacher")
+    parser.add_argument("--nb_workers", type=int, default=1,
+                        help="number of forked worker processes translating shards of src_fn (cpu only)")
+    parser.add_argument("--nb_blas_threads", type=int, help="number of BLAS threads of each worker process")
+    parser.add_argument("--gpu", type=int, help="specify gpu number to use, if any")
+    parser.add_argument("--resume", default=False, action="store_true",
+                        help="resume an interrupted translation of src_fn by the teacher")
+    parser.add_argument("--keep_unk", default=False, action="store_true",
+                        help="keep the teacher translations containing unknown words in the distilled data")
+    parser.add_argument("--student_config", help="training config file the student training starts from")
+    parser.add_argument("--student_train_args", default="",
+                        help="additional arguments of the student training (eg. \"--Hi 256 --Ho 256 --max_nb_epochs 10\")")
+    parser.add_argument("--student_max_nb_epochs", type=int, default=10,
+                        help="number of epochs of the student training when neither --student_train_args nor "
+                        "--student_config give --max_nb_iters or --max_nb_epochs")
+    parser.add_argument("--no_report", default=False, action="store_true",
+                        help="do not translate the dev set with the teacher and the student to create the report")
+
+
+class CommandLineValuesException(Exception):
+    pass
+
+
+def run_command(define_command_parser, do_command, arguments):
+    """
+        Run a knmt command (eg. train_config.define_parser and train_config.do_train for 'knmt train') with the
+        given list of arguments.
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    define_command_parser(parser)
+    args = parser.parse_args(args=arguments)
+    args.__original_argument_list = arguments
+    log.info("running: %s" % " ".join(arguments))
+    do_command(args)
+
+
+def has_stop_criterion(train_arguments):
+    """
+        Whether a training run with the list of arguments train_arguments (of 'knmt train') stops by itself, because
+        max_nb_iters or max_nb_epochs is given on the command line or in the config file given by --config.
+    """
+    args_given_set = train_config.find_which_command_line_arguments_were_given(train_arguments)
+    if "max_nb_iters" in args_given_set or "max_nb_epochs" in args_given_set:
+        return True
+    if "config" in args_given_set:
+        parser = argparse.ArgumentParser()
+        train_config.define_parser(parser)
+        config_fn = parser.parse_known_args(train_arguments)[0].config
+        training_management = train_config.load_config_train(config_fn).training_management
+        return any(option in training_management and training_management[option] is not None
+                   for option in ["max_nb_iters", "max_nb_epochs"])
+    return False
+
+
+def filter_distilled_data(src_fn, distilled_fn, filtered_src_fn, filtered_tgt_fn, keep_unk=False):
+    """
+        Write to filtered_src_fn and filtered_tgt_fn the pairs of the source sentences of src_fn and of their
+        translations by the teacher in distilled_fn, except for the empty translations, and, if keep_unk is False,
+        the translations containing unknown words.
+        Return the number of pairs written and the number of pairs removed.
+    """
+    unk_pattern = re.compile(r"#T_UNK_\d+#")
+    nb_written = 0
+    nb_removed = 0
+    with codecs.open(src_fn, encoding="utf8") as src_f, codecs.open(distilled_fn, encoding="utf8") as distilled_f, \
+            codecs.open(filtered_src_fn, "w", encoding="utf8") as filtered_src_f, \
+            codecs.open(filtered_tgt_fn, "w", encoding="utf8") as filtered_tgt_f:
+        for src_line, distilled_line in izip(src_f, distilled_f):
+            if len(distilled_line.strip()) == 0 or (not keep_unk and unk_pattern.search(distilled_line)):
+                nb_removed += 1
+                continue
+            filtered_src_f.write(src_line.rstrip("\n") + "\n")
+            filtered_tgt_f.write(distilled_line.rstrip("\n") + "\n")
+            nb_written += 1
+    return nb_written, nb_removed
+
+
+def compare_teacher_and_student(teacher_models, student_model, dev_src, dev_ref, beam_width=5, nb_steps_ratio=1.5,
+                                gpu=None):
+    """
+        Translate dev_src with the teacher ensemble and with the student with beam search.
+        teacher_models is a list of (training_config, trained_model) pairs and student_model one such pair.
+        Return an OrderedDict with the BLEU, translation time, throughput and number of parameters of each.
+    """
+    from nmt_chainer.dataprocessing.processors import build_dataset_one_side_pp
+    from nmt_chainer.translation.eval import create_and_load_encdec_from_files, check_if_vocabulary_info_compatible
+    from nmt_chainer.translation.evaluation import beam_search_translate
+    from nmt_chainer.utilities.bleu_computer import compute_bleu
+    import timeit
+
+    def load_models(models):
+        encdec_list = []
+        eos_idx, src_indexer, tgt_indexer = None, None, None
+        for training_config, trained_model in models:
+            encdec, this_eos_idx, this_src_indexer, this_tgt_indexer = create_and_load_encdec_from_files(
+                training_config, trained_model)
+            if src_indexer is None:
+                eos_idx, src_indexer, tgt_indexer = this_eos_idx, this_src_indexer, this_tgt_indexer
+            else:
+                check_if_vocabulary_info_compatible(this_eos_idx, this_src_indexer, this_tgt_indexer,
+                                                    eos_idx, src_indexer, tgt_indexer)
+            if gpu is not None:
+                encdec = encdec.to_gpu(gpu)
+            encdec_list.append(encdec)
+        return encdec_list, eos_idx, src_indexer, tgt_indexer
+
+    report = OrderedDict()
+    for name, models in [("teacher", teacher_models), ("student", [student_model])]:
+        encdec_list, eos_idx, src_indexer, tgt_indexer = load_models(models)
+        src_data, _ = build_dataset_one_side_pp(dev_src, src_indexer)
+        with codecs.open(dev_ref, encoding="utf8") as f:
+            references = [line for line, _ in izip(f, src_data)]
+
+        start = timeit.default_timer()
+        translations = [best[0][0] for best in beam_search_translate(encdec_list, eos_idx, src_data,
+                                                                     beam_width=beam_width, gpu=gpu,
+                                                                     nb_steps_ratio=nb_steps_ratio)]
+        translation_time = timeit.default_timer() - start
+
+        translations_str = []
+        for t in translations:
+            if len(t) > 0 and t[-1] == eos_idx:
+                t = t[:-1]
+            translations_str.append(tgt_indexer.deconvert(t, unk_tag="#T_UNK#"))
+
+        infos = OrderedDict()
+        infos["nb_models"] = len(encdec_list)
+        infos["nb_parameters"] = sum(param.data.size for encdec in encdec_list for param in encdec.params())
+        infos["bleu"] = compute_bleu(references, translations_str).bleu() * 100
+        infos["translation_time"] = translation_time
+        infos["sentences_per_second"] = len(src_data) / translation_time
+        infos["words_per_second"] = sum(len(t.split(" ")) for t in translations_str) / translation_time
+        report[name] = infos
+
+    report["nb_dev_sentences"] = len(src_data)
+    report["bleu_delta"] = report["student"]["bleu"] - report["teacher"]["bleu"]
+    report["speedup"] = report["teacher"]["translation_time"] / report["student"]["translation_time"]
+    return report
+
+
+def format_report(report):
+    lines = ["%i dev sentences" % report["nb_dev_sentences"]]
+    for name in ["teacher", "student"]:
+        infos = report[name]
+        lines.append("%-8s %i model(s) %12i parameters   BLEU %.2f   time %.2f s   %.2f sentences/s   %.1f words/s" % (
+            name, infos["nb_models"], infos["nb_parameters"], infos["bleu"], infos["translation_time"],
+            infos["sentences_per_second"], infos["words_per_second"]))
+    lines.append("student vs teacher: BLEU %+.2f   speedup x%.2f" % (report["bleu_delta"], report["speedup"]))
+    return "\n".join(lines)
+
+
+def do_distill(args):
+    """
+        Sequence-level knowledge distillation (Kim & Rush, 2016):
+        1. translate the source side of the training data with the teacher (ensemble) by beam search (knmt eval)
+        2. create the training data of the student from these translations, with the vocabulary of the teacher
+           (knmt make_data)
+        3. train the student on it (knmt train)
+        4. compare the BLEU and the translation speed of the student and of the teacher on the dev set
+    """
+    teacher_models = [(args.training_config, args.trained_model)]
+    if args.additional_training_config is not None or args.additional_trained_model is not None:
+        if (args.additional_training_config is None or args.additional_trained_model is None or
+                len(args.additional_training_config) != len(args.additional_trained_model)):
+            raise CommandLineValuesException("--additional_training_config and --additional_trained_model need "
+                                             "the same number of arguments")
+        teacher_models += zip(args.additional_training_config, args.additional_trained_model)
+
+    data_prefix = args.save_prefix + ".student.data"
+    student_prefix = args.save_prefix + ".student"
+    train_arguments = [data_prefix, student_prefix] + shlex.split(args.student_train_args)
+    if args.student_config is not None:
+        train_arguments += ["--config", args.student_config]
+    if args.gpu is not None:
+        train_arguments += ["--gpu", str(args.gpu)]
+    # checked before the translation by the teacher, which can be long
+    if not has_stop_criterion(train_arguments):
+        log.info("no stop criterion for the student training: training it for %i epochs" % args.student_max_nb_epochs)
+        train_arguments += ["--max_nb_epochs", str(args.student_max_nb_epochs)]
+
+    save_dir = os.path.dirname(args.save_prefix)
+    if save_dir != "" and not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    distilled_fn = args.save_prefix + ".distilled.raw"
+    eval_arguments = [args.training_config, args.trained_model, args.src_fn, distilled_fn,
+                      "--mode", "beam_search", "--beam_width", str(args.beam_width),
+                      "--nb_steps_ratio", str(args.nb_steps_ratio),
+                      "--beam_search_batch_size", str(args.beam_search_batch_size),
+                      "--nb_workers", str(args.nb_workers)]
+    if len(teacher_models) > 1:
+        eval_arguments += (["--additional_training_config"] + [config for config, _ in teacher_models[1:]] +
+                           ["--additional_trained_model"] + [model for _, model in teacher_models[1:]])
+    if args.max_nb_ex is not None:
+        eval_arguments += ["--max_nb_ex", str(args.max_nb_ex)]
+    if args.nb_blas_threads is not None:
+        eval_arguments += ["--nb_blas_threads", str(args.nb_blas_threads)]
+    if args.gpu is not None:
+        eval_arguments += ["--gpu", str(args.gpu)]
+    if args.resume:
+        eval_arguments += ["--resume"]
+    log.info("translating %s with the teacher" % args.src_fn)
+    run_command(eval_config.define_parser, eval_config.do_eval, eval_arguments)
+
+    distilled_src_fn = args.save_prefix + ".distilled.src"
+    distilled_tgt_fn = args.save_prefix + ".distilled.tgt"
+    nb_written, nb_removed = filter_distilled_data(args.src_fn, distilled_fn, distilled_src_fn, distilled_tgt_fn,
+                                                   keep_unk=args.keep_unk)
+    log.info("distilled data: %i sentence pairs (%i removed)" % (nb_written, nb_removed))
+
+    teacher_voc = train_config.load_config_train(args.training_config).data.voc
+    run_command(make_data_conf.define_parser, make_data_conf.do_make_data,
+                [distilled_src_fn, distilled_tgt_fn, data_prefix, "--use_voc", teacher_voc,
+                 "--dev_src", args.dev_src, "--dev_tgt", args.dev_ref, "--force_overwrite"])
+
+    run_command(train_config.define_parser, train_config.do_train, train_arguments)
+
+    if args.no_report:
+        return
+
+    student_model = (student_prefix + ".train.config", student_prefix + ".model.best.npz")
+    if not os.path.exists(student_model[1]):
+        log.warn("%s was not created (no dev BLEU evaluation during training?): no report" % student_model[1])
+        return
+    report = compare_teacher_and_student(teacher_models, student_model, args.dev_src, args.dev_ref,
+                                         beam_width=args.beam_width, nb_steps_ratio=args.nb_steps_ratio, gpu=args.gpu)
+    report_fn = args.save_prefix + ".distill.report.json"
+    log.info("saving report to %s" % report_fn)
+    with open(report_fn, "w") as f:
+        json.dump(report, f, indent=2, separators=(',', ': '))
+    print format_report(report)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""batching_scheduler.py: Gather the translation requests of concurrent server threads into batched decodes"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import collections
+import logging
+import Queue
+import sys
+import threading
+import timeit
+
+logging.basicConfig()
+log = logging.getLogger("rnns:batching_scheduler")
+log.setLevel(logging.INFO)
+
+
+class TranslationRequest(object):
+    """
+        A sentence waiting to be translated by a BatchingScheduler, with its decoding parameters.
+        The scheduler thread sets result (or exc_info) and then the event done.
+    """
+
+    def __init__(self, sentence, params, need_attention):
+        self.sentence = sentence
+        self.params = params
+        self.params_key = tuple(sorted(params.iteritems()))
+        self.need_attention = need_attention
+        self.nb_tokens = len(sentence.split())
+        self.arrival_time = timeit.default_timer()
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+def compute_percentile(values, percent):
+    """
+        The value at the given percentile (nearest rank) of the non-empty list values.
+    """
+    sorted_values = sorted(values)
+    rank = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+class BatchingScheduler(object):
+    """
+        A thread translating the requests submitted by the server threads in batches.
+
+        translate_batch(sentences, params, need_attention) has to return the list of the results for sentences,
+        all of them being translated with the decoding parameters params (a dict of keyword arguments). A result
+        is a tuple whose last element is the attention, which is only kept for the requests that asked for it.
+
+        The scheduler waits for a first request, and then gathers the requests arriving during the next
+        batching_window seconds, until there are max_batch_size of them or (if max_batch_tokens is not None)
+        until adding a request would make their total number of source words larger than max_batch_tokens (this
+        request then starts the next batch). The requests of a batch with the same decoding parameters are
+        translated by a single call to translate_batch.
+        A longer window and larger batches give a better throughput under load, at the price of the latency of
+        the first requests of each batch.
+
+        The latencies of the last latency_history_size requests are kept for make_report.
+    """
+
+    def __init__(self, translate_batch, max_batch_size, batching_window=0.01, max_batch_tokens=None,
+                 latency_history_size=1000):
+        self.translate_batch = translate_batch
+        self.max_batch_size = max_batch_size
+        self.batching_window = batching_window
+        self.max_batch_tokens = max_batch_tokens
+        self.queue = Queue.Queue()
+        self.carried_over_request = None
+        self.nb_requests = 0
+        self.nb_batches = 0
+        self.nb_decodes = 0
+        self.latencies = collections.deque(maxlen=latency_history_size)
+        self.thread = threading.Thread(target=self.run, name="batching_scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def translate(self, sentence, params, need_attention=False):
+        """
+            Submit sentence and wait for its translation by the scheduler thread. An exception raised by
+            translate_batch is raised again here.
+        """
+        return self.translate_list([sentence], params, need_attention=need_attention)[0]
+
+    def translate_list(self, sentences, params, need_attention=False):
+        """
+            Submit all the sentences at once (so that they can be translated in the same batch) and wait for their
+            translations.
+        """
+        requests = [TranslationRequest(sentence, params, need_attention) for sentence in sentences]
+        for request in requests:
+            self.queue.put(request)
+        for request in requests:
+            # wait with a timeout, so that the waiting thread can still be interrupted
+            while not request.done.wait(1):
+                pass
+        for request in requests:
+            if request.exc_info is not None:
+                raise request.exc_info[0], request.exc_info[1], request.exc_info[2]
+        return [request.result for request in requests]
+
+    def collect_batch(self):
+        if self.carried_over_request is not None:
+            first_request = self.carried_over_request
+            self.carried_over_request = None
+        else:
+            first_request = self.queue.get()
+        batch = [first_request]
+        nb_tokens = first_request.nb_tokens
+        deadline = first_request.arrival_time + self.batching_window
+        while len(batch) < self.max_batch_size:
+            remaining_time = deadline - timeit.default_timer()
+            try:
+                if remaining_time > 0:
+                    request = self.queue.get(timeout=remaining_time)
+                else:
+                    # past the window, only take the requests that are already waiting
+                    request = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if self.max_batch_tokens is not None and nb_tokens + request.nb_tokens > self.max_batch_tokens:
+                self.carried_over_request = request
+                break
+            batch.append(request)
+            nb_tokens += request.nb_tokens
+        return batch
+
+    def process_batch(self, batch):
+        groups = collections.OrderedDict()
+        for request in batch:
+            groups.setdefault(request.params_key, []).append(request)
+        for group in groups.itervalues():
+            need_attention = any(request.need_attention for request in group)
+            try:
+                results = self.translate_batch([request.sentence for request in group], group[0].params,
+                                               need_attention)
+                assert len(results) == len(group)
+            except BaseException:
+                exc_info = sys.exc_info()
+                for request in group:
+                    request.exc_info = exc_info
+            else:
+                for request, result in zip(group, results):
+                    if not request.need_attention:
+                        result = result[:-1] + (None,)
+                    request.result = result
+            self.nb_decodes += 1
+            finish_time = timeit.default_timer()
+            for request in group:
+                self.latencies.append(finish_time - request.arrival_time)
+                request.done.set()
+        self.nb_requests += len(batch)
+        self.nb_batches += 1
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            self.process_batch(batch)
+            log.info("batching scheduler: %s" % self.make_report())
+
+    def make_report(self):
+        if self.nb_batches == 0:
+            return "no request"
+        return "%i requests in %i batches (%f per batch, %i decodes)  latency p50: %fs  p99: %fs" % (
+            self.nb_requests, self.nb_batches, float(self.nb_requests) / self.nb_batches, self.nb_decodes,
+            compute_percentile(self.latencies, 50), compute_percentile(self.latencies, 99))
@@ -13,6 +13,7 @@ from chainer import Link, Chain, ChainList
 import chainer.functions as F
 import chainer.links as L
 
+from nmt_chainer.utilities.utils import compute_src_lengths_from_mask
 
 import logging
 logging.basicConfig()
@@ -20,228 +21,322 @@ log = logging.getLogger("rnns:beam_search")
 log.setLevel(logging.INFO)
 
 
-def iterate_best_score(new_scores, beam_width):
+def to_index_array(xp, indices):
     """
-    Create generator over the beam_width best scores.
+    Convert a sequence of indices to a numpy/cupy array of int32
+    """
+    indices_array = np.array(indices, dtype=np.int32)
+    if xp is not np:
+        indices_array = cuda.to_gpu(indices_array)
+    return indices_array
+
+
+def compute_best_candidates(new_scores, beam_width):
+    """
+    Select the beam_width best scores.
 
     Args:
         new_scores: a numpy/cupy 2-dimensional array
         beam_width: a positive integer
 
     Returns:
-        a generator that yields tuples (num_case, idx_in_case, score) where
-            score is one of the top beam_width values of new_scores
-            num_case is the row of this score in new_scores
-            idx_in_case is the column of this score
+        a tuple of numpy arrays (num_cases, idx_in_cases, costs) where
+            costs are the opposite of the top beam_width values of new_scores
+            num_cases are the rows of these scores in new_scores
+            idx_in_cases are the columns of these scores
     """
     nb_cases, v_size = new_scores.shape
     new_costs_flattened = cuda.to_cpu(- new_scores).ravel()
 
-    # TODO replace wit a cupy argpartition when/if implemented
-    best_idx = np.argpartition(new_costs_flattened, beam_width)[:beam_width]
-
-    all_num_cases = best_idx / v_size
-    all_idx_in_cases = best_idx % v_size
+    if len(new_costs_flattened) <= beam_width:
+        # can happen with a small shortlist of target words
+        best_idx = np.arange(len(new_costs_flattened))
+    else:
+        # TODO replace wit a cupy argpartition when/if implemented
+        best_idx = np.argpartition(new_costs_flattened, beam_width)[:beam_width]
 
-    for num in xrange(len(best_idx)):
-        idx = best_idx[num]
-        num_case = all_num_cases[num]
-        idx_in_case = all_idx_in_cases[num]
-        yield num_case, idx_in_case, new_costs_flattened[idx]
+    return best_idx / v_size, best_idx % v_size, new_costs_flattened[best_idx]
 
 
-def iterate_eos_scores(new_scores, eos_idx):
+def compute_eos_candidates(new_scores, eos_idx):
+    """
+    Select the EOS score of each row of new_scores. Return value is similar to compute_best_candidates.
+    """
     nb_cases, v_size = new_scores.shape
+    return (np.arange(nb_cases), np.array([eos_idx] * nb_cases, dtype=np.int64),
+            cuda.to_cpu(- new_scores[:, eos_idx]))
 
-    for num_case in xrange(nb_cases):
-        idx_in_case = eos_idx
-        yield num_case, idx_in_case, cuda.to_cpu(new_scores[num_case, eos_idx])
 
-
-def update_next_lists(num_case, idx_in_case, new_cost, eos_idx, new_state_ensemble, finished_translations, current_translations,
-                      current_attentions,
-                      next_states_list, next_words_list, next_score_list, next_normalized_score_list, next_translations_list,
-                      attn_ensemble, next_attentions_list, beam_score_coverage_penalty, beam_score_coverage_penalty_strength, need_attention=False):
+class BeamHistory(object):
     """
-    Updates the lists containing the infos on translations in current beam
-
-    Args:
-        num_case: the index of the translation in current_translations we are going to try and extend
-        idx_in_case: vocabulary index of the word we want to add to current_translations[num_case]
-        eos_idx: value of the EOS index (so that we can chexk for equality with idx_in_case)
+        Back-pointer storage of the partial translations generated during a beam search.
 
-        new_state_ensemble: list of states as returned by compute_next_states_and_scores
-
-        finished_translations: list of finished translations (for which EOS was generated)
-                    each item in the list is a tuple (translation, score) or (translation, score, attention) if need_attention = True
+        Instead of keeping a full copy of each partial translation (and of its attention values), we only store, for
+        each step, the index of the parent of each hypothesis in the previous beam, its last word and its score.
+        Optionally, the attention used to generate the last word is stored in a buffer of shape
+        (nb_steps, beam_width, src_length). Full translations are reconstructed by backtracking when needed.
 
-        current_translations: list of unfinished translations in the current beam
-                                each item is a sequence of target word index
+        If keep_coverage is True, a running coverage vector (the sum of all the attention vectors of a hypothesis)
+        is also updated at each step, so that coverage penalties do not have to sum over the whole attention history.
+        If return_coverage is True, the coverage vector is added as a fourth element to the finished translations
+        returned with need_attention = True.
 
-        current_attentions: list of attentions for the current beam
-                                each item corresponds to an item in current_translations
-
-        next_states_list: the states extracted from new_state_ensemble corresponding to the translations in next_translations_list
-        next_words_list: list of target word index corresponding to the last words of each translation in next_translations_list
-        next_score_list: list of scores corresponding to the translations in next_translations_list
-        next_translations_list: partially constructed list of translations for the next beam
-            same structure as current_translations
-        next_attentions_list: attention list corresponding to the translations in next_translations_list
-
-        need_attention: if True, keep the attention
-
-    Return:
-        Returns None.
-        But the lists finished_translations, next_states_list, next_words_list, next_score_list, next_translations_list, next_attentions_list
-            will be updated.
+        A hypothesis is identified by its length (which is also the step at which it was generated) and its index
+        in the beam of that step. The initial beam only contains the empty translation.
     """
-    if idx_in_case == eos_idx:
-        if need_attention:
-            finished_translations.append((current_translations[num_case],
-                                          -new_cost,
-                                          current_attentions[num_case]
-                                          ))
-        else:
-            finished_translations.append((current_translations[num_case],
-                                          -new_cost))
-    else:
-        next_states_list.append(
-            [tuple([Variable(substates.data[num_case].reshape(1, -1), volatile="auto") for substates in new_state])
-             for new_state in new_state_ensemble]
-        )
 
-        next_words_list.append(idx_in_case)
-        next_score_list.append(-new_cost)
-
-        # Compute the normalized score if needed.
-        if beam_score_coverage_penalty == "google":
-            coverage_penalty = 0
-            if len(current_attentions[num_case]) > 0:
-                xp = cuda.get_array_module(attn_ensemble[0].data)
-                log_of_min_of_sum_over_j = xp.log(xp.minimum(
-                    sum(current_attentions[num_case]), xp.array(1.0)))
-                coverage_penalty = beam_score_coverage_penalty_strength * \
-                    xp.sum(log_of_min_of_sum_over_j)
-            normalized_score = -new_cost + coverage_penalty
-            next_normalized_score_list.append(normalized_score)
-
-        next_translations_list.append(
-            current_translations[num_case] + [idx_in_case])
+    def __init__(self, xp, nb_steps, beam_width, src_length=None, keep_attention=True, keep_coverage=False,
+                 return_coverage=False):
+        self.xp = xp
+        self.parents = np.zeros((nb_steps, beam_width), dtype=np.int32)
+        self.words = np.zeros((nb_steps, beam_width), dtype=np.int32)
+        self.scores = np.zeros((nb_steps, beam_width), dtype=np.float32)
+        if src_length is not None and keep_attention:
+            self.attentions = xp.zeros((nb_steps, beam_width, src_length), dtype=xp.float32)
+        else:
+            self.attentions = None
+        if src_length is not None and (keep_coverage or return_coverage):
+            self.coverages = xp.zeros((nb_steps, beam_width, src_length), dtype=xp.float32)
+        else:
+            self.coverages = None
+        self.src_length = src_length
+        self.return_coverage = return_coverage
+        self.length = 0  # length of the translations in the last beam
+        self.last_beam_size = 1
+
+    def need_attention_rows(self):
+        return self.attentions is not None or self.coverages is not None
+
+    def add_beam(self, parents, words, scores, attentions=None):
+        """
+            Add a new beam to the history. parents, words and scores are sequences of same length, with one item for
+            each hypothesis of the new beam. attentions is an array with one row for each hypothesis.
+        """
+        assert self.length < self.parents.shape[0]
+        nb_hyps = len(parents)
+        self.parents[self.length, :nb_hyps] = parents
+        self.words[self.length, :nb_hyps] = words
+        self.scores[self.length, :nb_hyps] = scores
+        if self.attentions is not None:
+            assert attentions is not None
+            self.attentions[self.length, :nb_hyps] = attentions
+        if self.coverages is not None:
+            assert attentions is not None
+            if self.length == 0:
+                self.coverages[0, :nb_hyps] = attentions
+            else:
+                self.coverages[self.length, :nb_hyps] = self.xp.take(self.coverages[self.length - 1],
+                                                                     to_index_array(self.xp, parents), axis=0)
+                self.coverages[self.length, :nb_hyps] += attentions
+        self.length += 1
+        self.last_beam_size = nb_hyps
+
+    def get_translation(self, length, num_hyp):
+        translation = [None] * length
+        for pos in xrange(length - 1, -1, -1):
+            translation[pos] = int(self.words[pos, num_hyp])
+            num_hyp = self.parents[pos, num_hyp]
+        return translation
+
+    def get_attention(self, length, num_hyp):
+        assert self.attentions is not None
+        attention = [None] * length
+        for pos in xrange(length - 1, -1, -1):
+            attention[pos] = self.attentions[pos, num_hyp]
+            num_hyp = self.parents[pos, num_hyp]
+        return attention
+
+    def get_coverage(self, length, num_hyp):
+        """
+            Return the sum of the attention vectors of the hypothesis num_hyp of the beam of length 'length'.
+        """
+        assert self.coverages is not None
+        if length == 0:
+            return self.xp.zeros((self.src_length,), dtype=self.xp.float32)
+        return self.coverages[length - 1, num_hyp]
+
+    def compute_coverage_penalties(self, coverage_penalty_strength):
+        """
+            Compute the google coverage penalty of each hypothesis of the last beam.
+            Return a numpy array with one item for each hypothesis.
+        """
+        if self.length == 0:
+            return None
+        xp = self.xp
+        log_of_min_of_sum_over_j = xp.log(xp.minimum(self.coverages[self.length - 1, :self.last_beam_size], xp.array(1.0)))
+        return coverage_penalty_strength * cuda.to_cpu(xp.sum(log_of_min_of_sum_over_j, axis=1)).astype(np.float64)
+
+    def get_finished_translation(self, length, num_hyp, score, need_attention=False):
+        """
+            Return a tuple (translation, score) or (translation, score, attention) if need_attention = True
+            for the hypothesis num_hyp of the beam of length 'length'.
+            If return_coverage is True, the tuple (translation, score, attention, coverage) is returned
+            when need_attention = True.
+        """
         if need_attention:
-            xp = cuda.get_array_module(attn_ensemble[0].data)
-            attn_summed = xp.zeros((attn_ensemble[0].data[0].shape), dtype=xp.float32)
-            for attn in attn_ensemble:
-                attn_summed += attn.data[num_case]
-            attn_summed /= len(attn_ensemble)
-            next_attentions_list.append(current_attentions[num_case] + [attn_summed])
+            if self.return_coverage:
+                return (self.get_translation(length, num_hyp), score, self.get_attention(length, num_hyp),
+                        self.get_coverage(length, num_hyp))
+            return (self.get_translation(length, num_hyp), score, self.get_attention(length, num_hyp))
+        else:
+            return (self.get_translation(length, num_hyp), score)
 
 
-def compute_next_lists(new_state_ensemble, new_scores, beam_width, beam_pruning_margin,
+def compute_next_lists(new_scores, beam_width, beam_pruning_margin,
                        beam_score_length_normalization, beam_score_length_normalization_strength,
                        beam_score_coverage_penalty, beam_score_coverage_penalty_strength,
                        eos_idx,
-                       current_translations,
+                       history,
                        finished_translations,
-                       current_attentions,
-                       attn_ensemble,
                        force_finish=False,
                        need_attention=False):
     """
         Compute the informations for the next beam.
 
         Args:
-            new_state_ensemble: list of states as returned by compute_next_states_and_scores
             new_scores: numpy/cupy array of float32 representing the scores for each augmented translation
                              new_scores[num_case][idx] is the partial score of the partial
-                             translation  current_translations[num_case] augmented with the word whose
+                             translation num_case of the current beam augmented with the word whose
                              target vocabulary index is idx.
             beam_width: maximum number of translations in a beam
             beam_pruning_margin: maximum difference of scores for translations in the same beam
             eos_idx: index of EOS in the target vocabulary
-            current_translations: list of partial translations in the current beam
-                                    each item is a sequence of target vocabulary index
+            history: BeamHistory object whose last beam is the current beam
             finished_translations: list of finished translations found so far (ie for which EOS was generated)
                     each item in the list is a tuple (translation, score) or (translation, score, attention) if need_attention = True
-            current_attentions: attention for each of the partial translation in current_translations
-            attn_ensemble: attention generated when computing the states in new_state_ensemble,
-                            as generated by compute_next_states_and_scores
+                    the translations finishing at this step are appended to it
             force_finish: force the generation of EOS if we did not find a translation after nb_steps steps
             need_attention: if True, attention is kept
 
         Return:
-            A tuple (next_states_list, next_words_list, next_score_list, next_translations_list, next_attentions_list)
-                containing the informations for the next beam
+            A tuple of numpy arrays (next_parents, next_words, next_scores) containing the informations for the
+                next beam. next_parents gives for each translation of the next beam the index of the
+                translation it extends in the current beam.
     """
-    # lists that contain infos on the current beam
-    next_states_list = []  # each item is a list of list
-    next_words_list = []
-    next_score_list = []
-    next_normalized_score_list = []
-    next_translations_list = []
-    next_attentions_list = []
-
     if force_finish:
-        score_iterator = iterate_eos_scores(new_scores, eos_idx)
+        num_cases, idx_in_cases, costs = compute_eos_candidates(new_scores, eos_idx)
     else:
-        score_iterator = iterate_best_score(new_scores, beam_width)
-
-    for num_case, idx_in_case, new_cost in score_iterator:
-        if len(current_translations[num_case]) > 0:
-            if beam_score_length_normalization == 'simple':
-                new_cost /= len(current_translations[num_case])
-            elif beam_score_length_normalization == 'google':
-                new_cost /= (pow((len(current_translations[num_case]) + 5), beam_score_length_normalization_strength) / pow(6, beam_score_length_normalization_strength))
-        update_next_lists(num_case, idx_in_case, new_cost, eos_idx, new_state_ensemble,
-                          finished_translations, current_translations, current_attentions,
-                          next_states_list, next_words_list, next_score_list, next_normalized_score_list, next_translations_list,
-                          attn_ensemble, next_attentions_list, beam_score_coverage_penalty, beam_score_coverage_penalty_strength, need_attention=need_attention)
-        assert len(next_states_list) <= beam_width
-#             if len(next_states_list) >= beam_width:
-#                 break
+        num_cases, idx_in_cases, costs = compute_best_candidates(new_scores, beam_width)
+
+    # all the translations of the current beam have the same length
+    current_length = history.length
+
+    # (casting to float64 gives the same values as a division of float32 scalars)
+    if current_length > 0:
+        if beam_score_length_normalization == 'simple':
+            costs = costs.astype(np.float64) / current_length
+        elif beam_score_length_normalization == 'google':
+            costs = costs.astype(np.float64) / (pow((current_length + 5), beam_score_length_normalization_strength) / pow(6, beam_score_length_normalization_strength))
+
+    # Translations ending with EOS are finished
+    is_eos = idx_in_cases == eos_idx
+    for num in np.nonzero(is_eos)[0]:
+        finished_translations.append(history.get_finished_translation(current_length, num_cases[num], -costs[num],
+                                                                      need_attention=need_attention))
+
+    is_next = np.logical_not(is_eos)
+    next_parents = num_cases[is_next]
+    next_words = idx_in_cases[is_next]
+    next_scores = -costs[is_next]
+    assert len(next_parents) <= beam_width
 
     # Prune items that have a score worse than beam_pruning_margin below the
     # best score.
-    if (beam_pruning_margin is not None and next_score_list):
-        best_next_score = max(next_score_list)
-        bad_score_indices = [
-            idx for idx,
-            elem in enumerate(next_score_list) if (
-                best_next_score -
-                elem > beam_pruning_margin)]
-
-        for i in bad_score_indices[::-1]:
-            del next_states_list[i]
-            del next_words_list[i]
-            del next_score_list[i]
-            del next_translations_list[i]
-            del next_attentions_list[i]
-            if beam_score_coverage_penalty == "google":
-                del next_normalized_score_list[i]
+    if beam_pruning_margin is not None and len(next_scores) > 0:
+        is_kept = (next_scores.max() - next_scores) <= beam_pruning_margin
+        next_parents, next_words, next_scores = next_parents[is_kept], next_words[is_kept], next_scores[is_kept]
 
     # Prune items that have a normalized score worse than beam_pruning_margin
     # below the best normalized score.
-    if (beam_score_coverage_penalty ==
-            "google" and beam_pruning_margin is not None and next_normalized_score_list):
-        best_next_normalized_score = max(next_normalized_score_list)
-        bad_score_indices = [
-            idx for idx,
-            elem in enumerate(next_normalized_score_list) if (
-                best_next_normalized_score -
-                elem > beam_pruning_margin)]
-
-        for i in bad_score_indices[::-1]:
-            del next_states_list[i]
-            del next_words_list[i]
-            del next_score_list[i]
-            del next_normalized_score_list[i]
-            del next_translations_list[i]
-            del next_attentions_list[i]
-
-    return next_states_list, next_words_list, next_score_list, next_translations_list, next_attentions_list
+    if beam_score_coverage_penalty == "google" and beam_pruning_margin is not None and len(next_scores) > 0:
+        coverage_penalties = history.compute_coverage_penalties(beam_score_coverage_penalty_strength)
+        if coverage_penalties is not None:
+            next_normalized_scores = next_scores + coverage_penalties[next_parents]
+        else:
+            next_normalized_scores = next_scores
+        is_kept = (next_normalized_scores.max() - next_normalized_scores) <= beam_pruning_margin
+        next_parents, next_words, next_scores = next_parents[is_kept], next_words[is_kept], next_scores[is_kept]
+
+    return next_parents, next_words, next_scores
+
+
+def combine_scores(xp, logits_ensemble, prob_space_combination=False):
+    """
+        Combine the logits given by each model of an ensemble into log probabilities, by computing
+        the log of the softmax of each chainer variable in logits_ensemble and taking its arithmetic average
+        (or the log of the average of the softmax if prob_space_combination is True).
+    """
+    combined_scores = xp.zeros((logits_ensemble[0].data.shape), dtype=xp.float32)
+
+    if not prob_space_combination:
+        for logits in logits_ensemble:
+            combined_scores += xp.log(F.softmax(logits).data)
+        combined_scores /= len(logits_ensemble)
+    else:
+        for logits in logits_ensemble:
+            combined_scores += F.softmax(logits).data
+        combined_scores /= len(logits_ensemble)
+        combined_scores = xp.log(combined_scores)
+
+    return combined_scores
+
+
+def exp_normalize_in_place(xp, scores):
+    """
+        Replace each row x of the 2-dimensional array scores by exp(x - max(x)) in place,
+        and return the logsumexp of each row as an array of shape (nb_rows, 1).
+    """
+    row_max = scores.max(axis=1, keepdims=True)
+    scores -= row_max
+    xp.exp(scores, out=scores)
+    logsumexp = xp.log(scores.sum(axis=1, keepdims=True))
+    logsumexp += row_max
+    return logsumexp
+
+
+def combine_scores_fused(xp, logits_ensemble, prob_space_combination=False):
+    """
+        Same as combine_scores, but computed without chainer functions: the log-softmax (or softmax) of each
+        model is computed in place in the data of its logits (which is thus overwritten) and accumulated in
+        a single array. No other array of the size of the vocabulary is allocated.
+        Results can differ from combine_scores by rounding errors.
+    """
+    combined_scores = xp.zeros((logits_ensemble[0].data.shape), dtype=xp.float32)
+
+    for logits in logits_ensemble:
+        scores = logits.data
+        if not prob_space_combination:
+            # log_softmax(x) = x - logsumexp(x)
+            combined_scores += scores
+            combined_scores -= exp_normalize_in_place(xp, scores)
+        else:
+            exp_normalize_in_place(xp, scores)
+            scores /= scores.sum(axis=1, keepdims=True)
+            combined_scores += scores
+
+    combined_scores /= len(logits_ensemble)
+    if prob_space_combination:
+        xp.log(combined_scores, out=combined_scores)
+
+    return combined_scores
+
+
+def map_ensemble(ensemble_pool, func, *iterables):
+    """
+        Return [func(*args) for args in zip(*iterables)], where the calls to func are done concurrently by
+        ensemble_pool.map if ensemble_pool is not None (eg. a multiprocessing.pool.ThreadPool).
+        This is used to run the models of an ensemble concurrently: numpy and BLAS release the GIL during most of the
+        computations, and the models are independent until their scores are combined.
+    """
+    args_list = zip(*iterables)
+    if ensemble_pool is None or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+    return ensemble_pool.map(lambda args: func(*args), args_list)
 
 
 def compute_next_states_and_scores(dec_cell_ensemble, current_states_ensemble, current_words,
-                                   prob_space_combination=False):
+                                   prob_space_combination=False, demux_sizes=None, fused_scoring=False,
+                                   ensemble_pool=None):
     """
         Compute the next states and scores when giving current_words as input to the decoding cells in dec_cell_ensemble.
 
@@ -254,6 +349,10 @@ def compute_next_states_and_scores(dec_cell_ensemble, current_states_ensemble, c
             current_words: array of int32 representing the next words to give as input
                             if None, the decoder cell should use its BOS embedding as input
             prob_space_combination: if true, ensemble scores are combined by geometric average instead of arithmetic average
+            demux_sizes: if not None, the decoder cells are conditionalized on several input sentences and
+                            demux_sizes[i] is the number of consecutive states conditionalized on the ith sentence
+            fused_scoring: if True, the scores are combined with combine_scores_fused instead of combine_scores
+            ensemble_pool: if not None, the decoder cells are run concurrently by this pool (see map_ensemble)
 
         Return:
             A tuple (combined_scores, new_state_ensemble, attn_ensemble) where:
@@ -266,27 +365,33 @@ def compute_next_states_and_scores(dec_cell_ensemble, current_states_ensemble, c
 #     xp = cuda.get_array_module(dec_ensemble[0].initial_state.data)
     xp = dec_cell_ensemble[0].xp
 
-    if current_words is not None:
-        states_logits_attn_ensemble = [dec_cell(states, current_words) for (dec_cell, states) in zip(
-            dec_cell_ensemble, current_states_ensemble)]
+    if demux_sizes is None:
+        if current_words is not None:
+            states_logits_attn_ensemble = map_ensemble(ensemble_pool,
+                                                       lambda dec_cell, states: dec_cell(states, current_words),
+                                                       dec_cell_ensemble, current_states_ensemble)
+        else:
+            assert all(x is None for x in current_states_ensemble)
+            states_logits_attn_ensemble = map_ensemble(ensemble_pool, lambda dec_cell: dec_cell.get_initial_logits(1),
+                                                       dec_cell_ensemble)
     else:
-        assert all(x is None for x in current_states_ensemble)
-        states_logits_attn_ensemble = [dec_cell.get_initial_logits(1) for dec_cell in dec_cell_ensemble]
+        if current_words is not None:
+            states_logits_attn_ensemble = map_ensemble(
+                ensemble_pool, lambda dec_cell, states: dec_cell(states, current_words, demux_sizes=demux_sizes),
+                dec_cell_ensemble, current_states_ensemble)
+        else:
+            assert all(x is None for x in current_states_ensemble)
+            states_logits_attn_ensemble = map_ensemble(
+                ensemble_pool, lambda dec_cell: dec_cell.get_initial_logits(sum(demux_sizes), demux_sizes=demux_sizes),
+                dec_cell_ensemble)
 
     new_state_ensemble, logits_ensemble, attn_ensemble = zip(*states_logits_attn_ensemble)
 
     # Combine the scores of the ensembled models
-    combined_scores = xp.zeros((logits_ensemble[0].data.shape), dtype=xp.float32)
-
-    if not prob_space_combination:
-        for logits in logits_ensemble:
-            combined_scores += xp.log(F.softmax(logits).data)
-        combined_scores /= len(dec_cell_ensemble)
+    if fused_scoring:
+        combined_scores = combine_scores_fused(xp, logits_ensemble, prob_space_combination=prob_space_combination)
     else:
-        for logits in logits_ensemble:
-            combined_scores += F.softmax(logits).data
-        combined_scores /= len(dec_cell_ensemble)
-        combined_scores = xp.log(combined_scores)
+        combined_scores = combine_scores(xp, logits_ensemble, prob_space_combination=prob_space_combination)
 
     return combined_scores, new_state_ensemble, attn_ensemble
 
@@ -298,7 +403,7 @@ def advance_one_step(dec_cell_ensemble, eos_idx, current_translations_states, be
                      beam_score_coverage_penalty_strength,
                      finished_translations,
                      force_finish=False, need_attention=False,
-                     prob_space_combination=False):
+                     prob_space_combination=False, shortlist=None, fused_scoring=False, ensemble_pool=None):
     """
         Generate the partial translations / decoder states in the next beam
 
@@ -307,37 +412,78 @@ def advance_one_step(dec_cell_ensemble, eos_idx, current_translations_states, be
                 if the length of this list is larger than one, then we will proceed to do ensemble decoding
             eos_idx: the index of EOS element in the target vocabulary
             current_translations_states: a tuple representing the state of the current beam
-                the tuple has the shape (translations, score, previous_states, previous_words, attention) where:
-                    translations is a list of unfinished translations
-                        each item is a sequence of target vocabulary index
-                    score is a numpy/cupy array of same length as translations, giving the score for each item in translations
+                the tuple has the shape (history, score, previous_states, previous_words) where:
+                    history is a BeamHistory object whose last beam contains the unfinished translations
+                    score is a numpy/cupy array with one item for each translation of the current beam,
+                        giving the score of each translation
                     previous_states is a list of "states", with one state for each cell in dec_cell_ensemble
                         "states" $i$ in previous_states represents the state of cell $i$ in dec_cell_ensemble after
-                            generating the translations in 'translations'. Each states thus actually represents up to
-                            beam_width state, onr for each translation in 'translations'.
+                            generating the translations of the current beam. Each states thus actually represents up to
+                            beam_width state, one for each translation of the current beam.
                             A value of None for a state indicate that the initial state of the decoder should be used.
                     previous_words is a numpy/cupy array of int32 containing the index of the last word of each translation
-                        in 'translations'. If its value is None, it means the decoder should use its BOS embedding as input.
-                    attention is the list of attentions generated for each of the translations in 'translations'
+                        of the current beam. If its value is None, it means the decoder should use its BOS embedding as input.
             finished_translations: list of finished translations
                 each item in the list is a tuple (translation, score) or (translation, score, attention) if need_attention = True
-            beam_width, beam_pruning_margin, force_finish, need_attention, prob_space_combination:
-                see ensemble_beam_search documentation
+            beam_width, beam_pruning_margin, force_finish, need_attention, prob_space_combination, fused_scoring,
+            ensemble_pool: see ensemble_beam_search documentation
+            shortlist: if not None, the numpy array of target word indices the decoder cells compute scores for
+                (eos_idx is then the index of EOS in shortlist)
 
         Returns:
-            A tuple (translations, score, states, words, attention) similar to the input
+            A tuple (history, score, states, words) similar to the input
                 argument current_translations_states, but corresponding to the next beam.
     """
 
 #     xp = cuda.get_array_module(dec_ensemble[0].initial_state.data)
     xp = dec_cell_ensemble[0].xp
-    current_translations, current_scores, current_states_ensemble, current_words, current_attentions = current_translations_states
+    history, current_scores, current_states_ensemble, current_words = current_translations_states
 
     # Compute the next states and associated next word scores
     combined_scores, new_state_ensemble, attn_ensemble = compute_next_states_and_scores(
         dec_cell_ensemble, current_states_ensemble, current_words,
-        prob_space_combination=prob_space_combination)
+        prob_space_combination=prob_space_combination, fused_scoring=fused_scoring, ensemble_pool=ensemble_pool)
+
+    next_parents, next_words, next_scores = update_beam(
+        xp, eos_idx, history, current_scores,
+        combined_scores, attn_ensemble,
+        beam_width, beam_pruning_margin,
+        beam_score_length_normalization, beam_score_length_normalization_strength,
+        beam_score_coverage_penalty, beam_score_coverage_penalty_strength,
+        finished_translations, force_finish=force_finish, need_attention=need_attention,
+        shortlist=shortlist)
+
+    if len(next_parents) == 0:
+        return None  # We only found finished translations
+
+    # Create the new translation states
+
+    next_words_array, gathered_next_states_list = gather_next_states_and_words(
+        xp, new_state_ensemble, next_parents, next_words)
 
+    next_translations_states = (history,
+                                xp.array(next_scores),
+                                gathered_next_states_list,
+                                Variable(next_words_array, volatile="auto")
+                                )
+
+    return next_translations_states
+
+
+def update_beam(xp, eos_idx, history, current_scores,
+                combined_scores, attn_ensemble,
+                beam_width, beam_pruning_margin,
+                beam_score_length_normalization, beam_score_length_normalization_strength,
+                beam_score_coverage_penalty, beam_score_coverage_penalty_strength,
+                finished_translations, force_finish=False, need_attention=False, shortlist=None):
+    """
+        Add the scores of the current beam to combined_scores, compute the lists for the next beam
+        (see compute_next_lists) and add the next beam to history.
+        combined_scores and attn_ensemble should only contain the rows corresponding to the translations of the
+        current beam (ie. the last beam of history).
+        If shortlist is not None, the columns of combined_scores correspond to the words of shortlist, and the
+        returned next_words are converted back to target vocabulary indices.
+    """
     nb_cases, v_size = combined_scores.shape
     assert nb_cases <= beam_width
 
@@ -345,37 +491,106 @@ def advance_one_step(dec_cell_ensemble, eos_idx, current_translations_states, be
     new_scores = current_scores[:, xp.newaxis] + combined_scores
 
     # Compute the list of new translation states after pruning
-    next_states_list, next_words_list, next_score_list, next_translations_list, next_attentions_list = compute_next_lists(
-        new_state_ensemble, new_scores, beam_width, beam_pruning_margin,
+    next_parents, next_words, next_scores = compute_next_lists(
+        new_scores, beam_width, beam_pruning_margin,
         beam_score_length_normalization, beam_score_length_normalization_strength,
         beam_score_coverage_penalty, beam_score_coverage_penalty_strength,
         eos_idx,
-        current_translations, finished_translations,
-        current_attentions, attn_ensemble, force_finish=force_finish, need_attention=need_attention)
+        history, finished_translations,
+        force_finish=force_finish, need_attention=need_attention)
 
-    if len(next_states_list) == 0:
-        return None  # We only found finished translations
+    if shortlist is not None:
+        next_words = shortlist[next_words]
 
-    # Create the new translation states
+    if len(next_parents) > 0:
+        next_attentions = None
+        if history.need_attention_rows():
+            attn_summed = xp.zeros(attn_ensemble[0].data.shape, dtype=xp.float32)
+            for attn in attn_ensemble:
+                attn_summed += attn.data
+            attn_summed /= len(attn_ensemble)
+            next_attentions = xp.take(attn_summed, to_index_array(xp, next_parents), axis=0)
+        history.add_beam(next_parents, next_words, next_scores, attentions=next_attentions)
 
-    next_words_array = np.array(next_words_list, dtype=np.int32)
-    if xp is not np:
-        next_words_array = cuda.to_gpu(next_words_array)
+    return next_parents, next_words, next_scores
 
-    concatenated_next_states_list = []
-    for next_states_list_one_model in zip(*next_states_list):
-        concatenated_next_states_list.append(
-            tuple([F.concat(substates, axis=0) for substates in zip(*next_states_list_one_model)])
+
+def gather_next_states_and_words(xp, new_state_ensemble, next_parents, next_words):
+    """
+        Create the minibatches of states and words that can be given to the decoder cells for the next beam.
+
+        The states of the next beam are gathered in one indexing operation per sub-state from new_state_ensemble
+        (as returned by compute_next_states_and_scores), using the parent indices returned by compute_next_lists.
+
+        Return:
+            A tuple (next_words_array, gathered_next_states_list)
+    """
+    next_words_array = to_index_array(xp, next_words)
+    next_parents_array = to_index_array(xp, next_parents)
+
+    gathered_next_states_list = []
+    for new_state in new_state_ensemble:
+        gathered_next_states_list.append(
+            tuple([Variable(xp.take(substates.data, next_parents_array, axis=0), volatile="auto")
+                   for substates in new_state])
         )
+    return next_words_array, gathered_next_states_list
 
-    next_translations_states = (next_translations_list,
-                                xp.array(next_score_list),
-                                concatenated_next_states_list,
-                                Variable(next_words_array, volatile="auto"),
-                                next_attentions_list
-                                )
 
-    return next_translations_states
+def compute_length_normalization(length, length_normalization, length_normalization_strength):
+    """
+        Return the value by which the score of a translation of the given length is divided
+        when using the length normalization 'none', 'simple' or 'google'.
+    """
+    if length_normalization == 'simple':
+        return length + 1
+    elif length_normalization == 'google':
+        return pow((length + 5), length_normalization_strength) / pow(6, length_normalization_strength)
+    return 1
+
+
+def can_stop_search(history, scores, finished_translations, max_length,
+                    length_normalization, length_normalization_strength):
+    """
+        Return True if no translation of the current beam can be completed into a translation with a better
+        length-normalized score than the best finished translation found so far.
+
+        This is only valid if the scores of the beam are not length-normalized (beam_score_length_normalization
+        is 'none'), as the score of a translation can then only decrease when it is extended. With 'simple' and
+        'google' normalization, the normalized score of a completion is bounded by dividing by the normalization
+        of the longest possible translation (of length max_length).
+        Empty finished translations are ignored, as they are discarded when ranking the translations.
+    """
+    best_finished_score = None
+    for translation in finished_translations:
+        if len(translation[0]) == 0:
+            continue
+        score = translation[1] / compute_length_normalization(len(translation[0]), length_normalization,
+                                                              length_normalization_strength)
+        if best_finished_score is None or score > best_finished_score:
+            best_finished_score = score
+
+    if best_finished_score is None:
+        return False
+
+    best_current_score = float(scores.max())
+    # log probabilities are negative: the bound is obtained with the largest normalization
+    bound_length = max_length if best_current_score <= 0 else history.length
+    bound = best_current_score / compute_length_normalization(bound_length, length_normalization,
+                                                              length_normalization_strength)
+    return best_finished_score >= bound
+
+
+def prepare_shortlist(xp, shortlist, eos_idx):
+    """
+        Return a tuple (shortlist, shortlist_array, shortlist_eos_idx) where shortlist is the given shortlist as a
+        numpy array, shortlist_array is the same array on the device of xp, and shortlist_eos_idx is the position
+        of eos_idx in the shortlist.
+    """
+    shortlist = np.asarray(shortlist, dtype=np.int32)
+    shortlist_eos_idx = int(np.searchsorted(shortlist, eos_idx))
+    assert shortlist_eos_idx < len(shortlist) and shortlist[shortlist_eos_idx] == eos_idx, "EOS not in shortlist"
+    return shortlist, to_index_array(xp, shortlist), shortlist_eos_idx
 
 
 def ensemble_beam_search(model_ensemble, src_batch, src_mask, nb_steps, eos_idx,
@@ -386,7 +601,13 @@ def ensemble_beam_search(model_ensemble, src_batch, src_mask, nb_steps, eos_idx,
                          beam_score_coverage_penalty_strength=0.2,
                          need_attention=False,
                          force_finish=False,
-                         prob_space_combination=False, use_unfinished_translation_if_none_found=False):
+                         prob_space_combination=False, use_unfinished_translation_if_none_found=False,
+                         need_coverage=False,
+                         early_stopping_length_normalization=None,
+                         early_stopping_length_normalization_strength=0.2,
+                         search_stats=None,
+                         shortlist=None, shortlist_stats=None,
+                         fused_scoring=False, ensemble_pool=None):
     """
     Compute translations using a beam-search algorithm.
 
@@ -405,17 +626,51 @@ def ensemble_beam_search(model_ensemble, src_batch, src_mask, nb_steps, eos_idx,
         force_finish: force the generation of EOS if we did not find a translation after nb_steps steps
         prob_space_combination: if true, ensemble scores are combined by geometric average instead of arithmetic average
         use_unfinished_translation_if_none_found: will ureturn unfinished translation if we did not find a translation after nb_steps steps
+        need_coverage: if True (and need_attention is True), each translation also contains the sum of its attention
+                    vectors (to compute post-scoring coverage penalties without summing the attention again)
+        early_stopping_length_normalization: if not None ('none', 'simple' or 'google'), stop the search as soon as
+                    no translation in the beam can get a better score than the best finished translation, when scores
+                    are normalized with this length normalization (see can_stop_search). The best translation is
+                    then the same as without early stopping, but fewer translations are returned.
+                    Requires beam_score_length_normalization to be None or 'none'.
+        early_stopping_length_normalization_strength: strength of the 'google' normalization for early stopping
+        search_stats: if not None, a dictionary in which the keys "nb_steps" (maximum number of steps) and
+                    "nb_steps_done" (number of steps actually done) will be set
+        shortlist: if not None, a sorted array of target word indices (that should contain eos_idx). Only these
+                    words are scored by the decoders, and the softmax is taken over them only.
+        shortlist_stats: if not None (and shortlist is not None), a dictionary in which the number of predictions
+                    and the number of predictions whose best word over the whole target vocabulary is not in the
+                    shortlist are accumulated (keys "nb_predictions" and "nb_misses", for each model of the ensemble)
+        fused_scoring: if True, compute the log probabilities of each step with an in-place log-softmax instead of
+                    chainer functions (see combine_scores_fused)
+        ensemble_pool: if not None (eg. a multiprocessing.pool.ThreadPool), the models of the ensemble are
+                    conditionalized and run concurrently by this pool (see map_ensemble). It is not used if
+                    shortlist_stats is not None, since the statistics are accumulated in a dictionary shared by the models.
 
     Return:
         list of translations
             each item in the list is a tuple (translation, score) or (translation, score, attention) if need_attention = True
+            or (translation, score, attention, coverage) if need_attention = True and need_coverage = True
     """
     mb_size = src_batch[0].data.shape[0]
     assert len(model_ensemble) >= 1
     xp = model_ensemble[0].xp
+    assert early_stopping_length_normalization is None or beam_score_length_normalization in (None, 'none')
+
+    shortlist_array = None
+    if shortlist is not None:
+        shortlist, shortlist_array, eos_idx = prepare_shortlist(xp, shortlist, eos_idx)
+
+    if shortlist_stats is not None:
+        ensemble_pool = None
 
-    dec_cell_ensemble = [model.give_conditionalized_cell(src_batch, src_mask, noise_on_prev_word=False,
-                                                         mode="test", demux=True) for model in model_ensemble]
+    dec_cell_ensemble = map_ensemble(ensemble_pool,
+                                     lambda model: model.give_conditionalized_cell(src_batch, src_mask,
+                                                                                   noise_on_prev_word=False,
+                                                                                   mode="test", demux=True,
+                                                                                   shortlist=shortlist_array,
+                                                                                   shortlist_stats=shortlist_stats),
+                                     model_ensemble)
 
     assert mb_size == 1
     # TODO: if mb_size == 1 then src_mask value unnecessary -> remove?
@@ -427,15 +682,17 @@ def ensemble_beam_search(model_ensemble, src_batch, src_mask, nb_steps, eos_idx,
 
     # Current_translations_states will hold the information for the current beam
     current_translations_states = (
-        [[]],  # translations
+        create_beam_history(xp, nb_steps, beam_width, len(src_batch), need_attention,
+                            beam_score_coverage_penalty, need_coverage=need_coverage),  # history of the translations
         xp.array([0]),  # scores
         previous_states_ensemble,  # previous states
-        None,  # previous words
-        [[]]  # attention
+        None  # previous words
     )
 
     # Proceed with the search
+    nb_steps_done = 0
     for num_step in xrange(nb_steps):
+        nb_steps_done += 1
         current_translations_states = advance_one_step(
             dec_cell_ensemble,
             eos_idx,
@@ -449,26 +706,208 @@ def ensemble_beam_search(model_ensemble, src_batch, src_mask, nb_steps, eos_idx,
             finished_translations,
             force_finish=force_finish and num_step == (nb_steps - 1),
             need_attention=need_attention,
-            prob_space_combination=prob_space_combination)
+            prob_space_combination=prob_space_combination,
+            shortlist=shortlist,
+            fused_scoring=fused_scoring,
+            ensemble_pool=ensemble_pool)
 
         if current_translations_states is None:
             break
 
+        if early_stopping_length_normalization is not None and can_stop_search(
+                current_translations_states[0], current_translations_states[1], finished_translations, nb_steps - 1,
+                early_stopping_length_normalization, early_stopping_length_normalization_strength):
+            break
+
 #     print finished_translations, need_attention
 
+    if search_stats is not None:
+        search_stats["nb_steps"] = nb_steps
+        search_stats["nb_steps_done"] = nb_steps_done
+
     # Return finished translations
+    complete_finished_translations(finished_translations, current_translations_states, need_attention=need_attention,
+                                   use_unfinished_translation_if_none_found=use_unfinished_translation_if_none_found)
+    return finished_translations
+
+
+def create_beam_history(xp, nb_steps, beam_width, src_length, need_attention, beam_score_coverage_penalty,
+                        need_coverage=False):
+    """
+        Create the BeamHistory for the search of a sentence of length src_length. The attention values are kept if
+        they are needed for the result, and the coverage vectors if they are needed for computing the coverage penalty.
+    """
+    return BeamHistory(xp, nb_steps, beam_width, src_length=src_length, keep_attention=need_attention,
+                       keep_coverage=beam_score_coverage_penalty == "google",
+                       return_coverage=need_coverage and need_attention)
+
+
+def complete_finished_translations(finished_translations, current_translations_states, need_attention=False,
+                                   use_unfinished_translation_if_none_found=False):
+    """
+        Make sure finished_translations contains at least one translation once the search is over, either by using
+        the best unfinished translation of the last beam or by adding an empty translation.
+    """
     if len(finished_translations) == 0:
         if use_unfinished_translation_if_none_found:
             assert current_translations_states is not None
-            if need_attention:
-                translations, scores, _, _, attentions = current_translations_states
-                finished_translations.append(
-                    (translations[0], scores[0], attentions[0]))
-            else:
-                finished_translations.append((translations[0], scores[0]))
+            history, scores, _, _ = current_translations_states
+            finished_translations.append(history.get_finished_translation(history.length, 0, scores[0],
+                                                                          need_attention=need_attention))
         else:
             if need_attention:
                 finished_translations.append(([], 0, []))
             else:
                 finished_translations.append(([], 0))
-    return finished_translations
+
+
+def ensemble_beam_search_batch(model_ensemble, src_batch, src_mask, nb_steps, eos_idx,
+                               beam_width=20, beam_pruning_margin=None,
+                               beam_score_length_normalization=None,
+                               beam_score_length_normalization_strength=0.2,
+                               beam_score_coverage_penalty=None,
+                               beam_score_coverage_penalty_strength=0.2,
+                               need_attention=False,
+                               force_finish=False,
+                               prob_space_combination=False, use_unfinished_translation_if_none_found=False,
+                               need_coverage=False,
+                               early_stopping_length_normalization=None,
+                               early_stopping_length_normalization_strength=0.2,
+                               search_stats=None,
+                               shortlist=None, shortlist_stats=None,
+                               fused_scoring=False, ensemble_pool=None):
+    """
+    Compute translations for several sentences at once using a beam-search algorithm.
+
+    The beams of all the sentences of the minibatch are concatenated so that the decoder cells are only called once
+    per step. The search itself is done independently for each sentence (each sentence has its own beam of
+    size beam_width and its own list of finished translations).
+
+    Args:
+        src_batch: input sentences in batch form, as generated by make_batch_src.
+        src_mask: mask value returned by make_batch_src
+        nb_steps: maximum length of the generated translations. Either an integer, or a list of integers
+                    with one value for each sentence in src_batch.
+        search_stats: if not None, a list with one dictionary for each sentence in src_batch,
+                    filled as in ensemble_beam_search
+        shortlist: if not None, the shortlist used for all the sentences in src_batch
+        other arguments: see ensemble_beam_search
+
+    Return:
+        a list with one item for each sentence in src_batch. Each item is a list of translations
+            as returned by ensemble_beam_search.
+    """
+    mb_size, max_src_length = src_batch[0].data.shape[0], len(src_batch)
+    assert len(model_ensemble) >= 1
+    xp = model_ensemble[0].xp
+    assert early_stopping_length_normalization is None or beam_score_length_normalization in (None, 'none')
+
+    if isinstance(nb_steps, int):
+        nb_steps = [nb_steps] * mb_size
+    assert len(nb_steps) == mb_size
+
+    src_lengths = compute_src_lengths_from_mask(mb_size, max_src_length, src_mask)
+
+    shortlist_array = None
+    if shortlist is not None:
+        shortlist, shortlist_array, eos_idx = prepare_shortlist(xp, shortlist, eos_idx)
+
+    if shortlist_stats is not None:
+        ensemble_pool = None
+
+    dec_cell_ensemble = map_ensemble(ensemble_pool,
+                                     lambda model: model.give_conditionalized_cell(src_batch, src_mask,
+                                                                                   noise_on_prev_word=False,
+                                                                                   mode="test", demux=True,
+                                                                                   shortlist=shortlist_array,
+                                                                                   shortlist_stats=shortlist_stats),
+                                     model_ensemble)
+
+    finished_translations_list = [[] for _ in xrange(mb_size)]
+
+    # Beam states for each sentence. The decoder states and previous words are shared by all the sentences
+    # and stored in current_states_ensemble and current_words.
+    current_translations_states_list = [(create_beam_history(xp, nb_steps[num_sent], beam_width, src_lengths[num_sent],
+                                                             need_attention, beam_score_coverage_penalty,
+                                                             need_coverage=need_coverage),
+                                         xp.array([0]), None, None) for num_sent in xrange(mb_size)]
+    current_states_ensemble = [None] * len(model_ensemble)
+    current_words = None
+    is_active = [True] * mb_size
+    nb_steps_done = [0] * mb_size
+
+    for num_step in xrange(max(nb_steps)):
+        demux_sizes = [len(current_translations_states_list[num_sent][1]) if is_active[num_sent] else 0
+                       for num_sent in xrange(mb_size)]
+
+        combined_scores, new_state_ensemble, attn_ensemble = compute_next_states_and_scores(
+            dec_cell_ensemble, current_states_ensemble, current_words,
+            prob_space_combination=prob_space_combination, demux_sizes=demux_sizes, fused_scoring=fused_scoring,
+            ensemble_pool=ensemble_pool)
+
+        all_next_parents = []
+        all_next_words = []
+        start = 0
+        for num_sent in xrange(mb_size):
+            size = demux_sizes[num_sent]
+            if size == 0:
+                continue
+            end = start + size
+            length = src_lengths[num_sent]
+            nb_steps_done[num_sent] += 1
+
+            sent_attn_ensemble = [Variable(attn.data[start:end, :length], volatile="auto") for attn in attn_ensemble]
+
+            history, current_scores, _, _ = current_translations_states_list[num_sent]
+
+            next_parents, next_words, next_scores = update_beam(
+                xp, eos_idx, history, current_scores,
+                combined_scores[start:end], sent_attn_ensemble,
+                beam_width, beam_pruning_margin,
+                beam_score_length_normalization, beam_score_length_normalization_strength,
+                beam_score_coverage_penalty, beam_score_coverage_penalty_strength,
+                finished_translations_list[num_sent],
+                force_finish=force_finish and num_step == (nb_steps[num_sent] - 1),
+                need_attention=need_attention,
+                shortlist=shortlist)
+            sent_start = start
+            start = end
+
+            if len(next_parents) == 0:
+                # We only found finished translations
+                current_translations_states_list[num_sent] = None
+                is_active[num_sent] = False
+                continue
+
+            current_translations_states_list[num_sent] = (history, xp.array(next_scores), None, None)
+            if num_step + 1 >= nb_steps[num_sent]:
+                is_active[num_sent] = False
+                continue
+
+            if early_stopping_length_normalization is not None and can_stop_search(
+                    history, next_scores, finished_translations_list[num_sent], nb_steps[num_sent] - 1,
+                    early_stopping_length_normalization, early_stopping_length_normalization_strength):
+                is_active[num_sent] = False
+                continue
+
+            all_next_parents.extend(sent_start + next_parents)
+            all_next_words.extend(next_words)
+
+        if len(all_next_parents) == 0:
+            break
+
+        next_words_array, current_states_ensemble = gather_next_states_and_words(
+            xp, new_state_ensemble, all_next_parents, all_next_words)
+        current_words = Variable(next_words_array, volatile="auto")
+
+    for num_sent in xrange(mb_size):
+        complete_finished_translations(finished_translations_list[num_sent], current_translations_states_list[num_sent],
+                                       need_attention=need_attention,
+                                       use_unfinished_translation_if_none_found=use_unfinished_translation_if_none_found)
+
+    if search_stats is not None:
+        for num_sent in xrange(mb_size):
+            search_stats[num_sent]["nb_steps"] = nb_steps[num_sent]
+            search_stats[num_sent]["nb_steps_done"] = nb_steps_done[num_sent]
+
+    return finished_translations_list
@@ -7,41 +7,55 @@ __email__ = "bergeron@pa.jst.jp"
 __status__ = "Development"
 
 import socket
+import threading
 import os.path
 import re
 from xml.sax.saxutils import escape
 
+from nmt_chainer.translation.framing import send_message, receive_message, FramingError
+
 
 class Client:
+    """
+        Client of the server. By default, each query opens a new connection (legacy one-shot protocol).
+        If keep_alive is True, the queries are sent as length-prefixed messages (see framing.py) on a single
+        connection, opened by the first query and kept until close is called.
+    """
 
-    def __init__(self, server_ip, server_port):
+    def __init__(self, server_ip, server_port, keep_alive=False):
         self.ip = server_ip
         self.port = server_port
+        self.keep_alive = keep_alive
+        self.socket = None
 
     def query(self, sentence, article_id=1, beam_width=30, nb_steps=50, nb_steps_ratio=1.5,
               prob_space_combination=False, normalize_unicode_unk=True, remove_unk=False, attempt_to_relocate_unk_source=False,
               sentence_id=1):
 
-        query = """<?xml version="1.0" encoding="utf-8"?>
-<article id="{0}"
-    beam_width="{1}"
-    nb_steps="{2}"
-    nb_steps_ratio="{3}"
-    prob_space_combination="{4}"
-    normalize_unicode_unk="{5}"
-    remove_unk="{6}"
-    attempt_to_relocate_unk_source="{7}">
-    <sentence id="{8}">
-        <i_sentence>{9}</i_sentence>
-    </sentence>
-</article>"""
+        return self.query_article([sentence], article_id=article_id, beam_width=beam_width, nb_steps=nb_steps,
+                                  nb_steps_ratio=nb_steps_ratio, prob_space_combination=prob_space_combination,
+                                  normalize_unicode_unk=normalize_unicode_unk, remove_unk=remove_unk,
+                                  attempt_to_relocate_unk_source=attempt_to_relocate_unk_source,
+                                  first_sentence_id=sentence_id)
 
-        query = query.format(article_id, beam_width, nb_steps, nb_steps_ratio, prob_space_combination,
-                             normalize_unicode_unk, remove_unk, attempt_to_relocate_unk_source, sentence_id, escape(sentence))
+    def query_article(self, sentences, article_id=1, beam_width=30, nb_steps=50, nb_steps_ratio=1.5,
+                      prob_space_combination=False, normalize_unicode_unk=True, remove_unk=False, attempt_to_relocate_unk_source=False,
+                      first_sentence_id=1):
+        """
+            Send all the sentences of an article in one request: the server translates them together. The sentences
+            get consecutive ids starting from first_sentence_id.
+        """
+        query = build_query(sentences, article_id=article_id, beam_width=beam_width, nb_steps=nb_steps,
+                            nb_steps_ratio=nb_steps_ratio, prob_space_combination=prob_space_combination,
+                            normalize_unicode_unk=normalize_unicode_unk, remove_unk=remove_unk,
+                            attempt_to_relocate_unk_source=attempt_to_relocate_unk_source,
+                            first_sentence_id=first_sentence_id)
+        if self.keep_alive:
+            return self.pipeline_queries([query])[0]
 
         s = socket.socket()
         s.connect((self.ip, self.port))
-        s.send(query)
+        s.sendall(query)
 
         try:
             resp = ''
@@ -53,3 +67,81 @@ class Client:
             return resp
         finally:
             s.close()
+
+    def query_articles(self, articles, **kwargs):
+        """
+            Return the responses to the articles (lists of sentences), kwargs being the parameters of query_article.
+            If keep_alive is True, all the requests are sent without waiting for the responses (pipelining).
+        """
+        if not self.keep_alive:
+            return [self.query_article(sentences, **kwargs) for sentences in articles]
+        return self.pipeline_queries([build_query(sentences, **kwargs) for sentences in articles])
+
+    def pipeline_queries(self, queries):
+        if self.socket is None:
+            self.socket = socket.create_connection((self.ip, self.port))
+        sock = self.socket
+        send_errors = []
+
+        # the queries are sent by another thread, so that the server is never blocked by responses not yet read
+        def send_queries():
+            try:
+                for query in queries:
+                    send_message(sock, query)
+            except BaseException as e:
+                send_errors.append(e)
+
+        sender = threading.Thread(target=send_queries)
+        sender.start()
+        try:
+            responses = []
+            for _ in queries:
+                response = receive_message(sock)
+                if response is None:
+                    raise FramingError("connection closed by the server")
+                responses.append(response)
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            sender.join()
+        if len(send_errors) > 0:
+            self.close()
+            raise send_errors[0]
+        return responses
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                # also interrupts a pending send of pipeline_queries
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.socket.close()
+            self.socket = None
+
+
+def build_query(sentences, article_id=1, beam_width=30, nb_steps=50, nb_steps_ratio=1.5,
+                prob_space_combination=False, normalize_unicode_unk=True, remove_unk=False, attempt_to_relocate_unk_source=False,
+                first_sentence_id=1):
+
+    query = """<?xml version="1.0" encoding="utf-8"?>
+<article id="{0}"
+    beam_width="{1}"
+    nb_steps="{2}"
+    nb_steps_ratio="{3}"
+    prob_space_combination="{4}"
+    normalize_unicode_unk="{5}"
+    remove_unk="{6}"
+    attempt_to_relocate_unk_source="{7}">
+{8}</article>"""
+
+    sentence_query = """    <sentence id="{0}">
+        <i_sentence>{1}</i_sentence>
+    </sentence>
+"""
+
+    sentences_query = "".join(sentence_query.format(first_sentence_id + num_sentence, escape(sentence))
+                              for num_sentence, sentence in enumerate(sentences))
+    return query.format(article_id, beam_width, nb_steps, nb_steps_ratio, prob_space_combination,
+                        normalize_unicode_unk, remove_unk, attempt_to_relocate_unk_source, sentences_query)
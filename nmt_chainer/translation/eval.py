@@ -6,11 +6,13 @@ __version__ = "1.0"
 __email__ = "fabien.cromieres@gmail.com"
 __status__ = "Development"
 
+import itertools
 import json
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from chainer import cuda, serializers
 import sys
-from nmt_chainer.dataprocessing.processors import build_dataset_one_side_pp
+from nmt_chainer.dataprocessing.processors import build_dataset_one_side_pp, iterate_dataset_one_side_pp
 import nmt_chainer.dataprocessing.make_data as make_data
 import nmt_chainer.training_module.train as train
 import nmt_chainer.training_module.train_config as train_config
@@ -29,6 +31,14 @@ from nmt_chainer.translation.evaluation import (greedy_batch_translate,
                                                 #                         convert_idx_to_string_with_attn
                                                 )
 
+from nmt_chainer.translation.shortlist import create_shortlist_generator
+from nmt_chainer.translation.resumable_output import find_resume_point, save_progress, truncate_file
+from nmt_chainer.translation.nbest_rescoring import iterate_moses_nbest_file, rescore_nbest_lists
+from nmt_chainer.models.numpy_inference import NumpyEncoderDecoder
+from nmt_chainer.utilities.model_export import create_encdec_from_exported_file
+from nmt_chainer.utilities.worker_processes import map_in_worker_processes
+from nmt_chainer.utilities.lru_cache import LRUCache
+
 # import visualisation
 from nmt_chainer.utilities import bleu_computer
 import logging
@@ -68,29 +78,44 @@ class AttentionVisualizer(object):
 
         self.plots_list.append(p1)
 
+    def make_components(self):
+        """
+            Return the (script, div) pair embedding the plots in a html page (see bokeh.embed.components).
+        """
+        from nmt_chainer.utilities import visualisation
+        p_all = visualisation.Column(*self.plots_list)
+        return bokeh.embed.components(p_all)
+
     def make_plot(self, output_file):
         from nmt_chainer.utilities import visualisation
         log.info("writing attention to {0}".format(output_file))
-        p_all = visualisation.Column(*self.plots_list)
         if isinstance(output_file, tuple):
             script_output_fn, div_output_fn = output_file
-            script, div = bokeh.embed.components(p_all)
+            script, div = self.make_components()
             with open(script_output_fn, 'w') as f:
                 f.write(script.encode('utf-8'))
             with open(div_output_fn, 'w') as f:
                 f.write(div)
         else:
             visualisation.output_file(output_file)
-            visualisation.show(p_all)
+            visualisation.show(visualisation.Column(*self.plots_list))
 
 
 class RichOutputWriter(object):
-    def __init__(self, filename):
+    def __init__(self, filename, nb_entries_already_written=0):
+        """
+            If nb_entries_already_written > 0, the entries are appended to filename, which must already contain
+            these entries (without the end of the list).
+        """
         log.info("writing JSON translation infos to %s" % filename)
         self.filename = filename
-        self.output = open(filename, "w")
-        self.no_entry_yet = True
-        self.output.write("[\n")
+        if nb_entries_already_written > 0:
+            self.output = open(filename, "a")
+            self.no_entry_yet = False
+        else:
+            self.output = open(filename, "w")
+            self.no_entry_yet = True
+            self.output.write("[\n")
 
     def add_info(self, src, translated, t, score, attn, unk_mapping=None):
         if not self.no_entry_yet:
@@ -107,6 +132,12 @@ class RichOutputWriter(object):
             self.output.write(json.dumps(unk_mapping))
         self.output.write("}")
 
+    def flush(self):
+        self.output.flush()
+
+    def tell(self):
+        return self.output.tell()
+
     def finish(self):
         self.output.write("\n]")
         self.output.close()
@@ -126,12 +157,29 @@ def beam_search_all(gpu, encdec, eos_idx, src_data, beam_width, beam_pruning_mar
                     remove_unk=False,
                     normalize_unicode_unk=False,
                     attempt_to_relocate_unk_source=False,
-                    nbest=None):
-
-    log.info("starting beam search translation of %i sentences" % len(src_data))
+                    nbest=None,
+                    beam_search_batch_size=1,
+                    nb_batch_to_sort=None,
+                    early_stopping=False,
+                    shortlist_generator=None,
+                    check_shortlist=False,
+                    fused_scoring=False,
+                    ensemble_pool=None,
+                    reverse_rescoring_window=20,
+                    reverse_rescoring_mb_size=80,
+                    reverse_rescoring_pool=None):
+
+    if hasattr(src_data, "__len__"):
+        log.info("starting beam search translation of %i sentences" % len(src_data))
+    else:
+        log.info("starting beam search translation")
     if isinstance(encdec, (list, tuple)) and len(encdec) > 1:
         log.info("using ensemble of %i models" % len(encdec))
 
+    # src_data may be a generator: the source sentences given back with the translations come from a copy of it
+    # (itertools.tee only buffers the sentences read by beam_search_translate but not yet translated)
+    src_data, src_data_copy = itertools.tee(src_data)
+
     with cuda.get_device(gpu):
         translations_gen = beam_search_translate(
             encdec, eos_idx, src_data, beam_width=beam_width, nb_steps=nb_steps,
@@ -150,9 +198,20 @@ def beam_search_all(gpu, encdec, eos_idx, src_data, beam_width, beam_pruning_mar
             prob_space_combination=prob_space_combination,
             reverse_encdec=reverse_encdec,
             use_unfinished_translation_if_none_found=use_unfinished_translation_if_none_found,
-            nbest=nbest)
-
-        for num_t, translations in enumerate(translations_gen):
+            nbest=nbest,
+            beam_search_batch_size=beam_search_batch_size,
+            nb_batch_to_sort=nb_batch_to_sort,
+            early_stopping=early_stopping,
+            shortlist_generator=shortlist_generator,
+            check_shortlist=check_shortlist,
+            fused_scoring=fused_scoring,
+            ensemble_pool=ensemble_pool,
+            reverse_rescoring_window=reverse_rescoring_window,
+            reverse_rescoring_mb_size=reverse_rescoring_mb_size,
+            reverse_rescoring_pool=reverse_rescoring_pool)
+
+        # translations_gen comes first in izip, so that it runs to its end (and logs its statistics)
+        for num_t, (translations, src_sentence) in enumerate(itertools.izip(translations_gen, src_data_copy)):
             res_trans = []
             for trans in translations:
                 (t, score, attn) = trans
@@ -192,7 +251,7 @@ def beam_search_all(gpu, encdec, eos_idx, src_data, beam_width, beam_pruning_mar
                         from nmt_chainer.utilities import replace_tgt_unk
                         translated = replace_tgt_unk.replace_unk_from_string(ct, src, dic, remove_unk, normalize_unicode_unk, attempt_to_relocate_unk_source).strip().split(" ")
 
-                res_trans.append((src_data[num_t], translated, t, score, attn, unk_mapping))
+                res_trans.append((src_sentence, translated, t, score, attn, unk_mapping))
 
             yield res_trans
 
@@ -214,25 +273,88 @@ def translate_to_file_with_beam_search(dest_fn, gpu, encdec, eos_idx, src_data,
                                        normalize_unicode_unk=False,
                                        attempt_to_relocate_unk_source=False,
                                        unprocessed_output_filename=None,
-                                       nbest=None):
+                                       nbest=None,
+                                       beam_search_batch_size=1,
+                                       nb_batch_to_sort=None,
+                                       early_stopping=False,
+                                       shortlist_generator=None,
+                                       check_shortlist=False,
+                                       fused_scoring=False,
+                                       ensemble_pool=None,
+                                       nb_workers=1,
+                                       nb_blas_threads=None,
+                                       progress_filename=None,
+                                       resume=False,
+                                       reverse_rescoring_window=20,
+                                       reverse_rescoring_mb_size=80,
+                                       reverse_rescoring_pool=None):
+    """
+        If nb_workers > 1, the sentences of src_data are translated by that many forked worker processes, each one
+        translating an interleaved shard of src_data (see map_in_worker_processes). The translations are put back in
+        order before being written, so that the outputs are the same as with a single process. If nb_blas_threads is
+        not None, it is the number of BLAS threads of each worker.
+
+        The outputs are flushed after each sentence. If progress_filename is not None, the number of sentences done
+        and the sizes of the output files are then saved to it (see resumable_output). If resume is True, the
+        sentences already translated by a previous (interrupted) call with the same arguments are skipped, and the
+        outputs are appended to the existing files.
+    """
+
+    nb_sentences_done = 0
+    if resume:
+        nb_sentences_done, offsets = find_resume_point(dest_fn, progress_filename=progress_filename,
+                                                       unprocessed_output_filename=unprocessed_output_filename,
+                                                       rich_output_filename=rich_output_filename, nbest=nbest)
+        if nb_sentences_done > 0:
+            for filename, offset in offsets.iteritems():
+                truncate_file(filename, offset)
+            if isinstance(src_data, list):
+                src_data = src_data[nb_sentences_done:]
+            else:
+                src_data = itertools.islice(src_data, nb_sentences_done, None)
+            if generate_attention_html is not None:
+                log.warn("the attention html will only contain the sentences translated after resuming")
+    output_mode = "a" if nb_sentences_done > 0 else "w"
 
     log.info("writing translation to %s " % dest_fn)
-    out = codecs.open(dest_fn, "w", encoding="utf8")
-
-    translation_iterator = beam_search_all(gpu, encdec, eos_idx, src_data, beam_width, beam_pruning_margin, beam_score_coverage_penalty, beam_score_coverage_penalty_strength, nb_steps,
-                                           nb_steps_ratio, beam_score_length_normalization, beam_score_length_normalization_strength, post_score_length_normalization, post_score_length_normalization_strength,
-                                           post_score_coverage_penalty, post_score_coverage_penalty_strength,
-                                           groundhog,
-                                           tgt_unk_id, tgt_indexer, force_finish=force_finish,
-                                           prob_space_combination=prob_space_combination, reverse_encdec=reverse_encdec,
-                                           use_unfinished_translation_if_none_found=use_unfinished_translation_if_none_found,
-                                           replace_unk=replace_unk,
-                                           src=src,
-                                           dic=dic,
-                                           remove_unk=remove_unk,
-                                           normalize_unicode_unk=normalize_unicode_unk,
-                                           attempt_to_relocate_unk_source=attempt_to_relocate_unk_source,
-                                           nbest=nbest)
+    out = codecs.open(dest_fn, output_mode, encoding="utf8")
+
+    def translate_src_data(src_data, ensemble_pool=ensemble_pool, reverse_rescoring_pool=reverse_rescoring_pool):
+        return beam_search_all(gpu, encdec, eos_idx, src_data, beam_width, beam_pruning_margin, beam_score_coverage_penalty, beam_score_coverage_penalty_strength, nb_steps,
+                               nb_steps_ratio, beam_score_length_normalization, beam_score_length_normalization_strength, post_score_length_normalization, post_score_length_normalization_strength,
+                               post_score_coverage_penalty, post_score_coverage_penalty_strength,
+                               groundhog,
+                               tgt_unk_id, tgt_indexer, force_finish=force_finish,
+                               prob_space_combination=prob_space_combination, reverse_encdec=reverse_encdec,
+                               use_unfinished_translation_if_none_found=use_unfinished_translation_if_none_found,
+                               replace_unk=replace_unk,
+                               src=src,
+                               dic=dic,
+                               remove_unk=remove_unk,
+                               normalize_unicode_unk=normalize_unicode_unk,
+                               attempt_to_relocate_unk_source=attempt_to_relocate_unk_source,
+                               nbest=nbest,
+                               beam_search_batch_size=beam_search_batch_size,
+                               nb_batch_to_sort=nb_batch_to_sort,
+                               early_stopping=early_stopping,
+                               shortlist_generator=shortlist_generator,
+                               check_shortlist=check_shortlist,
+                               fused_scoring=fused_scoring,
+                               ensemble_pool=ensemble_pool,
+                               reverse_rescoring_window=reverse_rescoring_window,
+                               reverse_rescoring_mb_size=reverse_rescoring_mb_size,
+                               reverse_rescoring_pool=reverse_rescoring_pool)
+
+    if nb_workers > 1:
+        if ensemble_pool is not None or reverse_rescoring_pool is not None:
+            log.info("the threads running the models of the ensemble or the reverse model are not available in the "
+                     "worker processes")
+        log.info("translating with %i worker processes" % nb_workers)
+        translation_iterator = map_in_worker_processes(lambda shard: translate_src_data(shard, ensemble_pool=None,
+                                                                                        reverse_rescoring_pool=None),
+                                                       src_data, nb_workers, nb_blas_threads=nb_blas_threads)
+    else:
+        translation_iterator = translate_src_data(src_data)
 
     attn_vis = None
     if generate_attention_html is not None:
@@ -241,13 +363,13 @@ def translate_to_file_with_beam_search(dest_fn, gpu, encdec, eos_idx, src_data,
 
     rich_output = None
     if rich_output_filename is not None:
-        rich_output = RichOutputWriter(rich_output_filename)
+        rich_output = RichOutputWriter(rich_output_filename, nb_entries_already_written=nb_sentences_done)
 
     unprocessed_output = None
     if unprocessed_output_filename is not None:
-        unprocessed_output = codecs.open(unprocessed_output_filename, "w", encoding="utf8")
+        unprocessed_output = codecs.open(unprocessed_output_filename, output_mode, encoding="utf8")
 
-    for idx, translations in enumerate(translation_iterator):
+    for idx, translations in enumerate(translation_iterator, nb_sentences_done):
         for src, translated, t, score, attn, unk_mapping in translations:
             if rich_output is not None:
                 rich_output.add_info(src, translated, t, score, attn, unk_mapping=unk_mapping)
@@ -265,6 +387,18 @@ def translate_to_file_with_beam_search(dest_fn, gpu, encdec, eos_idx, src_data,
                 out.write(ct + "\n")
             if unprocessed_output is not None:
                 unprocessed_output.write(" ".join(translated) + "\n")
+        # each translation is written as soon as it is available, so that the output can be followed
+        # (and is not lost) while a large file is translated
+        out.flush()
+        offsets = {dest_fn: out.tell()}
+        if unprocessed_output is not None:
+            unprocessed_output.flush()
+            offsets[unprocessed_output_filename] = unprocessed_output.tell()
+        if rich_output is not None:
+            rich_output.flush()
+            offsets[rich_output_filename] = rich_output.tell()
+        if progress_filename is not None:
+            save_progress(progress_filename, idx + 1, offsets)
 
     if rich_output is not None:
         rich_output.finish()
@@ -342,6 +476,18 @@ def create_encdec(config_eval):
 
             encdec_list.append(encdec)
 
+    if 'load_exported_model' in config_eval.process and config_eval.process.load_exported_model is not None:
+        for exported_model_fn in config_eval.process.load_exported_model:
+            encdec, this_eos_idx, this_src_indexer, this_tgt_indexer = create_encdec_from_exported_file(exported_model_fn)
+            model_infos_list.append(create_filename_infos(exported_model_fn))
+            if eos_idx is None:
+                assert len(encdec_list) == 0
+                eos_idx, src_indexer, tgt_indexer = this_eos_idx, this_src_indexer, this_tgt_indexer
+            else:
+                check_if_vocabulary_info_compatible(this_eos_idx, this_src_indexer, this_tgt_indexer, eos_idx, src_indexer, tgt_indexer)
+
+            encdec_list.append(encdec)
+
     assert len(encdec_list) > 0
 
     if 'additional_training_config' in config_eval.process and config_eval.process.additional_training_config is not None:
@@ -380,9 +526,75 @@ def create_encdec(config_eval):
     else:
         reverse_encdec = None
 
+    quantize = 'quantize_int8' in config_eval.process and config_eval.process.quantize_int8
+    if quantize or ('numpy_inference' in config_eval.process and config_eval.process.numpy_inference):
+        if config_eval.process.gpu is not None:
+            log.warn("numpy inference and int8 quantization are only for the cpu: ignoring them")
+        else:
+            log.info("using numpy inference%s" % (" with int8 quantized weights" if quantize else ""))
+            encdec_list = [NumpyEncoderDecoder(encdec, quantize=quantize) for encdec in encdec_list]
+            if reverse_encdec is not None:
+                reverse_encdec = NumpyEncoderDecoder(reverse_encdec, quantize=quantize)
+
     return encdec_list, eos_idx, src_indexer, tgt_indexer, reverse_encdec, model_infos_list
 
 
+def create_shortlist_generator_from_config(config_eval, encdec_list, eos_idx, src_indexer, tgt_indexer):
+    if 'shortlist' not in config_eval.method or not config_eval.method.shortlist:
+        return None
+    return create_shortlist_generator(encdec_list, eos_idx, src_indexer, tgt_indexer,
+                                      dictionary_filename=config_eval.method.shortlist_dictionary,
+                                      nb_frequent_words=config_eval.method.shortlist_nb_frequent_words,
+                                      nb_translations=config_eval.method.shortlist_nb_translations)
+
+
+def create_encoding_cache_from_config(config_eval, encdec_list, reverse_encdec=None):
+    """
+        Create the LRUCache shared by the models for their encoder outputs if --encoding_cache_size is not 0.
+    """
+    if 'encoding_cache_size' not in config_eval.process or not config_eval.process.encoding_cache_size:
+        return None
+    encoding_cache = LRUCache(int(config_eval.process.encoding_cache_size * 1024 * 1024))
+    for encdec in encdec_list:
+        encdec.encoding_cache = encoding_cache
+    if reverse_encdec is not None:
+        reverse_encdec.encoding_cache = encoding_cache
+    return encoding_cache
+
+
+def create_ensemble_pool_from_config(config_eval, encdec_list):
+    """
+        Create the ThreadPool running the models of the ensemble concurrently if --nb_ensemble_threads is larger
+        than 1 and there is more than one model (cpu only).
+    """
+    if 'nb_ensemble_threads' not in config_eval.process or config_eval.process.nb_ensemble_threads is None:
+        return None
+    nb_threads = min(config_eval.process.nb_ensemble_threads, len(encdec_list))
+    if nb_threads <= 1:
+        return None
+    if config_eval.process.gpu is not None:
+        log.warn("running the models of the ensemble concurrently is only for the cpu: ignoring --nb_ensemble_threads")
+        return None
+    log.info("running the %i models of the ensemble with %i threads" % (len(encdec_list), nb_threads))
+    return ThreadPool(nb_threads)
+
+
+def create_reverse_rescoring_pool_from_config(config_eval, reverse_encdec):
+    """
+        Create the ThreadPool rescoring the translations with the reverse model concurrently with the beam search
+        if --reverse_rescoring_in_thread is set and there is a reverse model (cpu only).
+    """
+    if reverse_encdec is None or not ('reverse_rescoring_in_thread' in config_eval.process and
+                                      config_eval.process.reverse_rescoring_in_thread):
+        return None
+    if config_eval.process.gpu is not None:
+        log.warn("rescoring with the reverse model in a separate thread is only for the cpu: "
+                 "ignoring --reverse_rescoring_in_thread")
+        return None
+    log.info("rescoring with the reverse model in a separate thread")
+    return ThreadPool(1)
+
+
 def do_eval(config_eval):
     src_fn = config_eval.process.src_fn
     tgt_fn = config_eval.output.tgt_fn
@@ -395,6 +607,12 @@ def do_eval(config_eval):
     max_nb_ex = config_eval.process.max_nb_ex
     nbest_to_rescore = config_eval.output.nbest_to_rescore
     nbest = config_eval.output.nbest
+    beam_search_batch_size = config_eval.process.beam_search_batch_size
+    nb_workers = config_eval.process.nb_workers
+    if nb_workers > 1 and gpu is not None:
+        log.warn("worker processes are only for the cpu: ignoring --nb_workers")
+        nb_workers = 1
+    early_stopping = config_eval.method.early_stopping
 
     beam_width = config_eval.method.beam_width
     beam_pruning_margin = config_eval.method.beam_pruning_margin
@@ -424,6 +642,12 @@ def do_eval(config_eval):
 
     encdec_list, eos_idx, src_indexer, tgt_indexer, reverse_encdec, model_infos_list = create_encdec(config_eval)
 
+    shortlist_generator = create_shortlist_generator_from_config(config_eval, encdec_list, eos_idx,
+                                                                 src_indexer, tgt_indexer)
+    encoding_cache = create_encoding_cache_from_config(config_eval, encdec_list, reverse_encdec)
+    ensemble_pool = create_ensemble_pool_from_config(config_eval, encdec_list)
+    reverse_rescoring_pool = create_reverse_rescoring_pool_from_config(config_eval, reverse_encdec)
+
     if config_eval.process.server is None:
         eval_dir_placeholder = "@eval@/"
         if dest_fn.startswith(eval_dir_placeholder):
@@ -452,9 +676,15 @@ def do_eval(config_eval):
                 ref = test_tgt_from_config
 
         log.info("opening source file %s" % src_fn)
-        src_data, stats_src_pp = build_dataset_one_side_pp(src_fn, src_pp=src_indexer,
-                                                           max_nb_ex=max_nb_ex)
-        log.info("src data stats:\n%s", stats_src_pp.make_report())
+        if config_eval.process.stream_src and mode in ("beam_search", "eval_bleu"):
+            # the sentences are read and indexed while being translated: the stats are only complete at the end
+            stats_src_pp = src_indexer.make_new_stat()
+            src_data = iterate_dataset_one_side_pp(src_fn, src_pp=src_indexer, max_nb_ex=max_nb_ex,
+                                                   stats=stats_src_pp)
+        else:
+            src_data, stats_src_pp = build_dataset_one_side_pp(src_fn, src_pp=src_indexer,
+                                                               max_nb_ex=max_nb_ex)
+            log.info("src data stats:\n%s", stats_src_pp.make_report())
 
     if dest_fn is not None:
         save_eval_config_fn = dest_fn + ".eval.init.config.json"
@@ -496,7 +726,8 @@ def do_eval(config_eval):
         with cuda.get_device(gpu):
             assert len(encdec_list) == 1
             translations = greedy_batch_translate(
-                encdec_list[0], eos_idx, src_data, batch_size=mb_size, gpu=gpu, nb_steps=nb_steps)
+                encdec_list[0], eos_idx, src_data, batch_size=mb_size, gpu=gpu, nb_steps=nb_steps,
+                nb_steps_ratio=nb_steps_ratio)
         out = codecs.open(dest_fn, "w", encoding="utf8")
         for t in translations:
             if t[-1] == eos_idx:
@@ -534,7 +765,24 @@ def do_eval(config_eval):
                                                rich_output_filename=rich_output_filename,
                                                use_unfinished_translation_if_none_found=True,
                                                unprocessed_output_filename=dest_fn + ".unprocessed",
-                                               nbest=nbest)
+                                               nbest=nbest,
+                                               beam_search_batch_size=beam_search_batch_size,
+                                               nb_batch_to_sort=config_eval.process.nb_batch_to_sort,
+                                               early_stopping=early_stopping,
+                                               shortlist_generator=shortlist_generator,
+                                               check_shortlist=config_eval.method.check_shortlist,
+                                               fused_scoring=config_eval.method.fused_scoring,
+                                               ensemble_pool=ensemble_pool,
+                                               nb_workers=nb_workers,
+                                               nb_blas_threads=config_eval.process.nb_blas_threads,
+                                               progress_filename=dest_fn + ".progress",
+                                               resume=config_eval.process.resume,
+                                               reverse_rescoring_window=config_eval.process.reverse_rescoring_window,
+                                               reverse_rescoring_mb_size=mb_size,
+                                               reverse_rescoring_pool=reverse_rescoring_pool)
+
+            if config_eval.process.stream_src:
+                log.info("src data stats:\n%s", stats_src_pp.make_report())
 
             translation_infos["dest"] = dest_fn
             translation_infos["unprocessed"] = dest_fn + ".unprocessed"
@@ -567,7 +815,7 @@ def do_eval(config_eval):
             assert len(encdec_list) == 1
             translations, attn_all = greedy_batch_translate(
                 encdec_list[0], eos_idx, src_data, batch_size=mb_size, gpu=gpu,
-                get_attention=True, nb_steps=nb_steps)
+                get_attention=True, nb_steps=nb_steps, nb_steps_ratio=nb_steps_ratio)
 #         tgt_voc_with_unk = tgt_voc + ["#T_UNK#"]
 #         src_voc_with_unk = src_voc + ["#S_UNK#"]
         assert len(translations) == len(src_data)
@@ -645,71 +893,32 @@ def do_eval(config_eval):
 #         out.write(convert_idx_to_string([x for x, attn in t], tgt_voc + ["#T_UNK#"]) + "\n")
 
     elif mode == "score_nbest":
+        assert len(encdec_list) == 1
         log.info("opening nbest file %s" % nbest_to_rescore)
-        nbest_f = codecs.open(nbest_to_rescore, encoding="utf8")
-        nbest_list = [[]]
-        for line in nbest_f:
-            line = line.strip().split("|||")
-            num_src = int(line[0].strip())
-            if num_src >= len(nbest_list):
-                assert num_src == len(nbest_list)
-                if max_nb_ex is not None and num_src >= max_nb_ex:
-                    break
-                nbest_list.append([])
-            else:
-                assert num_src == len(nbest_list) - 1
-            sentence = line[1].strip()
-            nbest_list[-1].append(sentence.split(" "))
-
-        log.info("found nbest lists for %i source sentences" % len(nbest_list))
-        nbest_converted, make_data_infos = make_data.build_dataset_for_nbest_list_scoring(tgt_indexer, nbest_list)
-        log.info("total %i sentences loaded" % make_data_infos.nb_ex)
-        log.info("#tokens src: %i   of which %i (%f%%) are unknown" % (make_data_infos.total_token,
-                                                                       make_data_infos.total_count_unk,
-                                                                       float(make_data_infos.total_count_unk * 100) /
-                                                                       make_data_infos.total_token))
-        if len(nbest_list) != len(src_data[:max_nb_ex]):
-            log.warn("mismatch in lengths nbest vs src : %i != %i" % (len(nbest_list), len(src_data[:max_nb_ex])))
-            assert len(nbest_list) == len(src_data[:max_nb_ex])
+        stats_tgt_nbest = tgt_indexer.make_new_stat()
+        nbest_lists = iterate_moses_nbest_file(nbest_to_rescore, max_nb_ex=max_nb_ex)
 
         log.info("starting scoring")
-        from nmt_chainer.utilities import utils
-        res = []
-        for num in xrange(len(nbest_converted)):
-            if num % 200 == 0:
-                print >>sys.stderr, num,
-            elif num % 50 == 0:
-                print >>sys.stderr, "*",
-
-            res.append([])
-            src, tgt_list = src_data[num], nbest_converted[num]
-            src_batch, src_mask = utils.make_batch_src([src], gpu=gpu, volatile="on")
-
-            assert len(encdec_list) == 1
-            scorer = encdec_list[0].nbest_scorer(src_batch, src_mask)
-
-            nb_batches = (len(tgt_list) + mb_size - 1) / mb_size
-            for num_batch in xrange(nb_batches):
-                tgt_batch, arg_sort = utils.make_batch_tgt(tgt_list[num_batch * nb_batches: (num_batch + 1) * nb_batches],
-                                                           eos_idx=eos_idx, gpu=gpu, volatile="on", need_arg_sort=True)
-                scores, attn = scorer(tgt_batch)
-                scores, _ = scores
-                scores = scores.data
-
-                assert len(arg_sort) == len(scores)
-                de_sorted_scores = [None] * len(scores)
-                for xpos in xrange(len(arg_sort)):
-                    original_pos = arg_sort[xpos]
-                    de_sorted_scores[original_pos] = scores[xpos]
-                res[-1] += de_sorted_scores
-        print >>sys.stderr
-        log.info("writing scores to %s" % dest_fn)
-        out = codecs.open(dest_fn, "w", encoding="utf8")
-        for num in xrange(len(res)):
-            for score in res[num]:
-                out.write("%i %f\n" % (num, score))
+        nb_src_with_nbest = 0
+        last_num_src = None
+        with codecs.open(dest_fn, "w", encoding="utf8") as out:
+            for num_src, score in rescore_nbest_lists(encdec_list[0], eos_idx, src_data, nbest_lists, tgt_indexer,
+                                                      mb_size=mb_size,
+                                                      nb_batch_to_sort=config_eval.process.nb_batch_to_sort,
+                                                      gpu=gpu, stats=stats_tgt_nbest):
+                if num_src != last_num_src:
+                    nb_src_with_nbest += 1
+                    last_num_src = num_src
+                out.write("%i %f\n" % (num_src, score))
+        log.info("wrote scores to %s" % dest_fn)
+        log.info("nbest data stats:\n%s", stats_tgt_nbest.make_report())
+        if nb_src_with_nbest != len(src_data):
+            log.warn("mismatch in lengths nbest vs src : %i != %i" % (nb_src_with_nbest, len(src_data)))
 
     time_end = time.clock()
+    if encoding_cache is not None:
+        log.info("encoding cache: %s" % encoding_cache.make_report())
+        translation_infos["encoding_cache"] = encoding_cache.make_report()
     translation_infos["loading_time"] = time_all_loaded - time_start
     translation_infos["translation_time"] = time_end - time_all_loaded
     translation_infos["total_time"] = time_end - time_start
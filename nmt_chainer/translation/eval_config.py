@@ -37,6 +37,23 @@ def define_parser(parser):
     translation_method_group.add_argument("--post_score_coverage_penalty", choices=['none', 'google'], default='none')
     translation_method_group.add_argument("--post_score_coverage_penalty_strength", type=float, default=0.2)
     translation_method_group.add_argument("--prob_space_combination", default=False, action="store_true")
+    translation_method_group.add_argument("--fused_scoring", default=False, action="store_true",
+                                          help="compute the beam search scores with an in-place log-softmax instead of chainer functions")
+    translation_method_group.add_argument("--early_stopping", default=False, action="store_true",
+                                          help="stop the beam search of a sentence when no unfinished translation can get "
+                                          "a better post-score than the best finished one (requires "
+                                          "beam_score_length_normalization and post_score_coverage_penalty to be 'none', and no --nbest)")
+    translation_method_group.add_argument("--shortlist", default=False, action="store_true",
+                                          help="only consider a shortlist of target words for each sentence in beam search")
+    translation_method_group.add_argument("--shortlist_dictionary",
+                                          help="lexical probability dictionary used for the shortlist (by default, the one "
+                                          "of the model)")
+    translation_method_group.add_argument("--shortlist_nb_frequent_words", type=int, default=1000,
+                                          help="number of most frequent target words always in the shortlist")
+    translation_method_group.add_argument("--shortlist_nb_translations", type=int, default=20,
+                                          help="number of translations of each source word added to the shortlist")
+    translation_method_group.add_argument("--check_shortlist", default=False, action="store_true",
+                                          help="report how often the best word over the whole vocabulary is not in the shortlist")
 
     output_group = parser.add_argument_group(_CONFIG_SECTION_TO_DESCRIPTION["output"])
     output_group.add_argument("--tgt_fn", help="target text")
@@ -56,8 +73,33 @@ def define_parser(parser):
     management_group.add_argument("--gpu", type=int, help="specify gpu number to use, if any")
     management_group.add_argument("--max_nb_ex", type=int, help="only use the first MAX_NB_EX examples")
     management_group.add_argument("--mb_size", type=int, default=80, help="Minibatch size")
-    management_group.add_argument("--nb_batch_to_sort", type=int, default=20, help="Sort this many batches by size.")
+    management_group.add_argument("--nb_batch_to_sort", type=int, default=20,
+                                  help="Sort this many batches by size (in beam_search mode, only used if beam_search_batch_size > 1).")
+    management_group.add_argument("--beam_search_batch_size", type=int, default=1,
+                                  help="number of sentences translated together by the beam search")
+    management_group.add_argument("--stream_src", default=False, action="store_true",
+                                  help="in beam_search mode, read the source file while translating it instead of "
+                                  "loading it in memory first")
+    management_group.add_argument("--numpy_inference", default=False, action="store_true",
+                                  help="run the models with the numpy inference engine instead of chainer (cpu only)")
+    management_group.add_argument("--resume", default=False, action="store_true",
+                                  help="resume an interrupted translation to dest_fn (beam_search and eval_bleu modes): "
+                                  "the sentences already written to dest_fn (and to the rich output) are not translated again")
+    management_group.add_argument("--nb_workers", type=int, default=1,
+                                  help="in beam_search mode, number of forked worker processes translating interleaved "
+                                  "shards of the source (cpu only)")
+    management_group.add_argument("--nb_blas_threads", type=int,
+                                  help="number of BLAS threads of each worker process (see --nb_workers)")
+    management_group.add_argument("--nb_ensemble_threads", type=int, default=1,
+                                  help="number of threads running the models of an ensemble concurrently (cpu only)")
+    management_group.add_argument("--quantize_int8", default=False, action="store_true",
+                                  help="quantize the weight matrices and embeddings of the models to int8 when loading them "
+                                  "(uses the numpy inference engine, cpu only)")
+    management_group.add_argument("--encoding_cache_size", type=float, default=0,
+                                  help="maximum size in MB of the cache of encoded source sentences (0: no cache)")
     management_group.add_argument("--load_model_config", nargs="+", help="gives a list of models to be used for translation")
+    management_group.add_argument("--load_exported_model", nargs="+",
+                                  help="gives a list of model files created by 'knmt utils export' to be used for translation")
     management_group.add_argument("--src_fn", nargs="?", help="source text",
                                   action=argument_parsing_tools.ArgumentActionNotOverwriteWithNone)
     management_group.add_argument("--dest_fn", nargs="?", help="destination file",
@@ -66,10 +108,32 @@ def define_parser(parser):
     management_group.add_argument("--additional_trained_model", nargs="*", help="prefix of the trained model")
     management_group.add_argument("--reverse_training_config", help="prefix of the trained model")
     management_group.add_argument("--reverse_trained_model", help="prefix of the trained model")
+    management_group.add_argument("--reverse_rescoring_window", type=int, default=20,
+                                  help="number of sentences whose translations are rescored together by the reverse model "
+                                  "(in minibatches of mb_size translations)")
+    management_group.add_argument("--reverse_rescoring_in_thread", default=False, action="store_true",
+                                  help="rescore with the reverse model in a separate thread, while the beam search "
+                                  "translates the next sentences (cpu only)")
 #     management_group.add_argument("--config", help = "load eval config file")
     management_group.add_argument("--server", help="host:port for listening request")
     management_group.add_argument("--segmenter_command", help="command to communicate with the segmenter server")
     management_group.add_argument("--segmenter_format", help="format to expect from the segmenter (parse_server, morph)", default='plain')
+    management_group.add_argument("--segmenter_pool_command",
+                                  help="command of long-lived segmenter processes reading one sentence per line on their standard "
+                                  "input, and writing its segmentation without buffering (used instead of --segmenter_command)")
+    management_group.add_argument("--segmenter_pool_size", type=int, default=1,
+                                  help="number of segmenter processes started with --segmenter_pool_command")
+    management_group.add_argument("--segmenter_timeout", type=float, default=10,
+                                  help="time in seconds after which a segmenter process started with --segmenter_pool_command "
+                                  "is restarted if it did not answer")
+    management_group.add_argument("--server_max_batch_size", type=int, default=1,
+                                  help="translate the sentences of concurrent server requests together, in batches of at most "
+                                  "this many sentences (1: each request is translated by its own thread)")
+    management_group.add_argument("--server_batching_window", type=float, default=10,
+                                  help="time in milliseconds during which the server waits for more requests to add to a batch "
+                                  "(longer windows give larger batches and a better throughput, but a higher latency)")
+    management_group.add_argument("--server_max_batch_tokens", type=int,
+                                  help="maximum number of source words of a batch of server requests")
     management_group.add_argument("--description", help="Optional message to be stored in the configuration file")
 
 
@@ -139,9 +203,9 @@ def do_eval(args):
             raise CommandLineValuesException(
                 "If specifying a model via the training_config argument, you also need to specify the trained_model argument")
     else:
-        if config_eval.process.load_model_config is None:
+        if config_eval.process.load_model_config is None and config_eval.process.load_exported_model is None:
             raise CommandLineValuesException(
-                "You need to specify either the training_config positional argument, or the load_model_config option, or both")
+                "You need to specify either the training_config positional argument, or the load_model_config or load_exported_model option, or both")
 
     nmt_chainer.translation.eval.do_eval(config_eval)
 
@@ -14,6 +14,7 @@ import math
 import codecs
 import operator
 import beam_search
+from nmt_chainer.translation.nbest_rescoring import score_pairs_sorted_by_length
 # import h5py
 
 logging.basicConfig()
@@ -73,7 +74,13 @@ def compute_loss_all(encdec, test_data, eos_idx, mb_size, gpu=None, reverse_src=
 
 
 def greedy_batch_translate(encdec, eos_idx, src_data, batch_size=80, gpu=None, get_attention=False, nb_steps=50,
-                           reverse_src=False, reverse_tgt=False):
+                           reverse_src=False, reverse_tgt=False, nb_steps_ratio=None):
+    """
+        The sentences of a minibatch that have generated EOS are removed from it, and the translation of the
+        minibatch stops when all of them are finished.
+        If nb_steps_ratio is not None, the maximum length of the translation of each sentence is
+        int(len(src) * nb_steps_ratio) + 1 (as in beam_search_translate) instead of nb_steps.
+    """
     nb_ex = len(src_data)
     nb_batch = nb_ex / batch_size + (1 if nb_ex % batch_size != 0 else 0)
     res = []
@@ -87,9 +94,17 @@ def greedy_batch_translate(encdec, eos_idx, src_data, batch_size=80, gpu=None, g
                 current_batch_raw_data_new.append(src_side[::-1])
             current_batch_raw_data = current_batch_raw_data_new
 
+        if nb_steps_ratio is not None:
+            nb_steps_per_sentence = [int(len(src) * nb_steps_ratio) + 1 for src in current_batch_raw_data]
+            max_nb_steps = max(nb_steps_per_sentence)
+        else:
+            nb_steps_per_sentence = None
+            max_nb_steps = nb_steps
+
         src_batch, src_mask = make_batch_src(current_batch_raw_data, gpu=gpu, volatile="on")
-        sample_greedy, score, attn_list = encdec(src_batch, nb_steps, src_mask, use_best_for_sample=True,
-                                                 keep_attn_values=get_attention, mode="test")
+        sample_greedy, score, attn_list = encdec(src_batch, max_nb_steps, src_mask, use_best_for_sample=True,
+                                                 keep_attn_values=get_attention, mode="test",
+                                                 eos_idx=eos_idx, nb_steps_per_sentence=nb_steps_per_sentence)
         deb = de_batch(sample_greedy, mask=None, eos_idx=eos_idx, is_variable=False)
         res += deb
         if get_attention:
@@ -139,6 +154,68 @@ def reverse_rescore(encdec, src_batch, src_mask, eos_idx, translations, gpu=None
     return de_sorted_scores
 
 
+def remove_empty_translations(translations):
+    # TODO: This is a quick patch, but actually ensemble_beam_search probably should not return empty translations except when no translation found
+    if len(translations) > 1:
+        translations = [t for t in translations if len(t[0]) > 0]
+    return translations
+
+
+def batch_reverse_rescore(encdec, eos_idx, src_list, translations_list, mb_size=80, gpu=None):
+    """
+        Batched version of reverse_rescore for several source sentences: translations_list[i] is the list of
+        translations found by the beam search for src_list[i].
+        The translations of all the sentences are scored together, in minibatches of mb_size (source, translation)
+        pairs sorted by length (see nbest_rescoring.score_pairs_sorted_by_length).
+        Return the list of the reverse scores of the translations of each sentence, or None for the sentences
+        with less than 2 translations (which do not need to be rescored).
+    """
+    pairs = []
+    for num_src, translations in enumerate(translations_list):
+        if len(translations) <= 1:
+            continue
+        for t in translations:
+            t = t[0]
+            if t[-1] == eos_idx:
+                t = t[:-1]
+            pairs.append((num_src, t[::-1]))
+
+    scores = score_pairs_sorted_by_length(encdec, eos_idx, src_list, pairs, mb_size=mb_size, gpu=gpu)
+
+    reverse_scores_list = [None] * len(translations_list)
+    for (num_src, _), score in zip(pairs, scores):
+        if reverse_scores_list[num_src] is None:
+            reverse_scores_list[num_src] = []
+        reverse_scores_list[num_src].append(score)
+    return reverse_scores_list
+
+
+def iterate_groups(src_data, group_size):
+    """
+        Yield lists of at most group_size consecutive (num_ex, src) pairs from the iterable src_data.
+    """
+    group = []
+    for num_ex, src in enumerate(src_data):
+        group.append((num_ex, src))
+        if len(group) == group_size:
+            yield group
+            group = []
+    if len(group) > 0:
+        yield group
+
+
+def iterate_length_sorted_groups(src_data, group_size, nb_groups_to_sort):
+    """
+        Same as iterate_groups, except that the sentences are read by windows of group_size * nb_groups_to_sort
+        sentences, and each window is sorted by length before being split into groups. Only one window of src_data
+        is held in memory at a time.
+    """
+    for window in iterate_groups(src_data, group_size * nb_groups_to_sort):
+        window.sort(key=lambda num_ex_and_src: len(num_ex_and_src[1]))
+        for num_group_start in xrange(0, len(window), group_size):
+            yield window[num_group_start: num_group_start + group_size]
+
+
 def beam_search_translate(encdec, eos_idx, src_data, beam_width=20, beam_pruning_margin=None, nb_steps=50, gpu=None,
                           beam_score_coverage_penalty=None, beam_score_coverage_penalty_strength=0.2,
                           need_attention=False, nb_steps_ratio=None, beam_score_length_normalization='none', beam_score_length_normalization_strength=0.2, post_score_length_normalization='simple', post_score_length_normalization_strength=0.2,
@@ -146,105 +223,294 @@ def beam_search_translate(encdec, eos_idx, src_data, beam_width=20, beam_pruning
                           groundhog=False, force_finish=False,
                           prob_space_combination=False,
                           reverse_encdec=None, use_unfinished_translation_if_none_found=False,
-                          nbest=None):
-    nb_ex = len(src_data)
-    for num_ex in range(nb_ex):
-        src_batch, src_mask = make_batch_src([src_data[num_ex]], gpu=gpu, volatile="on")
-        assert len(src_mask) == 0
+                          nbest=None, beam_search_batch_size=1, nb_batch_to_sort=None, early_stopping=False,
+                          shortlist_generator=None, check_shortlist=False, fused_scoring=False, ensemble_pool=None,
+                          reverse_rescoring_window=20, reverse_rescoring_mb_size=80, reverse_rescoring_pool=None):
+    """
+        Generator yielding the translations of each sentence in src_data.
+
+        If beam_search_batch_size > 1, that many consecutive sentences are translated together by
+        beam_search.ensemble_beam_search_batch. The translations are still yielded one sentence at a time.
+
+        src_data can be any iterable of sentences (eg. a generator reading a file): it is consumed lazily.
+        If nb_batch_to_sort is not None and beam_search_batch_size > 1, the sentences are read by windows of
+        beam_search_batch_size * nb_batch_to_sort sentences, which are sorted by length before being split into
+        groups, so that each group contains sentences of similar length. The translations are put back in the
+        original order in a reorder buffer, and each one is yielded as soon as it and all the translations before
+        it are done. Without reverse_encdec, the reorder buffer never holds more than one window of translations.
+        With reverse_encdec, the translations also wait for their rescoring (see below): the translations kept in
+        memory can then be up to one sorting window plus the rescoring window being filled plus, with a
+        reverse_rescoring_pool, the rescoring window in progress.
+
+        If early_stopping is True, the search of a sentence stops as soon as no translation in the beam can
+        get a better post-score than the best finished translation. The number of steps saved for each sentence
+        is logged at debug level, and their total at the end. Early stopping is only admissible when the beam
+        scores are not length-normalized, when there is no coverage penalty and no reverse model rescoring in the
+        post-score, and when only the best translation is needed (the other translations of an nbest list could
+        still improve): it is ignored otherwise.
+
+        If shortlist_generator is not None (see shortlist.ShortlistGenerator), the words considered for the
+        translation of each group of sentences are restricted to the shortlist it returns for these sentences.
+        If check_shortlist is also True, the proportion of predictions whose best word over the whole target
+        vocabulary is not in the shortlist is logged.
+
+        If ensemble_pool is not None, the models of the ensemble are run concurrently by this pool
+        (see beam_search.map_ensemble).
+
+        If reverse_encdec is not None, the translations of reverse_rescoring_window consecutive sentences are
+        rescored together by batch_reverse_rescore, in minibatches of reverse_rescoring_mb_size translations.
+        If reverse_rescoring_pool is also not None (a ThreadPool), this rescoring runs in the pool while the
+        beam search goes on with the next sentences.
+    """
+    if not isinstance(encdec, (tuple, list)):
+        encdec = [encdec]
+
+    if early_stopping and (beam_score_length_normalization not in (None, 'none') or
+                           post_score_coverage_penalty not in (None, 'none') or reverse_encdec is not None or
+                           (nbest is not None and nbest > 1)):
+        log.warn("early stopping needs beam_score_length_normalization and post_score_coverage_penalty to be 'none', "
+                 "no reverse model and no nbest: ignoring it")
+        early_stopping = False
+
+    if early_stopping:
+        early_stopping_length_normalization = post_score_length_normalization
+        total_nb_steps = 0
+        total_nb_steps_saved = 0
+        nb_stopped_early = 0
+    else:
+        early_stopping_length_normalization = None
+
+    shortlist_stats = {} if shortlist_generator is not None and check_shortlist else None
+    total_shortlist_size = 0
+
+    def compute_nb_steps(src):
         if nb_steps_ratio is not None:
-            nb_steps = int(len(src_data[num_ex]) * nb_steps_ratio) + 1
+            return int(len(src) * nb_steps_ratio) + 1
+        else:
+            return nb_steps
 
-#         if isinstance(encdec, (tuple, list)):
-#             assert len(encdec) == 1
-#             encdec = encdec[0]
-#
-#         translations = encdec.beam_search(src_batch, src_mask, nb_steps = nb_steps, eos_idx = eos_idx,
-#                                           beam_width = beam_width,
-#                                           beam_opt = beam_opt, need_attention = need_attention,
-#                                     groundhog = groundhog)
-
-        if not isinstance(encdec, (tuple, list)):
-            encdec = [encdec]
-        translations = beam_search.ensemble_beam_search(encdec, src_batch, src_mask, nb_steps=nb_steps, eos_idx=eos_idx,
-                                                        beam_width=beam_width,
-                                                        beam_pruning_margin=beam_pruning_margin,
-                                                        beam_score_length_normalization=beam_score_length_normalization,
-                                                        beam_score_length_normalization_strength=beam_score_length_normalization_strength,
-                                                        beam_score_coverage_penalty=beam_score_coverage_penalty,
-                                                        beam_score_coverage_penalty_strength=beam_score_coverage_penalty_strength,
-                                                        need_attention=need_attention, force_finish=force_finish,
-                                                        prob_space_combination=prob_space_combination,
-                                                        use_unfinished_translation_if_none_found=use_unfinished_translation_if_none_found)
-
-        # TODO: This is a quick patch, but actually ensemble_beam_search probably should not return empty translations except when no translation found
-        if len(translations) > 1:
-            translations = [t for t in translations if len(t[0]) > 0]
-
-#         print "nb_trans", len(translations), [score for _, score in translations]
-#         translations.sort(key = itemgetter(1), reverse = True)
-
-        if reverse_encdec is not None and len(translations) > 1:
-            rescored_translations = []
-            reverse_scores = reverse_rescore(
-                reverse_encdec, src_batch, src_mask, eos_idx, [
-                    t[0] for t in translations], gpu)
-            for num_t in xrange(len(translations)):
-                tr, sc, attn = translations[num_t]
-                rescored_translations.append(
-                    (tr, sc + reverse_scores[num_t], attn))
-            translations = rescored_translations
-
-        xp = encdec[0].xp
-
-        if post_score_length_normalization == 'none' and post_score_coverage_penalty == 'none':
-            ranking_criterion = operator.itemgetter(1)
+    # the google post-score coverage penalty uses the coverage vectors accumulated during the search
+    need_coverage = post_score_coverage_penalty == 'google'
+
+    if nb_batch_to_sort is not None and beam_search_batch_size > 1:
+        groups = iterate_length_sorted_groups(src_data, beam_search_batch_size, nb_batch_to_sort)
+    else:
+        groups = iterate_groups(src_data, beam_search_batch_size)
+
+    def rank(num_ex, src, translations, reverse_scores=None):
+        reorder_buffer[num_ex] = rank_beam_search_translations(
+            encdec, eos_idx, src, translations, gpu=gpu,
+            post_score_length_normalization=post_score_length_normalization,
+            post_score_length_normalization_strength=post_score_length_normalization_strength,
+            post_score_coverage_penalty=post_score_coverage_penalty,
+            post_score_coverage_penalty_strength=post_score_coverage_penalty_strength,
+            reverse_scores=reverse_scores, nbest=nbest)
+
+    # sentences waiting for the reverse model, and the rescoring running in reverse_rescoring_pool
+    reverse_rescoring_pending = []
+    reverse_rescoring_in_progress = []
+
+    def finish_reverse_rescoring():
+        while len(reverse_rescoring_in_progress) > 0:
+            window, async_result = reverse_rescoring_in_progress.pop()
+            for (num_ex, src, translations), reverse_scores in zip(window, async_result.get()):
+                rank(num_ex, src, translations, reverse_scores)
+
+    def start_reverse_rescoring():
+        window = list(reverse_rescoring_pending)
+        del reverse_rescoring_pending[:]
+        args = (reverse_encdec, eos_idx, [src for _, src, _ in window],
+                [translations for _, _, translations in window])
+        kwargs = dict(mb_size=reverse_rescoring_mb_size, gpu=gpu)
+        if reverse_rescoring_pool is not None:
+            # only one window is rescored at a time
+            finish_reverse_rescoring()
+            reverse_rescoring_in_progress.append((window, reverse_rescoring_pool.apply_async(
+                batch_reverse_rescore, args, kwargs)))
         else:
-            def ranking_criterion(x):
-                length_normalization = 1
-                if post_score_length_normalization == 'simple':
-                    length_normalization = len(x[0]) + 1
-                elif post_score_length_normalization == 'google':
-                    length_normalization = pow((len(x[0]) + 5), post_score_length_normalization_strength) / pow(6, post_score_length_normalization_strength)
-
-                coverage_penalty = 0
-                if post_score_coverage_penalty == 'google':
-                    assert len(src_data[num_ex]) == x[2][0].shape[0]
-
-                    # log.info("sum={0}".format(sum(x[2])))
-                    # log.info("min={0}".format(xp.minimum(sum(x[2]), xp.array(1.0))))
-                    # log.info("log={0}".format(xp.log(xp.minimum(sum(x[2]), xp.array(1.0)))))
-                    log_of_min_of_sum_over_j = xp.log(xp.minimum(sum(x[2]), xp.array(1.0)))
-                    coverage_penalty = post_score_coverage_penalty_strength * xp.sum(log_of_min_of_sum_over_j)
-                    # log.info("cp={0}".format(coverage_penalty))
-                    # cp = 0
-                    # for i in xrange(len(src_data[num_ex])):
-                    #    attn_sum = 0
-                    #    for j in xrange(len(x[0])):
-                    #        attn_sum += x[2][j][i]
-                    #    #log.info("attn_sum={0}".format(attn_sum))
-                    #    #log.info("min={0}".format(min(attn_sum, 1.0)))
-                    #    #log.info("log={0}".format(math.log(min(attn_sum, 1.0))))
-                    #    cp += math.log(min(attn_sum, 1.0))
-                    # log.info("cp={0}".format(cp))
-                    # cp *= post_score_coverage_penalty_strength
-
-                    # slow = x[1]/length_normalization + cp
-                    # opti = x[1]/length_normalization + coverage_penalty
-                    # log.info("type={0}....{1}".format(type(slow), type(opti)))
-                    # log.info("shape={0} size={1} dim={2} data={3} elem={4}".format(opti.shape, opti.size, opti.ndim, opti.data, opti.item(0)))
-                    # test = '!!!'
-                    # if "{0}".format(slow) == "{0}".format(opti):
-                    #    test = ''
-                    # log.info("score slow <=> optimized: {0} <=> {1} {2}".format(slow, opti, test))
-
-                return x[1] / length_normalization + coverage_penalty
-
-        translations.sort(key=ranking_criterion, reverse=True)
-
-        if nbest is not None:
-            yield translations[:nbest]
+            for (num_ex, src, translations), reverse_scores in zip(window, batch_reverse_rescore(*args, **kwargs)):
+                rank(num_ex, src, translations, reverse_scores)
+
+    nb_ex = 0
+    next_num_ex_to_yield = 0
+    reorder_buffer = {}
+    for group in groups:
+        num_ex_list = [num_ex for num_ex, _ in group]
+        src_list = [src for _, src in group]
+        nb_ex += len(group)
+        search_stats = [{} for _ in num_ex_list] if early_stopping else None
+        if shortlist_generator is not None:
+            shortlist = shortlist_generator(src_list)
+            total_shortlist_size += len(shortlist) * len(num_ex_list)
         else:
-            yield [translations[0]]
+            shortlist = None
+        if len(num_ex_list) == 1:
+            src_batch, src_mask = make_batch_src(src_list, gpu=gpu, volatile="on")
+            assert len(src_mask) == 0
+            translations_list = [beam_search.ensemble_beam_search(
+                encdec, src_batch, src_mask, nb_steps=compute_nb_steps(src_list[0]), eos_idx=eos_idx,
+                beam_width=beam_width,
+                beam_pruning_margin=beam_pruning_margin,
+                beam_score_length_normalization=beam_score_length_normalization,
+                beam_score_length_normalization_strength=beam_score_length_normalization_strength,
+                beam_score_coverage_penalty=beam_score_coverage_penalty,
+                beam_score_coverage_penalty_strength=beam_score_coverage_penalty_strength,
+                need_attention=need_attention, force_finish=force_finish,
+                prob_space_combination=prob_space_combination,
+                use_unfinished_translation_if_none_found=use_unfinished_translation_if_none_found,
+                need_coverage=need_coverage,
+                early_stopping_length_normalization=early_stopping_length_normalization,
+                early_stopping_length_normalization_strength=post_score_length_normalization_strength,
+                search_stats=search_stats[0] if early_stopping else None,
+                shortlist=shortlist, shortlist_stats=shortlist_stats,
+                fused_scoring=fused_scoring, ensemble_pool=ensemble_pool)]
+        else:
+            src_batch, src_mask = make_batch_src(src_list, gpu=gpu, volatile="on")
+            translations_list = beam_search.ensemble_beam_search_batch(
+                encdec, src_batch, src_mask,
+                nb_steps=[compute_nb_steps(src) for src in src_list], eos_idx=eos_idx,
+                beam_width=beam_width,
+                beam_pruning_margin=beam_pruning_margin,
+                beam_score_length_normalization=beam_score_length_normalization,
+                beam_score_length_normalization_strength=beam_score_length_normalization_strength,
+                beam_score_coverage_penalty=beam_score_coverage_penalty,
+                beam_score_coverage_penalty_strength=beam_score_coverage_penalty_strength,
+                need_attention=need_attention, force_finish=force_finish,
+                prob_space_combination=prob_space_combination,
+                use_unfinished_translation_if_none_found=use_unfinished_translation_if_none_found,
+                need_coverage=need_coverage,
+                early_stopping_length_normalization=early_stopping_length_normalization,
+                early_stopping_length_normalization_strength=post_score_length_normalization_strength,
+                search_stats=search_stats,
+                shortlist=shortlist, shortlist_stats=shortlist_stats,
+                fused_scoring=fused_scoring, ensemble_pool=ensemble_pool)
+
+        if early_stopping:
+            for num_ex, stats in zip(num_ex_list, search_stats):
+                nb_steps_saved = stats["nb_steps"] - stats["nb_steps_done"]
+                log.debug("sentence %i: %i/%i steps, %i steps saved by early stopping" % (
+                    num_ex, stats["nb_steps_done"], stats["nb_steps"], nb_steps_saved))
+                total_nb_steps += stats["nb_steps"]
+                total_nb_steps_saved += nb_steps_saved
+                if nb_steps_saved > 0:
+                    nb_stopped_early += 1
+
+        for num_ex, src, translations in zip(num_ex_list, src_list, translations_list):
+            if reverse_encdec is not None:
+                reverse_rescoring_pending.append((num_ex, src, remove_empty_translations(translations)))
+            else:
+                rank(num_ex, src, translations)
+        if len(reverse_rescoring_pending) >= reverse_rescoring_window:
+            start_reverse_rescoring()
+
+        while next_num_ex_to_yield in reorder_buffer:
+            yield reorder_buffer.pop(next_num_ex_to_yield)
+            next_num_ex_to_yield += 1
+
+    if len(reverse_rescoring_pending) > 0:
+        start_reverse_rescoring()
+    finish_reverse_rescoring()
+    while next_num_ex_to_yield in reorder_buffer:
+        yield reorder_buffer.pop(next_num_ex_to_yield)
+        next_num_ex_to_yield += 1
+
+    assert len(reorder_buffer) == 0
+
+    if early_stopping and nb_ex > 0:
+        log.info("early stopping: %i/%i sentences stopped early, %i/%i steps saved (%f per sentence)" % (
+            nb_stopped_early, nb_ex, total_nb_steps_saved, total_nb_steps, float(total_nb_steps_saved) / nb_ex))
+
+    if shortlist_generator is not None and nb_ex > 0:
+        log.info("shortlist: %f words per sentence on average" % (float(total_shortlist_size) / nb_ex))
+        if shortlist_stats is not None and shortlist_stats.get("nb_predictions", 0) > 0:
+            log.info("shortlist: best word outside of the shortlist for %i/%i predictions (%f%%)" % (
+                shortlist_stats["nb_misses"], shortlist_stats["nb_predictions"],
+                shortlist_stats["nb_misses"] * 100.0 / shortlist_stats["nb_predictions"]))
+
+
+def rank_beam_search_translations(encdec, eos_idx, src, translations, gpu=None,
+                                  post_score_length_normalization='simple', post_score_length_normalization_strength=0.2,
+                                  post_score_coverage_penalty='none', post_score_coverage_penalty_strength=0.2,
+                                  reverse_encdec=None, nbest=None, reverse_scores=None):
+    """
+        Rescore and sort the translations found by the beam search for the source sentence src.
+        The reverse model scores of the translations are either computed with reverse_encdec, or given by
+        reverse_scores (as computed by batch_reverse_rescore).
+        Return a list with the best translation (or the nbest translations if nbest is not None).
+    """
+    translations = remove_empty_translations(translations)
+
+#     print "nb_trans", len(translations), [score for _, score in translations]
+#     translations.sort(key = itemgetter(1), reverse = True)
+
+    if reverse_encdec is not None and reverse_scores is None and len(translations) > 1:
+        src_batch, src_mask = make_batch_src([src], gpu=gpu, volatile="on")
+        reverse_scores = reverse_rescore(
+            reverse_encdec, src_batch, src_mask, eos_idx, [
+                t[0] for t in translations], gpu)
+
+    if reverse_scores is not None:
+        assert len(reverse_scores) == len(translations)
+        rescored_translations = []
+        for num_t in xrange(len(translations)):
+            tr, sc = translations[num_t][:2]
+            rescored_translations.append(
+                (tr, sc + reverse_scores[num_t]) + tuple(translations[num_t][2:]))
+        translations = rescored_translations
+
+    xp = encdec[0].xp
+
+    if post_score_length_normalization == 'none' and post_score_coverage_penalty == 'none':
+        ranking_criterion = operator.itemgetter(1)
+    else:
+        def ranking_criterion(x):
+            length_normalization = beam_search.compute_length_normalization(
+                len(x[0]), post_score_length_normalization, post_score_length_normalization_strength)
+
+            coverage_penalty = 0
+            if post_score_coverage_penalty == 'google':
+                # x[3] is the sum of the attention vectors, as computed during the search
+                coverage = x[3] if len(x) > 3 else sum(x[2])
+                assert len(src) == coverage.shape[0]
+
+                # log.info("sum={0}".format(coverage))
+                # log.info("min={0}".format(xp.minimum(coverage, xp.array(1.0))))
+                # log.info("log={0}".format(xp.log(xp.minimum(coverage, xp.array(1.0)))))
+                log_of_min_of_sum_over_j = xp.log(xp.minimum(coverage, xp.array(1.0)))
+                coverage_penalty = post_score_coverage_penalty_strength * xp.sum(log_of_min_of_sum_over_j)
+                # log.info("cp={0}".format(coverage_penalty))
+                # cp = 0
+                # for i in xrange(len(src)):
+                #    attn_sum = 0
+                #    for j in xrange(len(x[0])):
+                #        attn_sum += x[2][j][i]
+                #    #log.info("attn_sum={0}".format(attn_sum))
+                #    #log.info("min={0}".format(min(attn_sum, 1.0)))
+                #    #log.info("log={0}".format(math.log(min(attn_sum, 1.0))))
+                #    cp += math.log(min(attn_sum, 1.0))
+                # log.info("cp={0}".format(cp))
+                # cp *= post_score_coverage_penalty_strength
+
+                # slow = x[1]/length_normalization + cp
+                # opti = x[1]/length_normalization + coverage_penalty
+                # log.info("type={0}....{1}".format(type(slow), type(opti)))
+                # log.info("shape={0} size={1} dim={2} data={3} elem={4}".format(opti.shape, opti.size, opti.ndim, opti.data, opti.item(0)))
+                # test = '!!!'
+                # if "{0}".format(slow) == "{0}".format(opti):
+                #    test = ''
+                # log.info("score slow <=> optimized: {0} <=> {1} {2}".format(slow, opti, test))
+
+            return x[1] / length_normalization + coverage_penalty
+
+    translations.sort(key=ranking_criterion, reverse=True)
+
+    # coverage vectors are not part of the returned translations
+    translations = [t[:3] for t in translations]
+
+    if nbest is not None:
+        return translations[:nbest]
+    else:
+        return [translations[0]]
 
 
 def batch_align(encdec, eos_idx, src_tgt_data, batch_size=80, gpu=None):
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""framing.py: Length-prefixed messages exchanged by the server and the client on persistent connections"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import socket
+import string
+import struct
+import xml.parsers.expat
+
+# each message is preceded by its length in bytes, as a 4 bytes big-endian unsigned integer
+LENGTH_PREFIX = struct.Struct("!I")
+
+# time in seconds after which an incomplete legacy request is given up
+LEGACY_REQUEST_TIMEOUT = 10
+
+# larger messages are refused. The first byte of a length prefix is then at most 0x08, which distinguishes it from
+# the first byte of a legacy (unframed) XML request: '<', a utf-8 BOM or whitespace (0x09 to 0x0d and 0x20)
+MAX_MESSAGE_SIZE = 128 * 1024 * 1024
+
+
+class FramingError(Exception):
+    pass
+
+
+def is_legacy_request(first_byte):
+    """
+        Whether a connection whose first byte is first_byte comes from a legacy client, which sends a single XML
+        article without length prefix and reads the response until the connection is closed.
+    """
+    return first_byte in "<\xef" + string.whitespace
+
+
+def receive_legacy_request(sock, timeout=LEGACY_REQUEST_TIMEOUT):
+    """
+        Read a legacy request: an XML document sent in any number of packets, without knowing its length. The
+        data is parsed as it arrives, and the reading stops as soon as the root element is closed, the data is
+        not well-formed XML, the connection is closed, or nothing is received for timeout seconds.
+        Return the data read, which the caller has to parse again (and report as an error if it is not valid).
+    """
+    depth = [0]
+    complete = [False]
+
+    def start_element(name, attrs):
+        depth[0] += 1
+
+    def end_element(name):
+        depth[0] -= 1
+        if depth[0] == 0:
+            complete[0] = True
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+
+    previous_timeout = sock.gettimeout()
+    sock.settimeout(timeout)
+    packets = []
+    nb_received = 0
+    try:
+        while not complete[0] and nb_received <= MAX_MESSAGE_SIZE:
+            try:
+                packet = sock.recv(4096)
+            except socket.timeout:
+                break
+            if not packet:
+                break
+            packets.append(packet)
+            nb_received += len(packet)
+            try:
+                parser.Parse(packet, False)
+            except xml.parsers.expat.ExpatError:
+                break
+    finally:
+        sock.settimeout(previous_timeout)
+    return "".join(packets)
+
+
+def send_message(sock, message):
+    if isinstance(message, unicode):
+        message = message.encode("utf-8")
+    if len(message) > MAX_MESSAGE_SIZE:
+        raise FramingError("message of %i bytes is too large (max %i)" % (len(message), MAX_MESSAGE_SIZE))
+    sock.sendall(LENGTH_PREFIX.pack(len(message)) + message)
+
+
+def receive_exactly(sock, size):
+    """
+        Read size bytes from sock. Return None if the connection is closed before the first byte, and raise
+        FramingError if it is closed in the middle.
+    """
+    chunks = []
+    nb_received = 0
+    while nb_received < size:
+        chunk = sock.recv(min(size - nb_received, 65536))
+        if not chunk:
+            if nb_received == 0:
+                return None
+            raise FramingError("connection closed after %i of %i bytes" % (nb_received, size))
+        chunks.append(chunk)
+        nb_received += len(chunk)
+    return "".join(chunks)
+
+
+def receive_message(sock):
+    """
+        Read the next message from sock, or return None if the connection was closed between two messages.
+    """
+    prefix = receive_exactly(sock, LENGTH_PREFIX.size)
+    if prefix is None:
+        return None
+    size, = LENGTH_PREFIX.unpack(prefix)
+    if size > MAX_MESSAGE_SIZE:
+        raise FramingError("message of %i bytes is too large (max %i)" % (size, MAX_MESSAGE_SIZE))
+    if size == 0:
+        return ""
+    message = receive_exactly(sock, size)
+    if message is None:
+        raise FramingError("connection closed before a message of %i bytes" % size)
+    return message
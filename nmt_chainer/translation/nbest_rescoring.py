@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""nbest_rescoring.py: score the candidates of a Moses n-best file with a model, batching together the candidates
+of several source sentences"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import codecs
+import logging
+
+from nmt_chainer.utilities.utils import make_batch_src, make_batch_tgt
+
+logging.basicConfig()
+log = logging.getLogger("rnns:nbest_rescoring")
+log.setLevel(logging.INFO)
+
+
+def iterate_moses_nbest_file(filename, max_nb_ex=None):
+    """
+        Yield (num_src, candidates) for each source sentence of the Moses n-best file filename, candidates being
+        the list of its candidate translations (as unicode strings).
+        The lines of the file ("num_src ||| candidate ||| ...") are read one by one: the lines of a source sentence
+        have to be consecutive, and the source sentences in increasing order.
+        If max_nb_ex is not None, only the sentences with num_src < max_nb_ex are read.
+    """
+    with codecs.open(filename, encoding="utf8") as f:
+        current_num_src = None
+        candidates = []
+        for line in f:
+            fields = line.split("|||")
+            num_src = int(fields[0].strip())
+            if num_src != current_num_src:
+                if current_num_src is not None:
+                    if num_src < current_num_src:
+                        raise ValueError("the n-best lists of %s are not sorted by source sentence (%i after %i)" %
+                                         (filename, num_src, current_num_src))
+                    yield current_num_src, candidates
+                    current_num_src = None
+                if max_nb_ex is not None and num_src >= max_nb_ex:
+                    break
+                current_num_src = num_src
+                candidates = []
+            candidates.append(fields[1].strip())
+        if current_num_src is not None:
+            yield current_num_src, candidates
+
+
+def score_pairs(encdec, eos_idx, src_data, pairs, gpu=None):
+    """
+        Return the score (log probability) given by encdec to each pair (num_src, tgt) of pairs, tgt being the
+        indexed candidate translation of the source sentence src_data[num_src].
+        All the pairs are scored in one minibatch, and each source sentence is encoded only once.
+    """
+    src_nums = sorted(set(num_src for num_src, _ in pairs))
+    position_in_src_batch = dict((num_src, pos) for pos, num_src in enumerate(src_nums))
+    src_batch, src_mask = make_batch_src([src_data[num_src] for num_src in src_nums], gpu=gpu, volatile="on")
+    scorer = encdec.nbest_batch_scorer(src_batch, src_mask)
+
+    tgt_batch, arg_sort = make_batch_tgt([tgt for _, tgt in pairs], eos_idx=eos_idx, gpu=gpu, volatile="on",
+                                         need_arg_sort=True)
+    src_indices = [position_in_src_batch[pairs[original_pos][0]] for original_pos in arg_sort]
+    (scores, _), _ = scorer(src_indices, tgt_batch)
+    scores = scores.data
+
+    assert len(arg_sort) == len(scores)
+    de_sorted_scores = [None] * len(scores)
+    for xpos in xrange(len(arg_sort)):
+        de_sorted_scores[arg_sort[xpos]] = float(scores[xpos])
+    return de_sorted_scores
+
+
+def score_pairs_sorted_by_length(encdec, eos_idx, src_data, pairs, mb_size=80, gpu=None):
+    """
+        Same as score_pairs, except that the pairs are sorted by source and target length and scored in minibatches
+        of mb_size pairs, so that the minibatches need little padding and contain few distinct source sentences.
+        The scores are returned in the order of pairs.
+    """
+    order = sorted(xrange(len(pairs)), key=lambda num_pair: (len(src_data[pairs[num_pair][0]]), len(pairs[num_pair][1])))
+    scores = [None] * len(pairs)
+    for start in xrange(0, len(order), mb_size):
+        batch_order = order[start:start + mb_size]
+        batch_scores = score_pairs(encdec, eos_idx, src_data, [pairs[num_pair] for num_pair in batch_order], gpu=gpu)
+        for num_pair, score in zip(batch_order, batch_scores):
+            scores[num_pair] = score
+    return scores
+
+
+def rescore_nbest_lists(encdec, eos_idx, src_data, nbest_lists, tgt_indexer, mb_size=80, nb_batch_to_sort=20,
+                        gpu=None, stats=None):
+    """
+        Generator yielding (num_src, score) for each candidate of nbest_lists (an iterable of (num_src, candidates),
+        as given by iterate_moses_nbest_file), in the original order.
+
+        The candidates are read mb_size * nb_batch_to_sort at a time, and each of these windows of (source, candidate)
+        pairs is scored by score_pairs_sorted_by_length.
+        stats (as returned by tgt_indexer.make_new_stat()) is updated with the candidates if it is not None.
+    """
+    def iterate_pairs():
+        for num_src, candidates in nbest_lists:
+            if num_src >= len(src_data):
+                raise ValueError("n-best list for source sentence %i, but there are only %i source sentences" %
+                                 (num_src, len(src_data)))
+            for candidate in candidates:
+                yield num_src, tgt_indexer.convert(candidate, stats=stats)
+
+    def score_window(window):
+        scores = score_pairs_sorted_by_length(encdec, eos_idx, src_data, window, mb_size=mb_size, gpu=gpu)
+        return [(num_src, score) for (num_src, _), score in zip(window, scores)]
+
+    window_size = mb_size * max(1, nb_batch_to_sort)
+    window = []
+    nb_scored = 0
+    for pair in iterate_pairs():
+        window.append(pair)
+        if len(window) >= window_size:
+            for result in score_window(window):
+                yield result
+            nb_scored += len(window)
+            log.info("scored %i candidates" % nb_scored)
+            window = []
+    if len(window) > 0:
+        for result in score_window(window):
+            yield result
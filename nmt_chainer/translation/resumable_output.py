@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""resumable_output.py: progress file of the translation of a file, and detection of the point where an interrupted
+translation can be resumed"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import json
+import logging
+import os
+
+logging.basicConfig()
+log = logging.getLogger("rnns:resumable_output")
+log.setLevel(logging.INFO)
+
+# The progress file is a small json file rewritten after each translated sentence (once the outputs have been
+# flushed). It contains the number of sentences done and the size in bytes of each output file at that point:
+#   {"nb_sentences_done": 40000, "offsets": {"dest.txt": 1234567, "dest.txt.unprocessed": 1234000, ...}}
+# When resuming, the output files are truncated to these sizes (which removes any partially written sentence) and
+# appended to.
+# Since the outputs are flushed before the progress file is written, the progress file can only be behind the
+# outputs, never ahead of them (except after a crash of the OS, in which case the outputs are scanned instead).
+
+RICH_OUTPUT_ENTRY_START = '{"tr": '
+RICH_OUTPUT_HEADER = "[\n"
+
+
+def save_progress(progress_filename, nb_sentences_done, offsets):
+    """ Atomically write the progress file (offsets is a dict {output filename: size in bytes}) """
+    tmp_filename = progress_filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump({"nb_sentences_done": nb_sentences_done, "offsets": offsets}, f)
+    os.rename(tmp_filename, progress_filename)
+
+
+def load_progress(progress_filename):
+    """ Return (nb_sentences_done, offsets) as saved by save_progress, or None if there is no progress file """
+    if not os.path.exists(progress_filename):
+        return None
+    with open(progress_filename) as f:
+        progress = json.load(f)
+    return progress["nb_sentences_done"], progress["offsets"]
+
+
+def complete_line_offsets(filename):
+    """ Return the list of the offsets just after each complete (ie. newline terminated) line of filename """
+    offsets = []
+    if not os.path.exists(filename):
+        return offsets
+    position = 0
+    with open(filename, "rb") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            position += len(line)
+            offsets.append(position)
+    return offsets
+
+
+def complete_rich_output_entry_offsets(filename):
+    """
+        Return the list of the offsets just after each complete entry of the rich output filename
+        (as written by eval.RichOutputWriter: the next entry, if any, starts after a ",\n" separator).
+        Return None if filename does not even contain the start of the json list.
+    """
+    if not os.path.exists(filename):
+        return None
+    offsets = []
+    with open(filename, "rb") as f:
+        if f.read(len(RICH_OUTPUT_HEADER)) != RICH_OUTPUT_HEADER:
+            return None
+        position = len(RICH_OUTPUT_HEADER)
+        current_entry = None
+        for line in f:
+            if line.startswith(RICH_OUTPUT_ENTRY_START):
+                current_entry = ""
+            if current_entry is not None:
+                # json strings cannot contain a raw newline: only the last line of an entry ends with "}"
+                content = line.rstrip("\n")
+                if content.endswith(","):
+                    content = content[:-1]
+                entry_is_complete = False
+                if content.endswith("}"):
+                    try:
+                        json.loads(current_entry + content)
+                        entry_is_complete = True
+                    except ValueError:
+                        pass
+                if entry_is_complete:
+                    offsets.append(position + len(content))
+                    current_entry = None
+                else:
+                    current_entry += line
+            if not line.endswith("\n"):
+                break
+            position += len(line)
+    return offsets
+
+
+def detect_progress_from_outputs(dest_fn, unprocessed_output_filename=None, rich_output_filename=None):
+    """
+        Find how many sentences are completely written in the output files, when there is no usable progress file.
+        Return (nb_sentences_done, offsets) as load_progress.
+    """
+    offsets_lists = {dest_fn: complete_line_offsets(dest_fn)}
+    if unprocessed_output_filename is not None:
+        offsets_lists[unprocessed_output_filename] = complete_line_offsets(unprocessed_output_filename)
+    if rich_output_filename is not None:
+        rich_output_offsets = complete_rich_output_entry_offsets(rich_output_filename)
+        if rich_output_offsets is None:
+            return 0, {}
+        offsets_lists[rich_output_filename] = rich_output_offsets
+
+    nb_sentences_done = min(len(offsets_list) for offsets_list in offsets_lists.itervalues())
+    offsets = {}
+    for filename, offsets_list in offsets_lists.iteritems():
+        if nb_sentences_done > 0:
+            offsets[filename] = offsets_list[nb_sentences_done - 1]
+        elif filename == rich_output_filename:
+            offsets[filename] = len(RICH_OUTPUT_HEADER)
+        else:
+            offsets[filename] = 0
+    return nb_sentences_done, offsets
+
+
+def find_resume_point(dest_fn, progress_filename=None, unprocessed_output_filename=None, rich_output_filename=None,
+                      nbest=None):
+    """
+        Return (nb_sentences_done, offsets) for resuming the translation written to dest_fn and the other given
+        output files: the first nb_sentences_done sentences are done, and each output file has to be truncated to
+        offsets[filename] before appending the next translations.
+        The progress file is used if it exists and is consistent with the output files. Otherwise, the complete lines
+        of dest_fn and of the unprocessed output, and the complete entries of the rich output are counted (this is not
+        possible for n-best lists, whose number of lines per sentence varies).
+    """
+    output_filenames = [fn for fn in (dest_fn, unprocessed_output_filename, rich_output_filename) if fn is not None]
+
+    progress = None
+    if progress_filename is not None:
+        progress = load_progress(progress_filename)
+    if progress is not None:
+        nb_sentences_done, offsets = progress
+        for filename in output_filenames:
+            if filename not in offsets:
+                if nb_sentences_done > 0:
+                    raise ValueError("cannot resume: %s was not written by the interrupted translation" % filename)
+            elif not os.path.exists(filename) or os.path.getsize(filename) < offsets[filename]:
+                log.warn("%s is shorter than recorded in the progress file %s" % (filename, progress_filename))
+                progress = None
+                break
+    if progress is not None:
+        log.info("resuming after %i sentences (from progress file %s)" % (nb_sentences_done, progress_filename))
+        return nb_sentences_done, dict((filename, offsets.get(filename, 0)) for filename in output_filenames)
+
+    if nbest is not None:
+        raise ValueError("cannot resume a n-best list translation without its progress file")
+    nb_sentences_done, offsets = detect_progress_from_outputs(dest_fn,
+                                                              unprocessed_output_filename=unprocessed_output_filename,
+                                                              rich_output_filename=rich_output_filename)
+    log.info("resuming after %i sentences (found in the output files)" % nb_sentences_done)
+    return nb_sentences_done, offsets
+
+
+def truncate_file(filename, size):
+    with open(filename, "r+b") as f:
+        f.truncate(size)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""segmenter_pool.py: A pool of long-lived segmenter processes used by the server"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import select
+import signal
+import subprocess
+import timeit
+
+logging.basicConfig()
+log = logging.getLogger("rnns:segmenter_pool")
+log.setLevel(logging.INFO)
+
+
+class SegmenterError(Exception):
+    pass
+
+
+class SegmenterTimeout(SegmenterError):
+    pass
+
+
+def parse_segmenter_output(parser_output, segmenter_format):
+    """
+        Return the list of words of the output of the segmenter for one sentence, according to segmenter_format
+        (parse_server, morph or plain).
+    """
+    words = []
+    if 'parse_server' == segmenter_format:
+        for line in parser_output.split("\n"):
+            if (line.startswith('#')):
+                continue
+            elif (not line.strip()):
+                break
+            else:
+                parts = line.split("\t")
+                word = parts[2]
+                words.append(word)
+    elif 'morph' == segmenter_format:
+        for pair in parser_output.split(' '):
+            if pair != '':
+                word, pos = pair.split('_')
+                words.append(word)
+    elif 'plain' == segmenter_format:
+        words = parser_output.split(' ')
+    else:
+        pass
+    return words
+
+
+class SegmenterProcess(object):
+    """
+        A segmenter process started by the shell command command, reading one sentence per line on its standard input
+        and writing the segmentation of each sentence on its standard output, without buffering it.
+        The segmentation of a sentence is one line, except for the parse_server format, where it ends with an empty
+        line.
+    """
+
+    def __init__(self, command, segmenter_format):
+        self.command = command
+        self.segmenter_format = segmenter_format
+        self.process = None
+        self.buffer = ""
+        self.start()
+
+    def start(self):
+        # in its own process group, so that all the processes of a pipeline can be killed together
+        self.process = subprocess.Popen(self.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        preexec_fn=os.setsid, close_fds=True)
+        self.buffer = ""
+        log.info("started segmenter process %i: %s" % (self.process.pid, self.command))
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.stdout.close()
+        self.process.wait()
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def read_line(self, deadline):
+        while "\n" not in self.buffer:
+            remaining_time = deadline - timeit.default_timer()
+            if remaining_time <= 0:
+                raise SegmenterTimeout("no answer from the segmenter (%s)" % self.command)
+            ready, _, _ = select.select([self.process.stdout], [], [], remaining_time)
+            if len(ready) == 0:
+                continue
+            data = os.read(self.process.stdout.fileno(), 4096)
+            if data == "":
+                raise SegmenterError("the segmenter process terminated (%s)" % self.command)
+            self.buffer += data
+        end = self.buffer.index("\n") + 1
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def segment(self, text, timeout):
+        """
+            Return the output of the segmenter for text (a utf-8 string), as a shell command run on text would.
+        """
+        deadline = timeit.default_timer() + timeout
+        try:
+            self.process.stdin.write(text.replace("\n", " ") + "\n")
+            self.process.stdin.flush()
+        except IOError as e:
+            raise SegmenterError("could not write to the segmenter process (%s): %s" % (self.command, e))
+        if 'parse_server' == self.segmenter_format:
+            lines = []
+            while True:
+                line = self.read_line(deadline)
+                lines.append(line)
+                if not line.strip():
+                    break
+            return "".join(lines)
+        return self.read_line(deadline)
+
+
+class SegmenterPool(object):
+    """
+        nb_processes SegmenterProcess shared by the threads of the server. Each call to segment uses an idle process
+        (waiting for one if they are all busy). segment_list segments the sentences of a list concurrently.
+        A process that fails or does not answer within timeout seconds is restarted. A sentence whose process
+        terminated is segmented again once by the restarted process.
+    """
+
+    def __init__(self, command, segmenter_format, nb_processes=1, timeout=10):
+        self.timeout = timeout
+        self.nb_processes = nb_processes
+        self.thread_pool = ThreadPool(nb_processes) if nb_processes > 1 else None
+        self.idle_processes = Queue.Queue()
+        for _ in xrange(nb_processes):
+            self.idle_processes.put(SegmenterProcess(command, segmenter_format))
+
+    def segment(self, text):
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        process = self.idle_processes.get()
+        try:
+            try:
+                return process.segment(text, self.timeout)
+            except SegmenterTimeout:
+                log.warn("segmenter timeout: restarting the process")
+                process.restart()
+                raise
+            except SegmenterError as e:
+                log.warn("%s: restarting the process" % e)
+                process.restart()
+            try:
+                return process.segment(text, self.timeout)
+            except SegmenterError:
+                process.restart()
+                raise
+        finally:
+            self.idle_processes.put(process)
+
+    def segment_list(self, texts):
+        if self.thread_pool is None or len(texts) <= 1:
+            return [self.segment(text) for text in texts]
+        return self.thread_pool.map(self.segment, texts)
+
+    def close(self):
+        if self.thread_pool is not None:
+            self.thread_pool.close()
+        while not self.idle_processes.empty():
+            self.idle_processes.get().stop()
@@ -12,11 +12,12 @@ import numpy as np
 from chainer import cuda
 import logging
 import sys
-import tempfile
 
-from nmt_chainer.dataprocessing.processors import build_dataset_one_side_pp
 import nmt_chainer.translation.eval
 from nmt_chainer.translation.server_arg_parsing import make_config_server
+from nmt_chainer.translation.segmenter_pool import parse_segmenter_output
+from nmt_chainer.translation.framing import (is_legacy_request, receive_legacy_request, send_message, receive_message,
+                                             FramingError)
 
 import traceback
 
@@ -36,6 +37,22 @@ log = logging.getLogger("rnns:server")
 log.setLevel(logging.INFO)
 
 
+def create_batching_scheduler_from_config(config_server, translate_batch):
+    """
+        Create the BatchingScheduler translating the requests of the server in batches if --server_max_batch_size
+        is larger than 1.
+    """
+    if 'server_max_batch_size' not in config_server.process or config_server.process.server_max_batch_size is None:
+        return None
+    if config_server.process.server_max_batch_size <= 1:
+        return None
+    from nmt_chainer.translation.batching_scheduler import BatchingScheduler
+    log.info("translating the requests in batches of at most %i sentences" % config_server.process.server_max_batch_size)
+    return BatchingScheduler(translate_batch, config_server.process.server_max_batch_size,
+                             batching_window=config_server.process.server_batching_window / 1000.0,
+                             max_batch_tokens=config_server.process.server_max_batch_tokens)
+
+
 class Translator:
 
     def __init__(self, config_server):
@@ -46,90 +63,197 @@ class Translator:
 
         self.encdec_list = [self.encdec]
 
+        from nmt_chainer.translation.eval import (create_shortlist_generator_from_config, create_encoding_cache_from_config,
+                                                  create_ensemble_pool_from_config)
+        self.shortlist_generator = create_shortlist_generator_from_config(config_server, self.encdec, self.eos_idx,
+                                                                          self.src_indexer, self.tgt_indexer)
+        self.encoding_cache = create_encoding_cache_from_config(config_server, self.encdec, self.reverse_encdec)
+        self.ensemble_pool = create_ensemble_pool_from_config(config_server, self.encdec)
+        self.batching_scheduler = create_batching_scheduler_from_config(config_server, self.translate_batch)
+
+    def translate_batch(self, sentences, params, need_attention):
+        return self.translate_sentences(sentences, need_attention=need_attention, **params)
+
+    def translate_sentences(self, sentences, beam_width=30, beam_pruning_margin=None, beam_score_coverage_penalty='none',
+                            beam_score_coverage_penalty_strength=0.2, nb_steps=50, nb_steps_ratio=1.2,
+                            remove_unk=False, normalize_unicode_unk=True, attempt_to_relocate_unk_source=False,
+                            beam_score_length_normalization='none', beam_score_length_normalization_strength=0.2,
+                            post_score_length_normalization='simple', post_score_length_normalization_strength=0.2,
+                            post_score_coverage_penalty='none', post_score_coverage_penalty_strength=0.2,
+                            groundhog=False, force_finish=False, prob_space_combination=False, need_attention=False):
+        """
+            Translate the (segmented) source sentence strings of the list sentences in memory, with the loaded models
+            and preprocessor. The sentences are translated together by a batched beam search.
+            Return the list of the tuples (translation, score, unk_mapping, attention) of each sentence:
+              - translation is the post-processed translation string
+              - unk_mapping is the list of "src_pos-tgt_pos" strings giving the source word aligned to each unknown
+                word of the translation
+              - attention is None if need_attention is False, and else a tuple (src_words, tgt_words, attn),
+                attn[j][i] being the attention given to the source word i when generating the target word j.
+        """
+        from nmt_chainer.translation.eval import beam_search_all
+        from nmt_chainer.utilities import replace_tgt_unk
+        if len(sentences) == 0:
+            return []
+        src_data = [self.src_indexer.convert(sentence.strip()) for sentence in sentences]
+        # the unknown words are replaced below, as each sentence has its own source string
+        translations = beam_search_all(self.config_server.process.gpu, self.encdec, self.eos_idx, src_data, beam_width, beam_pruning_margin,
+                                       beam_score_coverage_penalty, beam_score_coverage_penalty_strength, nb_steps,
+                                       nb_steps_ratio, beam_score_length_normalization, beam_score_length_normalization_strength,
+                                       post_score_length_normalization, post_score_length_normalization_strength,
+                                       post_score_coverage_penalty, post_score_coverage_penalty_strength,
+                                       groundhog,
+                                       self.config_server.output.tgt_unk_id, self.tgt_indexer, force_finish=force_finish,
+                                       prob_space_combination=prob_space_combination, reverse_encdec=self.reverse_encdec,
+                                       use_unfinished_translation_if_none_found=True,
+                                       beam_search_batch_size=len(sentences),
+                                       shortlist_generator=self.shortlist_generator,
+                                       check_shortlist=self.config_server.method.get("check_shortlist", False),
+                                       fused_scoring=self.config_server.method.get("fused_scoring", False),
+                                       ensemble_pool=self.ensemble_pool)
+
+        results = []
+        for sentence, [(src, translated, t, score, attn, unk_mapping)] in zip(sentences, translations):
+            ct = " ".join(translated)
+            if ct != '':
+                translated = replace_tgt_unk.replace_unk_from_string(
+                    ct, sentence, self.config_server.output.dic, remove_unk, normalize_unicode_unk,
+                    attempt_to_relocate_unk_source).strip().split(" ")
+            attention = None
+            if need_attention:
+                attention = (self.src_indexer.deconvert_swallow(src), translated, attn)
+            results.append((self.tgt_indexer.deconvert_post(translated), float(score), unk_mapping, attention))
+
+        if self.encoding_cache is not None:
+            log.info("encoding cache: %s" % self.encoding_cache.make_report())
+
+        return results
+
+    def translate_sentence_list(self, sentences, need_attention=False, **kwargs):
+        """
+            Translate the list sentences, kwargs being the decoding parameters of translate_sentences, and return
+            their tuples (translation, score, unk_mapping, attention).
+            If the server batches the requests (see create_batching_scheduler_from_config), the sentences are
+            translated by the scheduler thread together with the sentences of the other requests. Otherwise, they
+            are translated as one batch.
+        """
+        if self.batching_scheduler is not None:
+            return self.batching_scheduler.translate_list(sentences, kwargs, need_attention=need_attention)
+        return self.translate_sentences(sentences, need_attention=need_attention, **kwargs)
+
+    def translate_sentence(self, sentence, need_attention=False, **kwargs):
+        """
+            Translate a single sentence with translate_sentence_list and return its tuple
+            (translation, score, unk_mapping, attention).
+        """
+        return self.translate_sentence_list([sentence], need_attention=need_attention, **kwargs)[0]
+
+    def translate_article(self, sentences, beam_width, beam_pruning_margin, beam_score_coverage_penalty, beam_score_coverage_penalty_strength, nb_steps, nb_steps_ratio,
+                          remove_unk, normalize_unicode_unk, attempt_to_relocate_unk_source, beam_score_length_normalization, beam_score_length_normalization_strength, post_score_length_normalization, post_score_length_normalization_strength,
+                          post_score_coverage_penalty, post_score_coverage_penalty_strength,
+                          groundhog, force_finish, prob_space_combination, attn_graph_width, attn_graph_height):
+        """
+            Translate the sentences of an article together with translate_sentence_list and return, for each
+            sentence, the translation (followed by a newline), the script and div of the attention graph, and the
+            unk mapping.
+        """
+        from nmt_chainer.translation.eval import AttentionVisualizer
+        for sentence in sentences:
+            log.info("processing source string %s" % sentence)
+
+        results = self.translate_sentence_list(
+            sentences, beam_width=beam_width, beam_pruning_margin=beam_pruning_margin,
+            beam_score_coverage_penalty=beam_score_coverage_penalty,
+            beam_score_coverage_penalty_strength=beam_score_coverage_penalty_strength,
+            nb_steps=nb_steps, nb_steps_ratio=nb_steps_ratio,
+            remove_unk=remove_unk, normalize_unicode_unk=normalize_unicode_unk,
+            attempt_to_relocate_unk_source=attempt_to_relocate_unk_source,
+            beam_score_length_normalization=beam_score_length_normalization,
+            beam_score_length_normalization_strength=beam_score_length_normalization_strength,
+            post_score_length_normalization=post_score_length_normalization,
+            post_score_length_normalization_strength=post_score_length_normalization_strength,
+            post_score_coverage_penalty=post_score_coverage_penalty,
+            post_score_coverage_penalty_strength=post_score_coverage_penalty_strength,
+            groundhog=groundhog, force_finish=force_finish, prob_space_combination=prob_space_combination,
+            need_attention=True)
+
+        article = []
+        for translation, score, unk_mapping, (src_words, tgt_words, attn) in results:
+            attn_vis = AttentionVisualizer()
+            attn_vis.add_plot(src_words, tgt_words, attn, include_sum=False,
+                              visual_attribs={'title': '', 'toolbar_location': 'below', 'plot_width': attn_graph_width,
+                                              'plot_height': attn_graph_height})
+            script, div = attn_vis.make_components()
+            article.append((translation + "\n", script, div, unk_mapping))
+        return article
+
     def translate(self, sentence, beam_width, beam_pruning_margin, beam_score_coverage_penalty, beam_score_coverage_penalty_strength, nb_steps, nb_steps_ratio,
                   remove_unk, normalize_unicode_unk, attempt_to_relocate_unk_source, beam_score_length_normalization, beam_score_length_normalization_strength, post_score_length_normalization, post_score_length_normalization_strength,
                   post_score_coverage_penalty, post_score_coverage_penalty_strength,
                   groundhog, force_finish, prob_space_combination, attn_graph_width, attn_graph_height):
-        from nmt_chainer.utilities import visualisation
-        log.info("processing source string %s" % sentence)
-
-        src_file = tempfile.NamedTemporaryFile()
-        src_file.write(sentence.encode('utf-8'))
-        src_file.seek(0)
-
-        dest_file = tempfile.NamedTemporaryFile()
-        rich_output_file = tempfile.NamedTemporaryFile()
-        attn_graph_script_file = tempfile.NamedTemporaryFile()
-        attn_graph_div_file = tempfile.NamedTemporaryFile()
-
-        try:
-            out = ''
-            script = ''
-            div = '<div/>'
-            unk_mapping = []
-
-            src_data, stats_src_pp = build_dataset_one_side_pp(src_file.name, self.src_indexer, max_nb_ex=self.config_server.process.max_nb_ex)
-
-            from nmt_chainer.translation.eval import translate_to_file_with_beam_search
-            translate_to_file_with_beam_search(dest_file.name, self.config_server.process.gpu, self.encdec, self.eos_idx, src_data, beam_width, beam_pruning_margin,
-                                               beam_score_coverage_penalty=beam_score_coverage_penalty,
-                                               beam_score_coverage_penalty_strength=beam_score_coverage_penalty_strength,
-                                               nb_steps=nb_steps,
-                                               nb_steps_ratio=nb_steps_ratio,
-                                               beam_score_length_normalization=beam_score_length_normalization,
-                                               beam_score_length_normalization_strength=beam_score_length_normalization_strength,
-                                               post_score_length_normalization=post_score_length_normalization,
-                                               post_score_length_normalization_strength=post_score_length_normalization_strength,
-                                               post_score_coverage_penalty=post_score_coverage_penalty,
-                                               post_score_coverage_penalty_strength=post_score_coverage_penalty_strength,
-                                               groundhog=groundhog,
-                                               tgt_unk_id=self.config_server.output.tgt_unk_id,
-                                               tgt_indexer=self.tgt_indexer,
-                                               force_finish=force_finish,
-                                               prob_space_combination=prob_space_combination, reverse_encdec=self.reverse_encdec,
-                                               generate_attention_html=(attn_graph_script_file.name, attn_graph_div_file.name),
-                                               attn_graph_with_sum=False,
-                                               attn_graph_attribs={'title': '', 'toolbar_location': 'below', 'plot_width': attn_graph_width, 'plot_height': attn_graph_height}, src_indexer=self.src_indexer,
-                                               rich_output_filename=rich_output_file.name,
-                                               use_unfinished_translation_if_none_found=True,
-                                               replace_unk=True, src=sentence, dic=self.config_server.output.dic,
-                                               remove_unk=remove_unk, normalize_unicode_unk=normalize_unicode_unk, attempt_to_relocate_unk_source=attempt_to_relocate_unk_source)
-
-            dest_file.seek(0)
-            out = dest_file.read()
-
-            rich_output_file.seek(0)
-            rich_output_data = json.loads(rich_output_file.read())
-            unk_mapping = rich_output_data[0]['unk_mapping']
-
-            attn_graph_script_file.seek(0)
-            script = attn_graph_script_file.read()
-
-            attn_graph_div_file.seek(0)
-            div = attn_graph_div_file.read()
-
-        finally:
-            src_file.close()
-            dest_file.close()
-            rich_output_file.close()
-            attn_graph_script_file.close()
-            attn_graph_div_file.close()
-
-        return out, script, div, unk_mapping
+        """
+            Translate a single sentence with translate_article and return the translation (followed by a newline),
+            the script and div of the attention graph, and the unk mapping.
+        """
+        return self.translate_article([sentence], beam_width, beam_pruning_margin, beam_score_coverage_penalty, beam_score_coverage_penalty_strength, nb_steps, nb_steps_ratio,
+                                      remove_unk, normalize_unicode_unk, attempt_to_relocate_unk_source, beam_score_length_normalization, beam_score_length_normalization_strength, post_score_length_normalization, post_score_length_normalization_strength,
+                                      post_score_coverage_penalty, post_score_coverage_penalty_strength,
+                                      groundhog, force_finish, prob_space_combination, attn_graph_width, attn_graph_height)[0]
 
 
 class RequestHandler(SocketServer.BaseRequestHandler):
 
     def handle(self):
+        first_byte = self.request.recv(1, socket.MSG_PEEK)
+        if not first_byte:
+            return
+        if is_legacy_request(first_byte):
+            self.handle_legacy_request()
+        else:
+            self.handle_framed_requests()
+
+    def handle_legacy_request(self):
+        """
+            A single XML article, whose JSON response is sent before closing the connection.
+        """
+        data = receive_legacy_request(self.request)
+        self.request.sendall(self.process_request(data))
+
+    def handle_framed_requests(self):
+        """
+            Length-prefixed XML articles (see framing.py), answered in order by length-prefixed JSON responses until
+            the client closes the connection. The client can send the next requests without waiting for the
+            responses.
+        """
+        nb_requests = 0
+        while True:
+            try:
+                data = receive_message(self.request)
+            except (FramingError, socket.error) as e:
+                log.warn("closing the connection: %s" % e)
+                break
+            if data is None:
+                break
+            response = self.process_request(data)
+            try:
+                send_message(self.request, response)
+            except socket.error as e:
+                log.warn("closing the connection: %s" % e)
+                break
+            nb_requests += 1
+        log.info("connection closed after %i requests" % nb_requests)
+
+    def process_request(self, data):
+        """
+            Translate the XML article data and return the JSON response.
+        """
         start_request = timeit.default_timer()
         log.info(timestamped_msg("Handling request..."))
-        data = self.request.recv(4096)
+        cur_thread = threading.current_thread()
 
         response = {}
         if (data):
             try:
-                cur_thread = threading.current_thread()
-
                 log.info("data={0}".format(data))
                 root = ET.fromstring(data)
                 article_id = root.get('id')
@@ -200,63 +324,49 @@ class RequestHandler(SocketServer.BaseRequestHandler):
                 segmented_output = []
                 mapping = []
                 sentences = root.findall('sentence')
-                for idx, sentence in enumerate(sentences):
-                    sentence_number = sentence.get('id')
-                    text = sentence.findtext('i_sentence').strip()
+                sentence_numbers = [sentence.get('id') for sentence in sentences]
+                texts = [sentence.findtext('i_sentence').strip() for sentence in sentences]
+                for text in texts:
                     log.info("text=@@@%s@@@" % text)
 
-                    cmd = self.server.segmenter_command % pipes.quote(text)
-                    log.info("cmd=%s" % cmd)
-                    start_cmd = timeit.default_timer()
-
-                    parser_output = subprocess.check_output(cmd, shell=True)
-
-                    log.info(
-                        "Segmenter request processed in {} s.".format(
-                            timeit.default_timer() - start_cmd))
+                start_cmd = timeit.default_timer()
+                if self.server.segmenter_pool is not None:
+                    parser_outputs = self.server.segmenter_pool.segment_list(texts)
+                else:
+                    parser_outputs = []
+                    for text in texts:
+                        cmd = self.server.segmenter_command % pipes.quote(text)
+                        log.info("cmd=%s" % cmd)
+                        parser_outputs.append(subprocess.check_output(cmd, shell=True))
+
+                log.info(
+                    "Segmenter requests for {} sentences processed in {} s.".format(
+                        len(texts), timeit.default_timer() - start_cmd))
+
+                for parser_output in parser_outputs:
                     log.info("parser_output=%s" % parser_output)
-
-                    words = []
-                    if 'parse_server' == self.server.segmenter_format:
-                        for line in parser_output.split("\n"):
-                            if (line.startswith('#')):
-                                continue
-                            elif (not line.strip()):
-                                break
-                            else:
-                                parts = line.split("\t")
-                                word = parts[2]
-                                words.append(word)
-                    elif 'morph' == self.server.segmenter_format:
-                        for pair in parser_output.split(' '):
-                            if pair != '':
-                                word, pos = pair.split('_')
-                                words.append(word)
-                    elif 'plain' == self.server.segmenter_format:
-                        words = parser_output.split(' ')
-                    else:
-                        pass
+                    words = parse_segmenter_output(parser_output, self.server.segmenter_format)
                     splitted_sentence = ' '.join(words)
                     # log.info("splitted_sentence=" + splitted_sentence)
-
-                    log.info(timestamped_msg("Translating sentence %d" % idx))
-                    decoded_sentence = splitted_sentence.decode('utf-8')
-                    translation, script, div, unk_mapping = self.server.translator.translate(decoded_sentence,
-                                                                                             beam_width, beam_pruning_margin, beam_score_coverage_penalty, beam_score_coverage_penalty_strength, nb_steps, nb_steps_ratio, remove_unk, normalize_unicode_unk, attempt_to_relocate_unk_source,
-                                                                                             beam_score_length_normalization, beam_score_length_normalization_strength, post_score_length_normalization, post_score_length_normalization_strength, post_score_coverage_penalty, post_score_coverage_penalty_strength,
-                                                                                             groundhog, force_finish, prob_space_combination, attn_graph_width, attn_graph_height)
-                    out += translation
                     segmented_input.append(splitted_sentence)
-                    segmented_output.append(translation)
-                    mapping.append(unk_mapping)
-                    graph_data.append(
-                        (script.encode('utf-8'), div.encode('utf-8')))
 
-                    # There should always be only one sentence for now. - FB
-                    break
+                if len(segmented_input) > 0:
+                    log.info(timestamped_msg("Translating %d sentences" % len(segmented_input)))
+                    decoded_sentences = [splitted_sentence.decode('utf-8') for splitted_sentence in segmented_input]
+                    article = self.server.translator.translate_article(decoded_sentences,
+                                                                       beam_width, beam_pruning_margin, beam_score_coverage_penalty, beam_score_coverage_penalty_strength, nb_steps, nb_steps_ratio, remove_unk, normalize_unicode_unk, attempt_to_relocate_unk_source,
+                                                                       beam_score_length_normalization, beam_score_length_normalization_strength, post_score_length_normalization, post_score_length_normalization_strength, post_score_coverage_penalty, post_score_coverage_penalty_strength,
+                                                                       groundhog, force_finish, prob_space_combination, attn_graph_width, attn_graph_height)
+                    for translation, script, div, unk_mapping in article:
+                        out += translation
+                        segmented_output.append(translation)
+                        mapping.append(unk_mapping)
+                        graph_data.append(
+                            (script.encode('utf-8'), div.encode('utf-8')))
 
                 response['article_id'] = article_id
-                response['sentence_number'] = sentence_number
+                response['sentence_number'] = sentence_numbers[0] if len(sentence_numbers) > 0 else None
+                response['sentence_numbers'] = sentence_numbers
                 response['out'] = out
                 response['segmented_input'] = segmented_input
                 response['segmented_output'] = segmented_output
@@ -278,8 +388,7 @@ class RequestHandler(SocketServer.BaseRequestHandler):
                 start_request,
                 cur_thread.name))
 
-        response = json.dumps(response)
-        self.request.sendall(response)
+        return json.dumps(response)
 
 
 class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
@@ -293,11 +402,13 @@ class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
             handler_class,
             segmenter_command,
             segmenter_format,
-            translator):
+            translator,
+            segmenter_pool=None):
         SocketServer.TCPServer.__init__(self, server_address, handler_class)
         self.segmenter_command = segmenter_command
         self.segmenter_format = segmenter_format
         self.translator = translator
+        self.segmenter_pool = segmenter_pool
 
 
 def timestamped_msg(msg):
@@ -305,6 +416,20 @@ def timestamped_msg(msg):
     return "{0}: {1}".format(timestamp, msg)
 
 
+def create_segmenter_pool_from_config(config_server):
+    """
+        Create the pool of --segmenter_pool_size long-lived segmenter processes if --segmenter_pool_command is given.
+        Otherwise, --segmenter_command is run for each sentence.
+    """
+    if 'segmenter_pool_command' not in config_server.process or config_server.process.segmenter_pool_command is None:
+        return None
+    from nmt_chainer.translation.segmenter_pool import SegmenterPool
+    log.info("using a pool of %i segmenter processes" % config_server.process.segmenter_pool_size)
+    return SegmenterPool(config_server.process.segmenter_pool_command, config_server.process.segmenter_format,
+                         nb_processes=config_server.process.segmenter_pool_size,
+                         timeout=config_server.process.segmenter_timeout)
+
+
 def do_start_server(config_server):
     translator = Translator(config_server)
     server_host, server_port = config_server.process.server.split(":")
@@ -314,7 +439,8 @@ def do_start_server(config_server):
         RequestHandler,
         config_server.process.segmenter_command,
         config_server.process.segmenter_format,
-        translator)
+        translator,
+        segmenter_pool=create_segmenter_pool_from_config(config_server))
     ip, port = server.server_address
     log.info(
         timestamped_msg(
@@ -327,6 +453,8 @@ def do_start_server(config_server):
     except KeyboardInterrupt:
         server.shutdown()
         server.server_close()
+        if server.segmenter_pool is not None:
+            server.segmenter_pool.close()
 
     sys.exit(0)
 
@@ -2,7 +2,8 @@
 
 from nmt_chainer.utilities import argument_parsing_tools
 
-_CONFIG_SECTION_TO_DESCRIPTION = {"output": "Output Options",
+_CONFIG_SECTION_TO_DESCRIPTION = {"method": "Translation Method",
+                                  "output": "Output Options",
                                   "process": "Translation Process Options"}
 
 
@@ -15,6 +16,29 @@ def define_parser(parser):
     parser.add_argument("--port", help="port for listening request", default=44666)
     parser.add_argument("--segmenter_command", help="command to communicate with the segmenter server")
     parser.add_argument("--segmenter_format", help="format to expect from the segmenter (parse_server, morph)", default='plain')
+    parser.add_argument("--segmenter_pool_command",
+                        help="command of long-lived segmenter processes reading one sentence per line on their standard "
+                        "input, and writing its segmentation without buffering (used instead of --segmenter_command)")
+    parser.add_argument("--segmenter_pool_size", type=int, default=1,
+                        help="number of segmenter processes started with --segmenter_pool_command")
+    parser.add_argument("--segmenter_timeout", type=float, default=10,
+                        help="time in seconds after which a segmenter process started with --segmenter_pool_command "
+                        "is restarted if it did not answer")
+
+    translation_method_group = parser.add_argument_group(_CONFIG_SECTION_TO_DESCRIPTION["method"])
+    translation_method_group.add_argument("--fused_scoring", default=False, action="store_true",
+                                          help="compute the beam search scores with an in-place log-softmax instead of chainer functions")
+    translation_method_group.add_argument("--shortlist", default=False, action="store_true",
+                                          help="only consider a shortlist of target words for each sentence in beam search")
+    translation_method_group.add_argument("--shortlist_dictionary",
+                                          help="lexical probability dictionary used for the shortlist (by default, the one "
+                                          "of the model)")
+    translation_method_group.add_argument("--shortlist_nb_frequent_words", type=int, default=1000,
+                                          help="number of most frequent target words always in the shortlist")
+    translation_method_group.add_argument("--shortlist_nb_translations", type=int, default=20,
+                                          help="number of translations of each source word added to the shortlist")
+    translation_method_group.add_argument("--check_shortlist", default=False, action="store_true",
+                                          help="report how often the best word over the whole vocabulary is not in the shortlist")
 
     output_group = parser.add_argument_group(_CONFIG_SECTION_TO_DESCRIPTION["output"])
     output_group.add_argument("--tgt_fn", help="target text")
@@ -33,6 +57,25 @@ def define_parser(parser):
     management_group.add_argument("--nb_batch_to_sort", type=int, default=20, help="Sort this many batches by size.")
     management_group.add_argument("--reverse_training_config", help="prefix of the trained model")
     management_group.add_argument("--reverse_trained_model", help="prefix of the trained model")
+    management_group.add_argument("--load_exported_model", nargs="+",
+                                  help="gives a list of model files created by 'knmt utils export' to be used for translation")
+    management_group.add_argument("--numpy_inference", default=False, action="store_true",
+                                  help="run the models with the numpy inference engine instead of chainer (cpu only)")
+    management_group.add_argument("--nb_ensemble_threads", type=int, default=1,
+                                  help="number of threads running the models of an ensemble concurrently (cpu only)")
+    management_group.add_argument("--quantize_int8", default=False, action="store_true",
+                                  help="quantize the weight matrices and embeddings of the models to int8 when loading them "
+                                  "(uses the numpy inference engine, cpu only)")
+    management_group.add_argument("--encoding_cache_size", type=float, default=0,
+                                  help="maximum size in MB of the cache of encoded source sentences (0: no cache)")
+    management_group.add_argument("--server_max_batch_size", type=int, default=1,
+                                  help="translate the sentences of concurrent server requests together, in batches of at most "
+                                  "this many sentences (1: each request is translated by its own thread)")
+    management_group.add_argument("--server_batching_window", type=float, default=10,
+                                  help="time in milliseconds during which the server waits for more requests to add to a batch "
+                                  "(longer windows give larger batches and a better throughput, but a higher latency)")
+    management_group.add_argument("--server_max_batch_tokens", type=int,
+                                  help="maximum number of source words of a batch of server requests")
 
 
 def do_start_server(args):
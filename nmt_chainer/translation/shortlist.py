@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""shortlist.py: Target vocabulary shortlists for faster decoding"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import gzip
+import json
+import logging
+import operator
+
+import numpy as np
+
+from nmt_chainer.training_module.train import generate_lexical_probability_dictionary_indexed
+
+logging.basicConfig()
+log = logging.getLogger("rnns:shortlist")
+log.setLevel(logging.INFO)
+
+
+class ShortlistGenerator(object):
+    """
+        Compute the shortlist of target words to be considered when translating some source sentences.
+
+        The shortlist of a set of source sentences contains:
+            - the nb_frequent_words most frequent target words (the target indexer assigns indices by decreasing
+                frequency, so these are the words of index 0 to nb_frequent_words - 1)
+            - for each source word, its nb_translations most probable translations in the lexical probability
+                dictionary (all its translations if nb_translations is None)
+            - the indices in always_included (typically EOS and the UNK indices)
+
+        lexical_probability_dictionary should be indexed as returned by
+        training_module.train.generate_lexical_probability_dictionary_indexed. It can be None, in which case
+        the shortlist only contains the frequent words.
+    """
+
+    def __init__(self, lexical_probability_dictionary, tgt_voc_size, nb_frequent_words=1000, nb_translations=20,
+                 always_included=()):
+        self.base_words = set(xrange(min(nb_frequent_words, tgt_voc_size)))
+        self.base_words.update(always_included)
+
+        self.translations = {}
+        if lexical_probability_dictionary is not None:
+            for ws_idx, translations in lexical_probability_dictionary.iteritems():
+                sorted_translations = sorted(translations.iteritems(), key=operator.itemgetter(1), reverse=True)
+                if nb_translations is not None:
+                    sorted_translations = sorted_translations[:nb_translations]
+                self.translations[ws_idx] = [wt_idx for wt_idx, _ in sorted_translations if wt_idx < tgt_voc_size]
+
+    def __call__(self, src_sentences):
+        """
+            Return the shortlist for the list of source sentences src_sentences (each sentence being a sequence
+            of source word indices) as a sorted numpy array of int32.
+        """
+        words = set(self.base_words)
+        for src in src_sentences:
+            for ws_idx in src:
+                words.update(self.translations.get(ws_idx, ()))
+        return np.array(sorted(words), dtype=np.int32)
+
+
+def create_shortlist_generator(encdec_list, eos_idx, src_indexer, tgt_indexer, dictionary_filename=None,
+                               nb_frequent_words=1000, nb_translations=20):
+    """
+        Create a ShortlistGenerator for the models in encdec_list.
+        The lexical probability dictionary is loaded from dictionary_filename (a gzipped json file in the format of
+        the --lexical_probability_dictionary training option) if it is not None. Otherwise, the dictionary of the
+        first model trained with one is used.
+    """
+    if dictionary_filename is not None:
+        log.info("opening shortlist dictionary %s" % dictionary_filename)
+        lexical_probability_dictionary_all = json.load(gzip.open(dictionary_filename, "rb"))
+        lexical_probability_dictionary = generate_lexical_probability_dictionary_indexed(
+            lexical_probability_dictionary_all, src_indexer, tgt_indexer)
+    else:
+        lexical_probability_dictionary = None
+        for encdec in encdec_list:
+            if encdec.lexical_probability_dictionary is not None:
+                lexical_probability_dictionary = encdec.lexical_probability_dictionary
+                break
+        if lexical_probability_dictionary is None:
+            log.warn("no lexical probability dictionary for the shortlist: only using the %i most frequent words" %
+                     nb_frequent_words)
+
+    always_included = [eos_idx] + [idx for idx in xrange(len(tgt_indexer)) if tgt_indexer.is_unk_idx(idx)]
+
+    return ShortlistGenerator(lexical_probability_dictionary, eos_idx + 1, nb_frequent_words=nb_frequent_words,
+                              nb_translations=nb_translations, always_included=always_included)
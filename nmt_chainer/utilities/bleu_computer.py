@@ -195,6 +195,14 @@ def get_bc_from_files(ref_fn, trans_fn):
     return bc
 
 
+def compute_bleu(references, translations):
+    """ BleuComputer of the lists of strings references and translations """
+    bc = BleuComputer()
+    for reference, translation in izip(references, translations):
+        bc.update(reference.strip().split(" "), translation.strip().split(" "))
+    return bc
+
+
 def compute_confidence_interval_from_sampler(bleu_sampler, nb_resampling, confidence_interval=0.95):
     bleu_list = []
     for num_sample, bc in enumerate(bleu_sampler):
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""lru_cache.py: A least-recently-used cache of arrays bounded by memory size"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import collections
+import threading
+
+
+def compute_size_in_bytes(value):
+    """
+        Size in bytes of a numpy/cupy array, or of a tuple/list of arrays (other values count as 0).
+    """
+    if isinstance(value, (tuple, list)):
+        return sum(compute_size_in_bytes(v) for v in value)
+    return getattr(value, "nbytes", 0)
+
+
+class LRUCache(object):
+    """
+        A thread-safe least-recently-used cache whose values are arrays (or tuples of arrays).
+
+        max_size_in_bytes bounds the total size of the cached arrays: when adding a value makes the cache
+        larger than that, the least recently used values are evicted. A value larger than max_size_in_bytes
+        is not cached.
+
+        The counters nb_hits, nb_misses and nb_evictions are updated by get and put.
+    """
+
+    def __init__(self, max_size_in_bytes):
+        self.max_size_in_bytes = max_size_in_bytes
+        self.size_in_bytes = 0
+        self.nb_hits = 0
+        self.nb_misses = 0
+        self.nb_evictions = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """
+            Return the value cached for key (and mark it as most recently used), or None if there is none.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.nb_misses += 1
+                return None
+            self.nb_hits += 1
+            value, size = self.entries.pop(key)
+            self.entries[key] = (value, size)
+            return value
+
+    def put(self, key, value):
+        size = compute_size_in_bytes(value)
+        with self.lock:
+            if key in self.entries:
+                _, previous_size = self.entries.pop(key)
+                self.size_in_bytes -= previous_size
+            if size > self.max_size_in_bytes:
+                return
+            while self.size_in_bytes + size > self.max_size_in_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size_in_bytes -= evicted_size
+                self.nb_evictions += 1
+            self.entries[key] = (value, size)
+            self.size_in_bytes += size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size_in_bytes = 0
+
+    def make_report(self):
+        nb_requests = self.nb_hits + self.nb_misses
+        return "%i entries (%i bytes)  hits: %i/%i (%f%%)  evictions: %i" % (
+            len(self.entries), self.size_in_bytes, self.nb_hits, nb_requests,
+            (self.nb_hits * 100.0) / nb_requests if nb_requests != 0 else 0, self.nb_evictions)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""model_export.py: export a trained model to a single memory-mappable file, and load it back"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import json
+import struct
+
+import numpy as np
+from chainer import cuda
+
+from nmt_chainer.dataprocessing import processors
+from nmt_chainer.training_module import train
+from nmt_chainer.training_module import train_config
+
+import logging
+logging.basicConfig()
+log = logging.getLogger("rnns:model_export")
+log.setLevel(logging.INFO)
+
+# Layout of an exported model file:
+#   MAGIC (8 bytes)
+#   size of the header in bytes (unsigned 64 bits little-endian integer)
+#   header (utf-8 json)
+#   padding, then the arrays one after the other, each one starting on a multiple of ALIGNMENT bytes
+# The header contains the model section of the training config, the serialized preprocessing chain (as in the .voc
+# file), the indexed lexical probability dictionary (if any), and for each array its name (as in the npz files saved
+# by chainer.serializers.save_npz), shape, dtype and offset from the start of the arrays.
+# The arrays are not compressed, so that loading a model is only a np.memmap of the file: the pages of the file are
+# read lazily and shared by all the processes that load the same file.
+
+MAGIC = "KNMTEXP1"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def define_parser(parser):
+    parser.add_argument("training_config", help="prefix of the trained model")
+    parser.add_argument("trained_model", help="prefix of the trained model")
+    parser.add_argument("dest_fn", help="exported model file")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32",
+                        help="type of the exported weights (float16 halves the size of the file, but the weights "
+                        "are then converted to float32 when loading, so that their memory is not shared)")
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def iterate_named_arrays(encdec):
+    """ Yield (name, link, attribute_name) for each parameter and persistent array of encdec """
+    for link_path, link in encdec.namedlinks():
+        prefix = link_path.rstrip("/")
+        for param_name in sorted(link._params):
+            yield prefix + "/" + param_name, link, param_name
+        for persistent_name in sorted(link._persistent):
+            yield prefix + "/" + persistent_name, link, persistent_name
+
+
+def get_array(link, attribute_name):
+    value = getattr(link, attribute_name)
+    if attribute_name in link._params:
+        value = value.data
+    return cuda.to_cpu(value)
+
+
+def export_encdec(filename, encdec, model_config, bi_idx, dtype="float32"):
+    """
+        Write encdec to filename, along with model_config (the "model" section of its training config) and
+        bi_idx (its BiIndexingPrePostProcessor). The float32 arrays are stored with the given dtype.
+    """
+    dtype = np.dtype(dtype)
+    arrays = []
+    array_infos = []
+    offset = 0
+    for name, link, attribute_name in iterate_named_arrays(encdec):
+        array = get_array(link, attribute_name)
+        if not isinstance(array, np.ndarray):
+            raise NotImplementedError("cannot export the non-array value %s" % name)
+        if array.dtype == np.float32:
+            array = array.astype(dtype)
+        array = np.ascontiguousarray(array)
+        offset = align(offset)
+        array_infos.append({"name": name, "shape": list(array.shape), "dtype": array.dtype.str, "offset": offset})
+        arrays.append((offset, array))
+        offset += array.nbytes
+
+    if encdec.lexical_probability_dictionary is not None:
+        lexical_probability_dictionary = [[src_idx, sorted(tgt_probs.iteritems())]
+                                          for src_idx, tgt_probs in sorted(
+                                              encdec.lexical_probability_dictionary.iteritems())]
+    else:
+        lexical_probability_dictionary = None
+
+    model_config = dict(model_config)
+    # the lexical probability dictionary is stored already indexed
+    model_config["lexical_probability_dictionary"] = None
+
+    header = json.dumps({"format_version": FORMAT_VERSION,
+                         "model_config": model_config,
+                         "voc": bi_idx.to_serializable(),
+                         "lexical_probability_dictionary": lexical_probability_dictionary,
+                         "arrays": array_infos})
+
+    header_end = len(MAGIC) + 8 + len(header)
+    data_start = align(header_end)
+    with open(filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write("\0" * (data_start - header_end))
+        position = 0
+        for offset, array in arrays:
+            f.write("\0" * (offset - position))
+            f.write(array.tostring())
+            position = offset + array.nbytes
+
+
+def read_exported_file(filename):
+    """
+        Return the header of the exported model file filename and a dict {name: array}.
+        The arrays are read-only views of a np.memmap of the file.
+    """
+    mm = np.memmap(filename, dtype=np.uint8, mode="r")
+    if mm[:len(MAGIC)].tostring() != MAGIC:
+        raise ValueError("%s is not an exported model file" % filename)
+    header_size, = struct.unpack("<Q", mm[len(MAGIC):len(MAGIC) + 8].tostring())
+    header_end = len(MAGIC) + 8 + header_size
+    header = json.loads(mm[len(MAGIC) + 8:header_end].tostring().decode("utf8"))
+    if header["format_version"] != FORMAT_VERSION:
+        raise ValueError("unsupported format version %r in %s" % (header["format_version"], filename))
+
+    data_start = align(header_end)
+    arrays = {}
+    for array_info in header["arrays"]:
+        dtype = np.dtype(str(array_info["dtype"]))
+        shape = tuple(array_info["shape"])
+        start = data_start + array_info["offset"]
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        arrays[array_info["name"]] = np.ndarray(shape, dtype=dtype, buffer=mm, offset=start)
+        assert start + nbytes <= len(mm)
+    return header, arrays
+
+
+def create_encdec_from_exported_file(filename):
+    """
+        Load the model saved in filename by export_encdec.
+        Return encdec, eos_idx, src_indexer, tgt_indexer (as eval.create_and_load_encdec_from_files).
+        The float32 weights of encdec are read-only arrays mapped from the file.
+    """
+    log.info("loading exported model from %s" % filename)
+    header, arrays = read_exported_file(filename)
+
+    bi_idx = processors.BiIndexingPrePostProcessor.make_from_serializable(header["voc"])
+    src_indexer = bi_idx.src_processor()
+    tgt_indexer = bi_idx.tgt_processor()
+
+    encdec = train.create_encdec_from_config_dict(header["model_config"], src_indexer, tgt_indexer)
+    if header["lexical_probability_dictionary"] is not None:
+        encdec.lexical_probability_dictionary = dict(
+            (src_idx, dict((tgt_idx, prob) for tgt_idx, prob in tgt_probs))
+            for src_idx, tgt_probs in header["lexical_probability_dictionary"])
+
+    for name, link, attribute_name in iterate_named_arrays(encdec):
+        if name not in arrays:
+            raise ValueError("%s is missing from %s" % (name, filename))
+        current_value = get_array(link, attribute_name)
+        array = arrays[name]
+        if array.shape != current_value.shape:
+            raise ValueError("shape mismatch for %s in %s: %r != %r" % (name, filename, array.shape,
+                                                                         current_value.shape))
+        if array.dtype != current_value.dtype:
+            array = array.astype(current_value.dtype)
+        if attribute_name in link._params:
+            getattr(link, attribute_name).data = array
+        else:
+            setattr(link, attribute_name, array)
+
+    eos_idx = len(tgt_indexer)
+    return encdec, eos_idx, src_indexer, tgt_indexer
+
+
+def do_export(args):
+    from nmt_chainer.translation.eval import create_and_load_encdec_from_files
+    encdec, _, _, _ = create_and_load_encdec_from_files(args.training_config, args.trained_model)
+    config_training = train_config.load_config_train(args.training_config)
+    bi_idx = processors.load_pp_pair_from_file(config_training.data["voc"])
+    export_encdec(args.dest_fn, encdec, config_training["model"], bi_idx, dtype=args.dtype)
+    log.info("exported model to %s" % args.dest_fn)
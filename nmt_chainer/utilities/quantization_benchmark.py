@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""quantization_benchmark.py: compare the BLEU, speed and memory size of a model with and without int8 quantization"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import codecs
+import timeit
+from itertools import izip
+
+from nmt_chainer.dataprocessing.processors import build_dataset_one_side_pp
+from nmt_chainer.models.numpy_inference import (NumpyEncoderDecoder, compute_size_in_bytes,
+                                                compute_dequantization_buffers_size_in_bytes)
+from nmt_chainer.translation.eval import create_and_load_encdec_from_files
+from nmt_chainer.translation.evaluation import greedy_batch_translate, beam_search_translate
+from nmt_chainer.utilities.bleu_computer import compute_bleu
+
+
+def define_parser(parser):
+    parser.add_argument("training_config", help="prefix of the trained model")
+    parser.add_argument("trained_model", help="prefix of the trained model")
+    parser.add_argument("src_fn", help="source text of the dev set")
+    parser.add_argument("ref_fn", help="reference translation of the dev set")
+    parser.add_argument("--mode", choices=["beam_search", "translate"], default="beam_search")
+    parser.add_argument("--beam_width", type=int, default=12, help="beam width")
+    parser.add_argument("--beam_search_batch_size", type=int, default=1,
+                        help="number of sentences translated together by the beam search")
+    parser.add_argument("--mb_size", type=int, default=80, help="minibatch size (translate mode)")
+    parser.add_argument("--nb_steps", type=int, default=50, help="maximum length of the translations")
+    parser.add_argument("--max_nb_ex", type=int, help="only use the first MAX_NB_EX examples")
+
+
+def translate_dev_set(encdec, eos_idx, src_data, tgt_indexer, mode="beam_search", beam_width=12,
+                      beam_search_batch_size=1, mb_size=80, nb_steps=50):
+    """
+        Translate src_data with encdec (greedily if mode is "translate").
+        Return the list of translations (as strings) and the translation time in seconds.
+    """
+    start = timeit.default_timer()
+    if mode == "translate":
+        translations = greedy_batch_translate(encdec, eos_idx, src_data, batch_size=mb_size, nb_steps=nb_steps)
+    else:
+        # beam_search_translate yields a list containing the (translation, score) pair of the best translation
+        translations = [best[0][0] for best in beam_search_translate(encdec, eos_idx, src_data, beam_width=beam_width,
+                                                                     nb_steps=nb_steps,
+                                                                     beam_search_batch_size=beam_search_batch_size)]
+    translation_time = timeit.default_timer() - start
+
+    res = []
+    for t in translations:
+        if len(t) > 0 and t[-1] == eos_idx:
+            t = t[:-1]
+        res.append(tgt_indexer.deconvert(t, unk_tag="#T_UNK#"))
+    return res, translation_time
+
+
+def benchmark_quantization(encdec, eos_idx, src_data, references, tgt_indexer, **translation_kwargs):
+    """
+        Translate src_data with the chainer model encdec, with the numpy inference engine and with the int8
+        quantized numpy inference engine.
+        Return a list of tuples (name, bleu, translation_time, size_in_bytes, memory_in_bytes, translations), one
+        for each engine. size_in_bytes is the size of the weights, and memory_in_bytes also includes the buffers
+        allocated by the numpy engines during the translation (for chainer, only the weights are counted).
+    """
+    engines = [("chainer float32", encdec, sum(param.data.nbytes for param in encdec.params())),
+               ("numpy float32", NumpyEncoderDecoder(encdec), None),
+               ("numpy int8", NumpyEncoderDecoder(encdec, quantize=True), None)]
+    results = []
+    for name, model, size_in_bytes in engines:
+        shared_buffers_size = compute_dequantization_buffers_size_in_bytes()
+        translations, translation_time = translate_dev_set(model, eos_idx, src_data, tgt_indexer,
+                                                           **translation_kwargs)
+        if size_in_bytes is None:
+            size_in_bytes = compute_size_in_bytes(model)
+            memory_in_bytes = (compute_size_in_bytes(model, include_buffers=True) +
+                               compute_dequantization_buffers_size_in_bytes() - shared_buffers_size)
+        else:
+            memory_in_bytes = size_in_bytes
+        bleu = compute_bleu(references, translations).bleu()
+        results.append((name, bleu, translation_time, size_in_bytes, memory_in_bytes, translations))
+    return results
+
+
+def do_benchmark(args):
+    encdec, eos_idx, src_indexer, tgt_indexer = create_and_load_encdec_from_files(args.training_config,
+                                                                                  args.trained_model)
+    src_data, _ = build_dataset_one_side_pp(args.src_fn, src_indexer, max_nb_ex=args.max_nb_ex)
+    with codecs.open(args.ref_fn, "r", encoding="utf8") as f:
+        references = [line for line, _ in izip(f, src_data)]
+
+    results = benchmark_quantization(encdec, eos_idx, src_data, references, tgt_indexer, mode=args.mode,
+                                     beam_width=args.beam_width,
+                                     beam_search_batch_size=args.beam_search_batch_size,
+                                     mb_size=args.mb_size, nb_steps=args.nb_steps)
+
+    print "%i sentences  mode:%s" % (len(src_data), args.mode)
+    _, ref_bleu, ref_time, ref_size, _, ref_translations = results[0]
+    for name, bleu, translation_time, size_in_bytes, memory_in_bytes, translations in results:
+        nb_identical = sum(1 for t1, t2 in izip(translations, ref_translations) if t1 == t2)
+        print "%-16s BLEU %.4f (delta %+.4f)   time %.2f s (speedup x%.2f)   weights %.2f MB (x%.2f smaller)   weights+buffers %.2f MB (x%.2f smaller)   identical translations: %i/%i" % (
+            name, bleu * 100, (bleu - ref_bleu) * 100, translation_time, ref_time / translation_time,
+            size_in_bytes / (1024.0 * 1024), float(ref_size) / size_in_bytes,
+            memory_in_bytes / (1024.0 * 1024), float(ref_size) / memory_in_bytes, nb_identical, len(translations))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""scoring_benchmark.py: compare the speed of the ways of combining ensemble scores in beam search"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import timeit
+
+import numpy as np
+from chainer import cuda, Variable
+
+from nmt_chainer.translation.beam_search import combine_scores, combine_scores_fused
+
+
+def define_parser(parser):
+    parser.add_argument("--mb_size", type=int, default=20, help="number of rows (ie. beam width)")
+    parser.add_argument("--voc_size", type=int, default=50000, help="target vocabulary size")
+    parser.add_argument("--nb_models", type=int, default=2, help="number of models in the ensemble")
+    parser.add_argument("--nb_repeats", type=int, default=100, help="number of timed calls for each method")
+    parser.add_argument("--gpu", type=int, help="specify gpu number to use, if any")
+
+
+def make_logits_ensemble(xp, logits_data_list):
+    return [Variable(xp.array(logits_data), volatile="on") for logits_data in logits_data_list]
+
+
+def benchmark_scoring(logits_data_list, nb_repeats=100, gpu=None):
+    """
+        Time combine_scores and combine_scores_fused on the given list of logits arrays, for both combination modes.
+        Return a list of tuples (prob_space_combination, time_current, time_fused, max_abs_difference), where
+        the times are in seconds per call.
+    """
+    xp = np if gpu is None else cuda.cupy
+    results = []
+    for prob_space_combination in [False, True]:
+        reference = cuda.to_cpu(combine_scores(xp, make_logits_ensemble(xp, logits_data_list),
+                                               prob_space_combination=prob_space_combination))
+        fused = cuda.to_cpu(combine_scores_fused(xp, make_logits_ensemble(xp, logits_data_list),
+                                                 prob_space_combination=prob_space_combination))
+        max_abs_difference = float(np.max(np.abs(reference - fused)))
+
+        timings = []
+        for combination_function in [combine_scores, combine_scores_fused]:
+            total_time = 0
+            for _ in xrange(nb_repeats):
+                # the fused version overwrites the logits, so each call gets fresh copies (not timed)
+                logits_ensemble = make_logits_ensemble(xp, logits_data_list)
+                start = timeit.default_timer()
+                combination_function(xp, logits_ensemble, prob_space_combination=prob_space_combination)
+                if gpu is not None:
+                    cuda.Stream.null.synchronize()
+                total_time += timeit.default_timer() - start
+            timings.append(total_time / nb_repeats)
+
+        results.append((prob_space_combination, timings[0], timings[1], max_abs_difference))
+    return results
+
+
+def do_benchmark(args):
+    logits_data_list = [np.random.randn(args.mb_size, args.voc_size).astype(np.float32) * 5
+                        for _ in xrange(args.nb_models)]
+
+    with cuda.get_device(args.gpu):
+        results = benchmark_scoring(logits_data_list, nb_repeats=args.nb_repeats, gpu=args.gpu)
+
+    print "mb_size:%i voc_size:%i nb_models:%i" % (args.mb_size, args.voc_size, args.nb_models)
+    for prob_space_combination, time_current, time_fused, max_abs_difference in results:
+        print "%s combination: current %.3f ms   fused %.3f ms   speedup x%.2f   max abs difference %g" % (
+            "prob space" if prob_space_combination else "log space",
+            time_current * 1000, time_fused * 1000, time_current / time_fused, max_abs_difference)
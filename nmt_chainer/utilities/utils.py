@@ -54,6 +54,18 @@ def make_batch_src(src_data, padding_idx=0, gpu=None, volatile="off"):
         return [Variable(x, volatile=volatile) for x in src_batch], src_mask
 
 
+def compute_src_lengths_from_mask(mb_size, max_src_size, src_mask):
+    """ Recover the length of each source sentence of a minibatch from the mask returned by make_batch_src.
+        Returns a list of int (one for each sentence of the minibatch).
+    """
+    mask_offset = max_src_size - len(src_mask)
+    assert mask_offset >= 0
+    lengths = np.array([mask_offset] * mb_size, dtype=np.int32)
+    for mask_elem in src_mask:
+        lengths += cuda.to_cpu(mask_elem)
+    return [int(l) for l in lengths]
+
+
 def make_batch_src_tgt(training_data, eos_idx=1, padding_idx=0, gpu=None, volatile="off", need_arg_sort=False):
     if need_arg_sort:
         training_data_with_argsort = zip(training_data, range(len(training_data)))
@@ -3,6 +3,9 @@ from nmt_chainer.utilities import graph_training
 from nmt_chainer.utilities import replace_tgt_unk
 from nmt_chainer.utilities import expe_recap
 from nmt_chainer.utilities import bleu_computer
+from nmt_chainer.utilities import scoring_benchmark
+from nmt_chainer.utilities import quantization_benchmark
+from nmt_chainer.utilities import model_export
 
 
 def define_parser(parser):
@@ -24,11 +27,26 @@ def define_parser(parser):
                                         help="Compute BLEU score.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     bleu_computer.define_parser(bleu_parser)
 
+    bench_scoring_parser = subparsers.add_parser('bench_scoring', description="Benchmark the combination of ensemble scores in beam search.",
+                                                 help="Benchmark the combination of ensemble scores in beam search.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    scoring_benchmark.define_parser(bench_scoring_parser)
+
+    bench_quantization_parser = subparsers.add_parser('bench_quantization', description="Compare the BLEU, speed and memory size of a model with and without int8 quantization.",
+                                                      help="Compare the BLEU, speed and memory size of a model with and without int8 quantization.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    quantization_benchmark.define_parser(bench_quantization_parser)
+
+    export_parser = subparsers.add_parser('export', description="Export a trained model to a single file that can be memory-mapped by eval and server.",
+                                          help="Export a trained model to a single file that can be memory-mapped by eval and server.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    model_export.define_parser(export_parser)
+
 
 def do_utils(args):
     func = {"graph": graph_training.do_graph,
             "replace_tgt_unk": replace_tgt_unk.do_replace,
             "recap": expe_recap.do_recap,
-            "bleu": bleu_computer.do_bleu
+            "bleu": bleu_computer.do_bleu,
+            "bench_scoring": scoring_benchmark.do_benchmark,
+            "bench_quantization": quantization_benchmark.do_benchmark,
+            "export": model_export.do_export
             }[args.__sub_subcommand_name]
     func(args)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""worker_processes.py: process a list of items with forked worker processes, and get the results back in order"""
+__license__ = "undecided"
+__version__ = "1.0"
+__status__ = "Development"
+
+import ctypes
+import multiprocessing
+import Queue
+import threading
+import traceback
+
+import logging
+logging.basicConfig()
+log = logging.getLogger("rnns:worker_processes")
+log.setLevel(logging.INFO)
+
+
+def set_blas_num_threads(nb_threads):
+    """
+        Set the number of threads used by the BLAS library numpy is linked with (OpenBLAS or MKL).
+        Environment variables such as OMP_NUM_THREADS are only read when the library is loaded, so this is done by
+        calling the setter of the library directly. Return False if no known setter could be found.
+    """
+    try:
+        import numpy.core._multiarray_umath as numpy_extension
+    except ImportError:
+        import numpy.core.multiarray as numpy_extension
+    try:
+        # the symbols of the BLAS library are found through the dependencies of the numpy extension module
+        lib = ctypes.CDLL(numpy_extension.__file__)
+    except OSError:
+        return False
+    for setter_name in ("openblas_set_num_threads", "MKL_Set_Num_Threads", "mkl_set_num_threads"):
+        try:
+            setter = getattr(lib, setter_name)
+        except AttributeError:
+            continue
+        setter(ctypes.c_int(nb_threads))
+        return True
+    return False
+
+
+def map_in_worker_processes(func, items, nb_workers, nb_blas_threads=None, max_pending_items=64):
+    """
+        Generator yielding the results of func for each element of items, in the order of items.
+
+        func is a function taking an iterable of items and returning an iterable with one result for each of them
+        (eg. a generator translating sentences). nb_workers processes are forked: worker i computes func on the
+        shard items[i::nb_workers] and sends each result (which must be picklable) to this process, where the results
+        are put back in order (a result is yielded as soon as it and all the results before it are available).
+        Since the workers are forked, they share the memory of this process (eg. loaded models) until they modify it,
+        and func does not need to be picklable. Threads of this process (eg. of a ThreadPool) do not exist in the
+        workers.
+
+        items can be any iterable (eg. a generator reading a file): it is consumed lazily by a thread of this process,
+        which sends the items (which must be picklable) to the workers through queues of at most max_pending_items
+        items each. So only a bounded number of items are read in advance.
+
+        If nb_blas_threads is not None, each worker sets the number of threads of its BLAS library to this value.
+        If a worker fails, the other workers are terminated and a RuntimeError with its traceback is raised.
+    """
+    nb_workers = max(1, nb_workers)
+    results_queue = multiprocessing.Queue()
+    items_queues = [multiprocessing.Queue(max_pending_items) for _ in xrange(nb_workers)]
+    end_of_items = None
+
+    def iterate_shard(items_queue):
+        while True:
+            item = items_queue.get()
+            if item is end_of_items:
+                return
+            yield item[0]
+
+    def worker(num_worker):
+        if nb_blas_threads is not None and not set_blas_num_threads(nb_blas_threads):
+            log.warn("could not set the number of BLAS threads of worker %i" % num_worker)
+        try:
+            for num_in_shard, result in enumerate(func(iterate_shard(items_queues[num_worker]))):
+                results_queue.put(("result", num_worker + num_in_shard * nb_workers, result))
+            results_queue.put(("done", num_worker, None))
+        except Exception:
+            results_queue.put(("error", num_worker, "worker %i failed:\n%s" % (num_worker, traceback.format_exc())))
+
+    processes = [multiprocessing.Process(target=worker, args=(num_worker,)) for num_worker in xrange(nb_workers)]
+    for process in processes:
+        process.start()
+
+    # the items are sent by a thread started after the fork, so that it does not exist in the workers
+    stop_feeding = threading.Event()
+    feeding_errors = []
+
+    def put(items_queue, item):
+        while not stop_feeding.is_set():
+            try:
+                items_queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def feed_items():
+        try:
+            for num_item, item in enumerate(items):
+                # wrapped in a tuple, so that an item cannot be taken for end_of_items
+                if not put(items_queues[num_item % nb_workers], (item,)):
+                    return
+        except BaseException:
+            feeding_errors.append("reading the items failed:\n%s" % traceback.format_exc())
+        for items_queue in items_queues:
+            if not put(items_queue, end_of_items):
+                return
+
+    feeder = threading.Thread(target=feed_items)
+    feeder.daemon = True
+    feeder.start()
+
+    def get_next_message():
+        while True:
+            try:
+                return results_queue.get(timeout=1)
+            except Queue.Empty:
+                # a worker killed (eg. by a signal) cannot report its failure through the queue
+                exit_codes = [process.exitcode for process in processes]
+                if any(exit_code not in (None, 0) for exit_code in exit_codes):
+                    return "error", None, "a worker process died (exit codes: %r)" % exit_codes
+
+    reorder_buffer = {}
+    next_num_to_yield = 0
+    nb_workers_done = 0
+    try:
+        while nb_workers_done < nb_workers:
+            kind, num, result = get_next_message()
+            if kind == "error":
+                raise RuntimeError(result)
+            elif kind == "done":
+                nb_workers_done += 1
+                continue
+            reorder_buffer[num] = result
+            while next_num_to_yield in reorder_buffer:
+                yield reorder_buffer.pop(next_num_to_yield)
+                next_num_to_yield += 1
+        if len(feeding_errors) > 0:
+            raise RuntimeError(feeding_errors[0])
+        assert len(reorder_buffer) == 0
+    finally:
+        stop_feeding.set()
+        all_done = nb_workers_done == nb_workers
+        for process in processes:
+            if process.is_alive() and not all_done:
+                process.terminate()
+            process.join()
+        feeder.join()
+        if not all_done:
+            # the items still buffered for the terminated workers must not prevent this process from exiting
+            for items_queue in items_queues:
+                items_queue.cancel_join_thread()
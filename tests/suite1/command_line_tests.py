@@ -1,3 +1,4 @@
+import json
 import os.path
 import pytest
 
@@ -76,3 +77,42 @@ class TestCommandLine:
         if gpu is not None:
             args_eval += ['--gpu', gpu]
         main(arguments=args_eval)
+
+    def test_distill(self, tmpdir, gpu):
+        test_data_dir = os.path.join(
+            os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))),
+            "tests_data")
+        train_dir = tmpdir.mkdir("train")
+        data_prefix = str(train_dir.join("test1.data"))
+        train_prefix = str(train_dir.join("test1.train"))
+        data_src_file = os.path.join(test_data_dir, "src2.txt")
+        data_tgt_file = os.path.join(test_data_dir, "tgt2.txt")
+        args = 'make_data {0} {1} {2} --dev_src {0} --dev_tgt {1}'.format(
+            data_src_file, data_tgt_file, data_prefix).split(' ')
+        main(arguments=args)
+
+        args_train = ["train"] + [data_prefix, train_prefix] + "--max_nb_iters 6 --report_every 2 --mb_size 2 --Ei 10 --Eo 12 --Hi 30 --Ha 70 --Ho 15 --Hl 23".split(" ")
+        if gpu is not None:
+            args_train += ['--gpu', gpu]
+        main(arguments=args_train)
+
+        # the student training must stop by itself, or the report would never be written
+        from nmt_chainer.training_module.distillation import has_stop_criterion
+        assert not has_stop_criterion([data_prefix, train_prefix, "--Hi", "16"])
+        assert has_stop_criterion([data_prefix, train_prefix, "--config", train_prefix + '.train.config'])
+
+        distill_prefix = str(tmpdir.mkdir("distill").join("kd"))
+        args_distill = ["distill", train_prefix + '.train.config', train_prefix + '.model.best.npz', data_src_file,
+                        data_src_file, data_tgt_file, distill_prefix] +\
+            ["--additional_training_config", train_prefix + '.train.config', "--additional_trained_model", train_prefix + '.model.best_loss.npz'] +\
+            "--beam_width 3 --nb_workers 2 --keep_unk".split(" ") +\
+            ["--student_train_args", "--max_nb_iters 4 --report_every 2 --mb_size 2 --Ei 8 --Eo 8 --Hi 16 --Ha 16 --Ho 16 --Hl 8"]
+        if gpu is not None:
+            args_distill += ['--gpu', gpu]
+        main(arguments=args_distill)
+
+        with open(distill_prefix + ".distill.report.json") as f:
+            report = json.load(f)
+        assert report["teacher"]["nb_models"] == 2 and report["student"]["nb_models"] == 1
+        assert report["nb_dev_sentences"] == 40
@@ -7,6 +7,7 @@ __email__ = "fabien.cromieres@gmail.com"
 __status__ = "Development"
 
 import numpy as np
+import pytest
 import chainer
 from chainer import cuda, Function, gradient_check, Variable, optimizers, serializers
 from chainer import Link, Chain, ChainList
@@ -357,6 +358,106 @@ class TestEncoderDecoder:
 
         assert abs(total_loss_naive / total_length - float(loss.data)) < 1e-6
 
+    @pytest.mark.parametrize("attn_cls, use_goto_attention, use_lexicon, use_numpy_inference", [
+        (nmt_chainer.models.attention.AttentionModule, False, False, False),
+        (nmt_chainer.models.attention.AttentionModule, True, True, False),
+        (nmt_chainer.models.attention.DeepAttentionModule, False, False, False),
+        (nmt_chainer.models.attention.AttentionModule, False, True, True),
+        (nmt_chainer.models.attention.DeepAttentionModule, False, False, True),
+    ])
+    def test_sample_removing_finished_sentences(self, attn_cls, use_goto_attention, use_lexicon,
+                                                use_numpy_inference):
+        import nmt_chainer.translation.evaluation as evaluation
+        from nmt_chainer.models.numpy_inference import NumpyEncoderDecoder
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 29, 37, 13, 53, 7, 12, 19, 33
+        lexical_probability_dictionary = {2: {30: 0.5, 31: 0.5}, 3: {40: 1.0}} if use_lexicon else None
+        encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(
+            Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl, attn_cls=attn_cls, use_goto_attention=use_goto_attention,
+            lexical_probability_dictionary=lexical_probability_dictionary)
+        eos_idx = Vo - 1
+        model = NumpyEncoderDecoder(encdec) if use_numpy_inference else encdec
+
+        src_data = [[2, 3, 3, 4, 4, 5], [1, 3, 8, 9, 2], [5, 6], [7, 2, 2, 9, 1, 3, 3, 8], [4]]
+        nb_steps_per_sentence = [12, 3, 12, 7, 12]
+        src_batch, src_mask = utils.make_batch_src(src_data, volatile="on")
+        reference, _, reference_attn = model(src_batch, 12, src_mask, use_best_for_sample=True,
+                                             keep_attn_values=True, mode="test")
+        sequences, _, attn = model(src_batch, 12, src_mask, use_best_for_sample=True, keep_attn_values=True,
+                                   mode="test", eos_idx=eos_idx, nb_steps_per_sentence=nb_steps_per_sentence)
+        assert len(sequences) == len(attn) <= 12
+
+        nb_finished_early = 0
+        for num_sent in xrange(len(src_data)):
+            reference_translation = utils.de_batch(reference, eos_idx=eos_idx)[num_sent]
+            translation_length = min(len(reference_translation), nb_steps_per_sentence[num_sent])
+            if translation_length < len(sequences):
+                nb_finished_early += 1
+            for num_step in xrange(len(sequences)):
+                if num_step < translation_length:
+                    assert sequences[num_step][num_sent] == reference[num_step][num_sent]
+                    np.testing.assert_allclose(attn[num_step].data[num_sent], reference_attn[num_step].data[num_sent],
+                                               rtol=1e-5, atol=1e-6)
+                else:
+                    assert sequences[num_step][num_sent] == eos_idx
+                    assert not attn[num_step].data[num_sent].any()
+        assert nb_finished_early > 0
+
+        translations = evaluation.greedy_batch_translate(model, eos_idx, src_data, nb_steps=12, nb_steps_ratio=0.5)
+        for src, translation in zip(src_data, translations):
+            if translation[-1] == eos_idx:
+                translation = translation[:-1]
+            assert len(translation) <= int(len(src) * 0.5) + 1
+
+        # when EOS is always the best word, the sampling stops after the first step
+        encdec.dec.lin_o.b.data[eos_idx] = 100
+        model = NumpyEncoderDecoder(encdec) if use_numpy_inference else encdec
+        sequences, _, _ = model(src_batch, 12, src_mask, use_best_for_sample=True, mode="test", eos_idx=eos_idx)
+        assert len(sequences) == 1 and list(sequences[0]) == [eos_idx] * len(src_data)
+
+    @pytest.mark.parametrize("attn_cls, use_lexicon, use_numpy_inference", [
+        (nmt_chainer.models.attention.AttentionModule, False, False),
+        (nmt_chainer.models.attention.AttentionModule, True, False),
+        (nmt_chainer.models.attention.DeepAttentionModule, False, False),
+        (nmt_chainer.models.attention.AttentionModule, True, True),
+    ])
+    def test_nbest_rescoring(self, attn_cls, use_lexicon, use_numpy_inference):
+        from nmt_chainer.models.numpy_inference import NumpyEncoderDecoder
+        from nmt_chainer.translation.nbest_rescoring import rescore_nbest_lists
+
+        class IdentityIndexer(object):
+            def convert(self, sentence, stats=None):
+                return sentence
+
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 29, 37, 13, 53, 7, 12, 19, 33
+        lexical_probability_dictionary = {2: {30: 0.5, 31: 0.5}, 3: {40: 1.0}} if use_lexicon else None
+        encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(
+            Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl, attn_cls=attn_cls,
+            lexical_probability_dictionary=lexical_probability_dictionary)
+        eos_idx = Vo - 1
+        model = NumpyEncoderDecoder(encdec) if use_numpy_inference else encdec
+
+        src_data = [[2, 3, 3, 4, 4, 5], [1, 3, 8, 9, 2], [5, 6], [7, 2, 2, 9, 1, 3, 3, 8]]
+        nbest_lists = [(0, [[30, 40, 2], [31], [5, 6, 7, 8, 9, 10]]),
+                       (1, [[1, 2, 3, 4]]),
+                       (3, [[40, 41], [], [30, 30, 30, 30, 30, 30, 30], [12, 13]])]
+
+        # reference scores: the candidates are scored one by one
+        reference = []
+        for num_src, candidates in nbest_lists:
+            src_batch, src_mask = utils.make_batch_src([src_data[num_src]], volatile="on")
+            for candidate in candidates:
+                tgt_batch, _ = utils.make_batch_tgt([candidate], eos_idx=eos_idx, volatile="on",
+                                                    need_arg_sort=True)
+                (loss, _), _ = encdec(src_batch, tgt_batch, src_mask, raw_loss_info=True, mode="test")
+                reference.append((num_src, -float(loss.data)))
+
+        for mb_size in [1, 3, 100]:
+            results = list(rescore_nbest_lists(model, eos_idx, src_data, nbest_lists, IdentityIndexer(),
+                                               mb_size=mb_size, nb_batch_to_sort=2))
+            assert [num_src for num_src, _ in results] == [num_src for num_src, _ in reference]
+            np.testing.assert_allclose([score for _, score in results], [score for _, score in reference],
+                                       rtol=1e-5)
+
 
 class TestBeamSearch:
     def test_1(self):
@@ -378,3 +479,272 @@ class TestBeamSearch:
                                                      need_attention=False)
         res1a, res1b = next(best1_gen), next(best2_gen)
         res2a, res2b = next(best1_gen), next(best2_gen)
+
+    def test_history_coverage(self):
+        import nmt_chainer.translation.beam_search as beam_search
+        history = beam_search.BeamHistory(np, 4, 3, src_length=5, keep_attention=True, keep_coverage=True)
+        for parents, words in [([0, 0, 0], [4, 5, 6]), ([2, 0], [7, 8]), ([1, 1, 0], [9, 10, 11])]:
+            attentions = np.random.rand(len(parents), 5).astype(np.float32)
+            history.add_beam(parents, words, [0] * len(parents), attentions=attentions)
+        assert history.get_translation(3, 0) == [4, 8, 9]
+        assert history.get_translation(3, 2) == [6, 7, 11]
+        for num_hyp in xrange(3):
+            np.testing.assert_array_equal(history.get_coverage(3, num_hyp), sum(history.get_attention(3, num_hyp)))
+
+    def test_shortlist(self):
+        import nmt_chainer.translation.beam_search as beam_search
+        from nmt_chainer.translation.shortlist import ShortlistGenerator
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 29, 37, 13, 53, 7, 12, 19, 33
+        encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(
+            Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl)
+        eos_idx = Vo - 1
+
+        generator = ShortlistGenerator({2: {30: 0.5, 31: 0.3, 32: 0.2}, 3: {40: 1.0}}, Vo, nb_frequent_words=10,
+                                       nb_translations=2, always_included=[eos_idx])
+        shortlist = generator([[2, 5], [7]])
+        assert list(shortlist) == range(10) + [30, 31, eos_idx]
+
+        src_batch, src_mask = utils.make_batch_src([[2, 3, 3, 4, 5]], volatile="on")
+        full_translations = beam_search.ensemble_beam_search([encdec], src_batch, src_mask, nb_steps=10,
+                                                             eos_idx=eos_idx, beam_width=5)
+        shortlist_stats = {}
+        full_shortlist_translations = beam_search.ensemble_beam_search([encdec], src_batch, src_mask, nb_steps=10,
+                                                                       eos_idx=eos_idx, beam_width=5,
+                                                                       shortlist=np.arange(Vo),
+                                                                       shortlist_stats=shortlist_stats)
+        assert [t for t, _ in full_translations] == [t for t, _ in full_shortlist_translations]
+        for (_, score1), (_, score2) in zip(full_translations, full_shortlist_translations):
+            assert abs(score1 - score2) < 1e-5
+        assert shortlist_stats["nb_predictions"] > 0 and shortlist_stats["nb_misses"] == 0
+
+        translations = beam_search.ensemble_beam_search([encdec], src_batch, src_mask, nb_steps=10,
+                                                        eos_idx=eos_idx, beam_width=5, shortlist=shortlist)
+        for t, _ in translations:
+            assert all(w in shortlist for w in t)
+
+    def test_fused_scoring(self):
+        import nmt_chainer.translation.beam_search as beam_search
+        logits_data_list = [np.random.randn(7, 53).astype(np.float32) * 5 for _ in xrange(3)]
+        for prob_space_combination in [False, True]:
+            reference = beam_search.combine_scores(
+                np, [Variable(logits_data.copy()) for logits_data in logits_data_list],
+                prob_space_combination=prob_space_combination)
+            fused = beam_search.combine_scores_fused(
+                np, [Variable(logits_data.copy()) for logits_data in logits_data_list],
+                prob_space_combination=prob_space_combination)
+            assert fused.dtype == np.float32
+            np.testing.assert_allclose(fused, reference, rtol=1e-5, atol=1e-5)
+
+    def test_encoding_cache(self):
+        import nmt_chainer.translation.beam_search as beam_search
+        from nmt_chainer.utilities.lru_cache import LRUCache
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 29, 37, 13, 53, 7, 12, 19, 33
+        encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(
+            Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl)
+        eos_idx = Vo - 1
+        src_batch, src_mask = utils.make_batch_src([[2, 3, 3, 4, 5]], volatile="on")
+        reference = beam_search.ensemble_beam_search([encdec], src_batch, src_mask, nb_steps=10,
+                                                     eos_idx=eos_idx, beam_width=5)
+        encdec.encoding_cache = LRUCache(1024 * 1024)
+        for _ in xrange(2):
+            translations = beam_search.ensemble_beam_search([encdec], src_batch, src_mask, nb_steps=10,
+                                                            eos_idx=eos_idx, beam_width=5)
+            assert translations == reference
+        assert encdec.encoding_cache.nb_misses == 1 and encdec.encoding_cache.nb_hits == 1
+
+    def test_length_sorted_streaming(self):
+        import nmt_chainer.translation.evaluation as evaluation
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 29, 37, 13, 53, 7, 12, 19, 33
+        encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(
+            Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl)
+        eos_idx = Vo - 1
+        src_data = [[2, 3, 3, 4, 4, 5], [1, 3], [8, 9, 2, 7, 1, 1, 3, 2], [5], [4, 4, 6], [9, 2, 3, 1]]
+
+        groups = list(evaluation.iterate_length_sorted_groups(iter(src_data), 2, 2))
+        assert [[num_ex for num_ex, _ in group] for group in groups] == [[3, 1], [0, 2], [4, 5]]
+
+        reference = list(evaluation.beam_search_translate(encdec, eos_idx, src_data, beam_width=5, nb_steps=10))
+        sorted_translations = list(evaluation.beam_search_translate(
+            encdec, eos_idx, iter(src_data), beam_width=5, nb_steps=10, beam_search_batch_size=2, nb_batch_to_sort=2))
+        assert len(sorted_translations) == len(src_data)
+        for translations1, translations2 in zip(reference, sorted_translations):
+            assert translations1[0][0] == translations2[0][0]
+
+    def test_ensemble_pool(self):
+        from multiprocessing.pool import ThreadPool
+        import nmt_chainer.translation.beam_search as beam_search
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 29, 37, 13, 53, 7, 12, 19, 33
+        model_ensemble = [nmt_chainer.models.encoder_decoder.EncoderDecoder(Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl)
+                          for _ in xrange(3)]
+        eos_idx = Vo - 1
+        src_batch, src_mask = utils.make_batch_src([[2, 3, 3, 4, 5], [1, 3, 8], [5, 6, 2, 2]], volatile="on")
+        ensemble_pool = ThreadPool(3)
+        reference = beam_search.ensemble_beam_search_batch(model_ensemble, src_batch, src_mask, nb_steps=10,
+                                                           eos_idx=eos_idx, beam_width=5)
+        translations = beam_search.ensemble_beam_search_batch(model_ensemble, src_batch, src_mask, nb_steps=10,
+                                                              eos_idx=eos_idx, beam_width=5,
+                                                              ensemble_pool=ensemble_pool)
+        assert [[t[0] for t in sent_translations] for sent_translations in translations] == \
+            [[t[0] for t in sent_translations] for sent_translations in reference]
+        ensemble_pool.close()
+
+    def test_batch_reverse_rescoring(self):
+        from multiprocessing.pool import ThreadPool
+        import nmt_chainer.translation.evaluation as evaluation
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 29, 37, 13, 53, 7, 12, 19, 33
+        encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl)
+        reverse_encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl)
+        eos_idx = Vo - 1
+        src_data = [[2, 3, 3, 4, 4, 5], [1, 3], [8, 9, 2, 7, 1, 1, 3, 2], [5], [4, 4, 6], [9, 2, 3, 1]]
+
+        translations_list = [[([4, 5, 6, eos_idx], -1.0), ([7], -2.0), ([8, 8, 9, 10, 11], -3.0)],
+                             [([12, 13], -0.5)],
+                             [([30, 31, 32, eos_idx], -1.5), ([33, 34], -2.5)]]
+        reverse_scores_list = evaluation.batch_reverse_rescore(reverse_encdec, eos_idx, src_data[:3],
+                                                               translations_list, mb_size=2)
+        assert reverse_scores_list[1] is None
+        for num_src in [0, 2]:
+            src_batch, src_mask = utils.make_batch_src([src_data[num_src]], volatile="on")
+            reference = evaluation.reverse_rescore(reverse_encdec, src_batch, src_mask, eos_idx,
+                                                   [t for t, _ in translations_list[num_src]])
+            np.testing.assert_allclose(reverse_scores_list[num_src], reference, rtol=1e-5)
+
+        reference = list(evaluation.beam_search_translate(encdec, eos_idx, src_data, beam_width=5, nb_steps=10,
+                                                          reverse_encdec=reverse_encdec, reverse_rescoring_window=1,
+                                                          reverse_rescoring_mb_size=1))
+        reverse_rescoring_pool = ThreadPool(1)
+        translations = list(evaluation.beam_search_translate(encdec, eos_idx, iter(src_data), beam_width=5,
+                                                             nb_steps=10, reverse_encdec=reverse_encdec,
+                                                             reverse_rescoring_window=4, reverse_rescoring_mb_size=3,
+                                                             reverse_rescoring_pool=reverse_rescoring_pool))
+        reverse_rescoring_pool.close()
+        assert len(translations) == len(src_data)
+        for translations1, translations2 in zip(reference, translations):
+            assert translations1[0][0] == translations2[0][0]
+
+
+class TestNumpyInference:
+    @pytest.mark.parametrize("cell_type, attn_cls, use_goto_attention", [
+        ("lstm", nmt_chainer.models.attention.AttentionModule, False),
+        ("gru", nmt_chainer.models.attention.AttentionModule, True),
+        ("slow_gru", nmt_chainer.models.attention.DeepAttentionModule, False),
+        ("stack,sub_cell_type:gru,nb_stacks:3,residual_connection:1,no_residual_connection_on_input:1",
+         nmt_chainer.models.attention.AttentionModule, False),
+        ("stack,nb_stacks:2", nmt_chainer.models.attention.DeepAttentionModule, False),
+    ])
+    def test_same_results(self, cell_type, attn_cls, use_goto_attention):
+        import nmt_chainer.models.rnn_cells as rnn_cells
+        import nmt_chainer.translation.evaluation as evaluation
+        from nmt_chainer.models.numpy_inference import NumpyEncoderDecoder
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 29, 37, 13, 53, 7, 12, 19, 33
+        cell_model = rnn_cells.create_cell_model_from_string(cell_type)
+        encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(
+            Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl, attn_cls=attn_cls, encoder_cell_type=cell_model,
+            decoder_cell_type=cell_model, use_goto_attention=use_goto_attention)
+        numpy_encdec = NumpyEncoderDecoder(encdec)
+        eos_idx = Vo - 1
+
+        src_data = [[2, 3, 3, 4, 4, 5], [1, 3, 8, 9, 2], [5, 6]]
+        src_batch, src_mask = utils.make_batch_src(src_data, volatile="on")
+        np.testing.assert_allclose(numpy_encdec.encode(src_batch, src_mask),
+                                   encdec.enc(src_batch, src_mask, mode="test").data, rtol=1e-5, atol=1e-5)
+
+        tgt_batch = utils.make_batch_tgt([[4, 5, 6], [7, 8], [9]], eos_idx=eos_idx, volatile="on")
+        (loss, nb_predictions), _ = encdec(src_batch, tgt_batch, src_mask, raw_loss_info=True)
+        (numpy_loss, numpy_nb_predictions), _ = numpy_encdec(src_batch, tgt_batch, src_mask, raw_loss_info=True)
+        assert numpy_nb_predictions == nb_predictions
+        np.testing.assert_allclose(numpy_loss.data, loss.data, rtol=1e-5)
+
+        assert (evaluation.greedy_batch_translate(numpy_encdec, eos_idx, src_data, nb_steps=10) ==
+                evaluation.greedy_batch_translate(encdec, eos_idx, src_data, nb_steps=10))
+
+        def nbest_translations(model, **kwargs):
+            return [[translation[0] for translation in translations] for translations in
+                    evaluation.beam_search_translate(model, eos_idx, src_data, beam_width=5, nb_steps=10, nbest=5,
+                                                     **kwargs)]
+
+        numpy_translations = nbest_translations(numpy_encdec)
+        assert nbest_translations(numpy_encdec, beam_search_batch_size=3) == numpy_translations
+        # early stopping would cut the nbest lists: it is ignored
+        assert nbest_translations(numpy_encdec, early_stopping=True) == numpy_translations
+        if attn_cls is nmt_chainer.models.attention.AttentionModule:
+            # DeepAttentionModule has no demux mode, so it cannot be used for beam search with chainer
+            assert nbest_translations(encdec) == numpy_translations
+
+    @pytest.mark.parametrize("cell_type", ["lstm", "gru", "slow_gru", "stack,nb_stacks:2"])
+    def test_quantized(self, cell_type):
+        import nmt_chainer.models.rnn_cells as rnn_cells
+        from nmt_chainer.models.numpy_inference import NumpyEncoderDecoder, compute_size_in_bytes
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 290, 37, 30, 530, 31, 40, 19, 33
+        cell_model = rnn_cells.create_cell_model_from_string(cell_type)
+        encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(
+            Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl, encoder_cell_type=cell_model, decoder_cell_type=cell_model)
+        numpy_encdec = NumpyEncoderDecoder(encdec)
+        quantized_encdec = NumpyEncoderDecoder(encdec, quantize=True)
+        assert compute_size_in_bytes(quantized_encdec) < 0.3 * compute_size_in_bytes(numpy_encdec)
+
+        src_data = [[2, 3, 3, 4, 4, 5], [1, 3, 8, 9, 2], [5, 6]]
+        src_batch, src_mask = utils.make_batch_src(src_data, volatile="on")
+        np.testing.assert_allclose(quantized_encdec.encode(src_batch, src_mask),
+                                   numpy_encdec.encode(src_batch, src_mask), atol=5e-2)
+
+        tgt_batch = utils.make_batch_tgt([[4, 5, 6], [7, 8], [9]], eos_idx=Vo - 1, volatile="on")
+        (loss, _), _ = numpy_encdec(src_batch, tgt_batch, src_mask, raw_loss_info=True)
+        (quantized_loss, _), _ = quantized_encdec(src_batch, tgt_batch, src_mask, raw_loss_info=True)
+        np.testing.assert_allclose(quantized_loss.data, loss.data, rtol=1e-2)
+
+    def test_quantized_linear(self):
+        from nmt_chainer.models.numpy_inference import QuantizedLinear, compute_size_in_bytes
+        random_state = np.random.RandomState(42)
+        W = random_state.randn(300, 20).astype(np.float32)
+        W[3] = 0
+        b = random_state.randn(300).astype(np.float32)
+        x = random_state.randn(4, 20).astype(np.float32)
+        linear = QuantizedLinear.quantize(W, b)
+        y = linear(x)
+        # each weight is rounded to the nearest multiple of the scale of its row
+        max_error = np.abs(x).sum(axis=1)[:, None] * linear.scale[None, :] / 2
+        assert np.all(np.abs(y - (np.dot(x, W.T) + b)) <= max_error + 1e-4)
+        np.testing.assert_allclose(linear.select_rows([5, 3, 7])(x), y[:, [5, 3, 7]], rtol=1e-5, atol=1e-5)
+        linear.chunk_size = 16
+        np.testing.assert_allclose(linear(x), y, rtol=1e-5, atol=1e-5)
+        linear.chunk_size = 1000
+        np.testing.assert_allclose(linear(x), y, rtol=1e-5, atol=1e-5)
+        # no float32 copy of the weights is kept by the layer
+        assert compute_size_in_bytes(linear, include_buffers=True) == W.size + linear.scale.nbytes + b.nbytes
+
+    @pytest.mark.parametrize("cell_type", ["lstm", "gru"])
+    def test_numpy_encdec_multithreaded(self, cell_type):
+        import threading
+        import nmt_chainer.models.rnn_cells as rnn_cells
+        import nmt_chainer.translation.evaluation as evaluation
+        from nmt_chainer.models.numpy_inference import NumpyEncoderDecoder
+        Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl = 29, 37, 30, 53, 31, 40, 19, 33
+        cell_model = rnn_cells.create_cell_model_from_string(cell_type)
+        encdec = nmt_chainer.models.encoder_decoder.EncoderDecoder(
+            Vi, Ei, Hi, Vo, Eo, Ho, Ha, Hl, encoder_cell_type=cell_model, decoder_cell_type=cell_model)
+        numpy_encdec = NumpyEncoderDecoder(encdec)
+        eos_idx = Vo - 1
+
+        # each thread translates sentences of different lengths with the same model
+        all_src_data = [[[2, 3, 3, 4, 4, 5], [1, 3, 8, 9, 2]], [[5, 6]], [[7, 1, 2, 8, 9, 10, 11, 3, 2]],
+                        [[4, 4], [6, 7, 8], [9, 10, 11, 12]], [[13]], [[3, 5, 7, 9, 11, 13, 15, 17]]]
+
+        def translate(src_data):
+            return [translation[0] for translation in
+                    evaluation.beam_search_translate(numpy_encdec, eos_idx, src_data, beam_width=3, nb_steps=12)]
+
+        expected_translations = [translate(src_data) for src_data in all_src_data]
+        results = [[] for _ in all_src_data]
+
+        def run(thread_num):
+            for _ in range(5):
+                results[thread_num].append(translate(all_src_data[thread_num]))
+
+        threads = [threading.Thread(target=run, args=(thread_num,)) for thread_num in range(len(all_src_data))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for thread_num in range(len(all_src_data)):
+            assert results[thread_num] == [expected_translations[thread_num]] * 5
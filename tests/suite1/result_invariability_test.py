@@ -70,6 +70,50 @@ class TestResultInvariability:
             "--mode beam_search --beam_width 30"),
         ("result_invariability_untrained_with_lex_prob_dict", "beam_search",
             "--mode beam_search --beam_width 30"),
+        ("result_invariability", "beam_search",
+            "--mode beam_search --beam_width 30 --beam_search_batch_size 4"),
+        ("result_invariability_untrained", "beam_search",
+            "--mode beam_search --beam_width 30 --beam_search_batch_size 4"),
+        ("result_invariability_untrained", "beam_search_and_google_options_2",
+            "--mode beam_search --beam_width 30 "
+            "--beam_pruning_margin 1.5 "
+            "--beam_score_coverage_penalty google --beam_score_coverage_penalty_strength 0.3 "
+            "--beam_score_length_normalization google --beam_score_length_normalization_strength 0.25 "
+            "--post_score_coverage_penalty google --post_score_coverage_penalty_strength 0.4 "
+            "--post_score_length_normalization google --post_score_length_normalization_strength 0.33 "
+            "--beam_search_batch_size 4"),
+        ("result_invariability_with_lex_prob_dict", "beam_search",
+            "--mode beam_search --beam_width 30 --beam_search_batch_size 4"),
+        ("result_invariability", "beam_search",
+            "--mode beam_search --beam_width 30 --early_stopping"),
+        ("result_invariability_untrained", "beam_search",
+            "--mode beam_search --beam_width 30 --early_stopping --beam_search_batch_size 4"),
+        ("result_invariability_with_lex_prob_dict", "beam_search",
+            "--mode beam_search --beam_width 30 --early_stopping --beam_search_batch_size 4"),
+        ("result_invariability_with_lex_prob_dict", "beam_search",
+            "--mode beam_search --beam_width 30 --shortlist --shortlist_nb_frequent_words 100000"),
+        ("result_invariability", "beam_search",
+            "--mode beam_search --beam_width 30 --fused_scoring"),
+        ("result_invariability_untrained", "beam_search_and_prob_space_combination",
+            "--mode beam_search --beam_width 30 "
+            "--prob_space_combination --fused_scoring"),
+        ("result_invariability", "beam_search",
+            "--mode beam_search --beam_width 30 --beam_search_batch_size 3 --nb_batch_to_sort 4 --stream_src"),
+        ("result_invariability_untrained", "beam_search",
+            "--mode beam_search --beam_width 30 --stream_src"),
+        ("result_invariability", "beam_search",
+            "--mode beam_search --beam_width 30 --numpy_inference"),
+        ("result_invariability_untrained", "greedy_search",
+            "--mode translate --numpy_inference"),
+        ("result_invariability_with_lex_prob_dict", "beam_search",
+            "--mode beam_search --beam_width 30 --numpy_inference --beam_search_batch_size 4"),
+        ("result_invariability", "beam_search",
+            "--mode beam_search --beam_width 30 --nb_workers 3 --nb_blas_threads 1"),
+        ("result_invariability_untrained", "ensemble_search",
+            "--mode beam_search --beam_width 30 "
+            "--additional_training_config tests/tests_data/models/result_invariability_untrained.train.train.config "
+            "--additional_trained_model tests/tests_data/models/result_invariability_untrained.train.model.best_loss.npz "
+            "--nb_workers 2 --nb_ensemble_threads 2"),
     ])
     def test_eval_result_invariability(self, tmpdir, gpu, model_name, variant_name, variant_options):
         """
@@ -106,6 +150,90 @@ class TestResultInvariability:
 
         assert(actual_translations == expected_translations)
 
+    @pytest.mark.parametrize("model_name, export_options", [
+        ("result_invariability", ""),
+        ("result_invariability_untrained", "--dtype float32"),
+        ("result_invariability_with_lex_prob_dict", ""),
+    ])
+    def test_exported_model_result_invariability(self, tmpdir, gpu, model_name, export_options):
+        """
+        Export a preexisting model with 'knmt utils export' and check that translating with the exported
+        file gives the same results as with the original model.
+        """
+        test_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tests_data")
+        data_src_file = os.path.join(test_data_dir, "src2.txt")
+        train_prefix = os.path.join(test_data_dir, "models", "{0}.train".format(model_name))
+        work_dir = tmpdir.mkdir("export")
+        exported_model_file = os.path.join(str(work_dir), "{0}.knmt".format(model_name))
+        search_file = os.path.join(str(work_dir), "translations_using_beam_search.txt")
+
+        args_export = [train_prefix + '.train.config', train_prefix + '.model.best.npz', exported_model_file]
+        if export_options:
+            args_export += export_options.split(' ')
+        main(arguments=["utils", "export"] + args_export)
+
+        args_eval_search = ['--load_exported_model', exported_model_file, '--src_fn', data_src_file,
+                            '--dest_fn', search_file, '--mode', 'beam_search', '--beam_width', '30']
+        if gpu is not None:
+            args_eval_search += ['--gpu', gpu]
+        main(arguments=["eval"] + args_eval_search)
+
+        with open(os.path.join(test_data_dir, "models/{0}.translations_using_beam_search.txt".format(model_name))) as f:
+            expected_translations = f.readlines()
+        with open(search_file) as f:
+            actual_translations = f.readlines()
+
+        assert(actual_translations == expected_translations)
+
+    @pytest.mark.parametrize("model_name, delete_progress_file", [
+        ("result_invariability", False),
+        ("result_invariability", True),
+    ])
+    def test_resume_result_invariability(self, tmpdir, gpu, model_name, delete_progress_file):
+        """
+        Simulate a translation interrupted in the middle of a sentence and check that resuming it with --resume
+        gives the same outputs as an uninterrupted translation.
+        """
+        test_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../tests_data")
+        data_src_file = os.path.join(test_data_dir, "src2.txt")
+        train_prefix = os.path.join(test_data_dir, "models", "{0}.train".format(model_name))
+        work_dir = tmpdir.mkdir("resume")
+        search_file = os.path.join(str(work_dir), "translations_using_beam_search.txt")
+        rich_output_file = search_file + ".json"
+        expected_rich_output_file = os.path.join(str(work_dir), "expected.json")
+
+        args_eval_search = [train_prefix + '.train.config', train_prefix + '.model.best.npz', data_src_file,
+                            search_file, '--mode', 'beam_search', '--beam_width', '30']
+        if gpu is not None:
+            args_eval_search += ['--gpu', gpu]
+
+        main(arguments=["eval"] + args_eval_search + ['--rich_output_filename', expected_rich_output_file])
+        with open(expected_rich_output_file) as f:
+            expected_rich_output = f.read()
+
+        main(arguments=["eval"] + args_eval_search + ['--rich_output_filename', rich_output_file,
+                                                      '--max_nb_ex', '7'])
+        with open(search_file, "a") as f:
+            f.write("partially written")
+        with open(rich_output_file) as f:
+            rich_output = f.read()
+        with open(rich_output_file, "w") as f:
+            f.write(rich_output[:-100])
+        if delete_progress_file:
+            os.remove(search_file + ".progress")
+
+        main(arguments=["eval"] + args_eval_search + ['--rich_output_filename', rich_output_file, '--resume'])
+
+        with open(os.path.join(test_data_dir, "models/{0}.translations_using_beam_search.txt".format(model_name))) as f:
+            expected_translations = f.readlines()
+        with open(search_file) as f:
+            actual_translations = f.readlines()
+        with open(rich_output_file) as f:
+            actual_rich_output = f.read()
+
+        assert(actual_translations == expected_translations)
+        assert(actual_rich_output == expected_rich_output)
+
     @pytest.mark.parametrize("model_name, options", [
         ("result_invariability", "--max_nb_iters 2000 --mb_size 2 --Ei 5 --Eo 12 --Hi 6 --Ha 70 --Ho 15 --Hl 12"),
         ("result_invariability_untrained", "--max_nb_iters 800 --mb_size 2 --Ei 5 --Eo 12 --Hi 6 --Ha 70 --Ho 15 --Hl 12"),
@@ -55,6 +55,18 @@ class TestServer:
             resp = client.query("les lunettes sont rouges")
             print "resp={0}".format(resp)
             resp_json = json.loads(resp)
+
+            sentences = ["les lunettes sont rouges", "les lunettes"]
+            resp_article_json = json.loads(client.query_article(sentences, first_sentence_id=5))
+            resp_sentences_json = [json.loads(client.query(sentence)) for sentence in sentences]
+
+            keep_alive_client = Client('127.0.0.1', 45766, keep_alive=True)
+            try:
+                resp_keep_alive_json = json.loads(keep_alive_client.query("les lunettes sont rouges"))
+                resp_pipelined_json = [json.loads(resp) for resp in keep_alive_client.query_articles(
+                    [[sentence] for sentence in sentences] + [sentences])]
+            finally:
+                keep_alive_client.close()
         finally:
             parent = psutil.Process(server_process.pid)
             children = parent.children(recursive=True)
@@ -63,3 +75,264 @@ class TestServer:
             server_process.terminate()
 
         assert(resp_json['out'] == "die Brille sind rot\n")
+
+        assert resp_article_json['sentence_numbers'] == ["5", "6"]
+        assert resp_article_json['out'] == "".join(r['out'] for r in resp_sentences_json)
+        assert resp_article_json['segmented_output'] == [r['out'] for r in resp_sentences_json]
+        assert len(resp_article_json['attn_graphes']) == 2
+
+        assert resp_keep_alive_json['out'] == resp_json['out']
+        assert [r['out'] for r in resp_pipelined_json] == [r['out'] for r in resp_sentences_json] + [resp_article_json['out']]
+
+    def test_translate_sentence_in_memory(self, gpu):
+        """
+        Test the in-memory translation API used by the server.
+        """
+        import argparse
+        import nmt_chainer.translation.eval_config as eval_config
+        test_data_dir = os.path.abspath(os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            "../tests_data"))
+        config_file = os.path.join(str(test_data_dir), "models/result_invariability.train.train.config")
+        model_file = os.path.join(str(test_data_dir), "models/result_invariability.train.model.best.npz")
+        parser = argparse.ArgumentParser()
+        eval_config.define_parser(parser)
+        args = ["--server", "127.0.0.1:45767", "--mode", "beam_search", config_file, model_file]
+        if gpu is not None:
+            args += ["--gpu", gpu]
+        translator = server.Translator(eval_config.make_config_eval(parser.parse_args(args)))
+
+        translation, score, unk_mapping, attention = translator.translate_sentence(u"les lunettes sont rouges")
+        assert translation == "die Brille sind rot"
+        assert score < 0
+        assert unk_mapping == []
+        assert attention is None
+
+        translation2, score2, _, (src_words, tgt_words, attn) = translator.translate_sentence(
+            u"les lunettes sont rouges", need_attention=True)
+        assert (translation2, score2) == (translation, score)
+        assert src_words == u"les lunettes sont rouges".split(" ")
+        assert len(attn) == len(tgt_words) and len(attn[0]) == len(src_words)
+
+    def test_translate_sentences_batched(self, gpu):
+        """
+        Test that translating several sentences in one batch gives the same translations as one at a time.
+        """
+        import argparse
+        import nmt_chainer.translation.eval_config as eval_config
+        test_data_dir = os.path.abspath(os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            "../tests_data"))
+        config_file = os.path.join(str(test_data_dir), "models/result_invariability.train.train.config")
+        model_file = os.path.join(str(test_data_dir), "models/result_invariability.train.model.best.npz")
+        parser = argparse.ArgumentParser()
+        eval_config.define_parser(parser)
+        args = ["--server", "127.0.0.1:45767", "--mode", "beam_search", config_file, model_file]
+        if gpu is not None:
+            args += ["--gpu", gpu]
+        translator = server.Translator(eval_config.make_config_eval(parser.parse_args(args)))
+
+        sentences = [u"les lunettes sont rouges", u"le chat est noir .", u"les lunettes"]
+        results = translator.translate_sentences(sentences, beam_width=5)
+        assert len(results) == len(sentences)
+        for sentence, (translation, score, unk_mapping, attention) in zip(sentences, results):
+            translation1, score1, unk_mapping1, _ = translator.translate_sentence(sentence, beam_width=5)
+            assert translation == translation1
+            assert abs(score - score1) < 1e-4
+            assert unk_mapping == unk_mapping1
+            assert attention is None
+
+
+class TestBatchingScheduler:
+
+    def test_batching(self):
+        import threading
+        from nmt_chainer.translation.batching_scheduler import BatchingScheduler
+        calls = []
+
+        def translate_batch(sentences, params, need_attention):
+            calls.append((list(sentences), params, need_attention))
+            return [(sentence.upper(), params["beam_width"], "attn") for sentence in sentences]
+
+        scheduler = BatchingScheduler(translate_batch, max_batch_size=4, batching_window=0.5)
+        requests = [("s%i" % i, {"beam_width": 5 if i % 2 == 0 else 10}, i == 0) for i in range(6)]
+        results = [None] * len(requests)
+
+        def submit(num_request):
+            sentence, params, need_attention = requests[num_request]
+            results[num_request] = scheduler.translate(sentence, params, need_attention=need_attention)
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for (sentence, params, need_attention), result in zip(requests, results):
+            assert result == (sentence.upper(), params["beam_width"], "attn" if need_attention else None)
+        assert scheduler.nb_requests == 6
+        assert scheduler.nb_batches < 6
+        for sentences, params, _ in calls:
+            assert all(requests[int(s[1:])][1] == params for s in sentences)
+            assert len(sentences) <= 4
+        assert sorted(s for sentences, _, _ in calls for s in sentences) == sorted(s for s, _, _ in requests)
+
+    def test_max_batch_tokens(self):
+        from nmt_chainer.translation.batching_scheduler import BatchingScheduler, TranslationRequest
+        calls = []
+
+        def translate_batch(sentences, params, need_attention):
+            calls.append(list(sentences))
+            return [(sentence, None) for sentence in sentences]
+
+        scheduler = BatchingScheduler(translate_batch, max_batch_size=10, batching_window=0.5, max_batch_tokens=5)
+        requests = [TranslationRequest(sentence, {}, False) for sentence in ["a b c", "d e", "f g", "h"]]
+        for request in requests:
+            scheduler.queue.put(request)
+        for request in requests:
+            request.done.wait(10)
+        assert calls == [["a b c", "d e"], ["f g", "h"]]
+        assert [request.result for request in requests] == [("a b c", None), ("d e", None), ("f g", None), ("h", None)]
+
+    def test_failure(self):
+        from nmt_chainer.translation.batching_scheduler import BatchingScheduler
+
+        def translate_batch(sentences, params, need_attention):
+            raise ValueError("failed batch")
+
+        scheduler = BatchingScheduler(translate_batch, max_batch_size=4, batching_window=0)
+        with pytest.raises(ValueError):
+            scheduler.translate("a", {})
+        assert scheduler.nb_requests == 1
+
+
+class TestSegmenterPool:
+
+    def test_parse_segmenter_output(self):
+        from nmt_chainer.translation.segmenter_pool import parse_segmenter_output
+        assert parse_segmenter_output("a b c", "plain") == ["a", "b", "c"]
+        assert parse_segmenter_output("a_N b_V ", "morph") == ["a", "b"]
+        assert parse_segmenter_output("# S-ID:1\n1\tx\ta\n2\ty\tb\n\n3\tz\tc\n", "parse_server") == ["a", "b"]
+
+    def test_segment(self):
+        from nmt_chainer.translation.segmenter_pool import SegmenterPool
+        pool = SegmenterPool("cat", "plain", nb_processes=2)
+        try:
+            assert pool.segment("a b c") == "a b c\n"
+            assert pool.segment(u"\u00e9t\u00e9") == u"\u00e9t\u00e9\n".encode("utf-8")
+        finally:
+            pool.close()
+
+        pool = SegmenterPool("sed -u 's/ /\\n/g; s/$/\\n/'", "parse_server")
+        try:
+            assert pool.segment("a b") == "a\nb\n\n"
+            assert pool.segment("c") == "c\n\n"
+        finally:
+            pool.close()
+
+    def test_restart(self):
+        from nmt_chainer.translation.segmenter_pool import SegmenterPool, SegmenterTimeout
+        # the process terminates after each sentence: it is restarted and the sentence is segmented again
+        pool = SegmenterPool("head -n 1", "plain")
+        try:
+            assert pool.segment("a b") == "a b\n"
+            assert pool.segment("c d") == "c d\n"
+        finally:
+            pool.close()
+
+        pool = SegmenterPool("sleep 10", "plain", timeout=0.2)
+        try:
+            with pytest.raises(SegmenterTimeout):
+                pool.segment("a b")
+            process = pool.idle_processes.get()
+            assert process.process.poll() is None
+            pool.idle_processes.put(process)
+        finally:
+            pool.close()
+
+
+class TestFraming:
+
+    def test_messages(self):
+        import socket
+        import threading
+        from nmt_chainer.translation.framing import send_message, receive_message
+        sock1, sock2 = socket.socketpair()
+        try:
+            large_message = "x" * (1024 * 1024)
+            send_message(sock1, "<article/>")
+            send_message(sock1, "")
+            send_message(sock1, u"\u00e9t\u00e9")
+            # sent by another thread, as it does not fit in the socket buffers
+            sender = threading.Thread(target=send_message, args=(sock1, large_message))
+            sender.start()
+            assert receive_message(sock2) == "<article/>"
+            assert receive_message(sock2) == ""
+            assert receive_message(sock2) == u"\u00e9t\u00e9".encode("utf-8")
+            assert receive_message(sock2) == large_message
+            sender.join()
+            sock1.close()
+            assert receive_message(sock2) is None
+        finally:
+            sock1.close()
+            sock2.close()
+
+    def test_truncated_message(self):
+        import socket
+        from nmt_chainer.translation.framing import receive_message, FramingError, is_legacy_request
+        sock1, sock2 = socket.socketpair()
+        try:
+            sock1.sendall("\x00\x00\x00\x10abc")
+            sock1.close()
+            with pytest.raises(FramingError):
+                receive_message(sock2)
+        finally:
+            sock2.close()
+        assert is_legacy_request("<")
+        assert not is_legacy_request("\x00")
+
+    def test_length_prefix_is_not_legacy(self):
+        import socket
+        import string
+        from nmt_chainer.translation.framing import (receive_message, FramingError, is_legacy_request,
+                                                     LENGTH_PREFIX, MAX_MESSAGE_SIZE)
+        for size in [0, 1, 0x7ffffff, MAX_MESSAGE_SIZE]:
+            assert not is_legacy_request(LENGTH_PREFIX.pack(size)[0])
+        for first_byte in string.whitespace:
+            assert is_legacy_request(first_byte)
+        # a prefix starting with 0x09 (a tab) would be taken for a legacy request: it cannot be a valid size
+        sock1, sock2 = socket.socketpair()
+        try:
+            sock1.sendall(LENGTH_PREFIX.pack(0x09000000))
+            with pytest.raises(FramingError):
+                receive_message(sock2)
+        finally:
+            sock1.close()
+            sock2.close()
+
+    def test_legacy_request(self):
+        import socket
+        from nmt_chainer.translation.framing import receive_legacy_request
+        # the reading stops at the end of the document, even if the client keeps the connection open
+        for request in ['<?xml version="1.0" encoding="utf-8"?>\n<article id="1"><sentence id="1">'
+                        '<i_sentence>a &lt;b&gt;</i_sentence></sentence></article>',
+                        '<other_root/>']:
+            sock1, sock2 = socket.socketpair()
+            try:
+                sock1.sendall(request)
+                assert receive_legacy_request(sock2, timeout=10) == request
+            finally:
+                sock1.close()
+                sock2.close()
+
+        # a malformed request is returned as soon as the error is detected, an incomplete one after the timeout
+        for request, timeout in [("<article></sentence>", 10), ("<article><sentence>", 0.2)]:
+            sock1, sock2 = socket.socketpair()
+            try:
+                sock1.sendall(request)
+                assert receive_legacy_request(sock2, timeout=timeout) == request
+            finally:
+                sock1.close()
+                sock2.close()
@@ -92,3 +92,64 @@ class TestMakeData:
         if gpu is not None:
             args_train += ['--gpu', gpu]
         main(arguments=args_train)
+
+
+class TestLRUCache:
+    def test_eviction(self):
+        from nmt_chainer.utilities.lru_cache import LRUCache
+        cache = LRUCache(100)
+        cache.put("a", np.zeros(10, dtype=np.float32))
+        cache.put("b", (np.zeros(10, dtype=np.float32), None))
+        assert cache.size_in_bytes == 80
+        assert cache.get("a") is not None  # "b" is now the least recently used
+        cache.put("c", np.zeros(6, dtype=np.float32))
+        assert "b" not in cache and "a" in cache and "c" in cache
+        assert cache.size_in_bytes == 64
+        assert cache.get("b") is None
+        cache.put("d", np.zeros(30, dtype=np.float32))  # larger than the cache
+        assert "d" not in cache
+        assert (cache.nb_hits, cache.nb_misses, cache.nb_evictions) == (1, 1, 1)
+
+
+class TestWorkerProcesses:
+    def test_order(self):
+        from nmt_chainer.utilities.worker_processes import map_in_worker_processes
+
+        def square_all(shard):
+            for x in shard:
+                yield x * x
+
+        assert list(map_in_worker_processes(square_all, xrange(17), 4, nb_blas_threads=1)) == [x * x for x in xrange(17)]
+
+    def test_failure(self):
+        import pytest
+        from nmt_chainer.utilities.worker_processes import map_in_worker_processes
+
+        def fail_on_5(shard):
+            for x in shard:
+                if x == 5:
+                    raise ValueError("5")
+                yield x
+
+        with pytest.raises(RuntimeError):
+            list(map_in_worker_processes(fail_on_5, xrange(10), 3))
+
+    def test_lazy_items(self):
+        from nmt_chainer.utilities.worker_processes import map_in_worker_processes
+        nb_items_read = [0]
+
+        def iterate_items():
+            for x in xrange(1000):
+                nb_items_read[0] += 1
+                yield x
+
+        def identity(shard):
+            for x in shard:
+                yield x
+
+        results = map_in_worker_processes(identity, iterate_items(), 2, max_pending_items=4)
+        assert [next(results) for _ in xrange(5)] == range(5)
+        # only a bounded number of items are read in advance
+        assert nb_items_read[0] < 100
+        assert list(results) == range(5, 1000)
+        assert nb_items_read[0] == 1000